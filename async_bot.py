@@ -0,0 +1,463 @@
+# async_bot.py
+# asyncio runtime for the test flow in flow.py, which bot.py runs on python-telegram-bot:
+# handlers are coroutines and Bot API calls go over a shared pool of keep-alive HTTP
+# connections. Long polling or a webhook (BOT_MODE), with tests in progress kept in
+# sessions.db like bot.py's.
+import asyncio
+import json
+import logging
+import secrets
+import signal
+import ssl
+import time
+import urllib.parse
+from collections import defaultdict
+
+import config
+import metrics
+from bot_api import BotAPIMethods, TelegramError
+from outbound import OutboundQueue
+from catalog import CATALOGS
+from flow import CANCEL_TEXT, END, MENU_TEXT, SHOW_QUESTION, STALE_TAP_TEXT, TestFlow
+from keyboards import MENU_KEYBOARD
+from results_store import open_results_store
+from results_writer import ResultsWriter
+from session_database import SessionDatabase
+from session_manager import SessionManager, record_abandonment
+from stats import checkpoint_path, follow_results
+from webhook import WebhookServer, require_webhook_url
+
+# Enable logging
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONVERSATION = 'tests'  # bot.py's ConversationHandler name
+
+
+def encode_params(params):
+    # reply_markup arrives prebuilt as JSON (see keyboards.py) and is spliced in without re-encoding
+    reply_markup = params.pop('reply_markup', None)
+    body = json.dumps({k: v for k, v in params.items() if v is not None}, ensure_ascii=False)
+    if reply_markup is not None:
+        body = f'{body[:-1]}{", " if len(body) > 2 else ""}"reply_markup": {reply_markup}}}'
+    return body.encode('utf-8')
+
+
+class BotAPI(BotAPIMethods):
+    """Bot API client; concurrent requests share up to pool_size keep-alive HTTP/1.1 connections."""
+
+    def __init__(self, token, base_url='https://api.telegram.org', pool_size=16, timeout=60):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.ssl = ssl.create_default_context() if url.scheme == 'https' else None
+        self.port = url.port or (443 if self.ssl else 80)
+        self.path = f"{url.path.rstrip('/')}/bot{token}/"
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle = []
+        self._slots = None
+
+    async def call(self, method, **params):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+        body = encode_params(params)
+        # Long polls are held open by the server for up to `timeout` seconds
+        timeout = self.timeout + (params.get('timeout') or 0)
+        start = time.perf_counter()
+        try:
+            async with self._slots:
+                status, payload = await asyncio.wait_for(self._request(method, body), timeout)
+        finally:
+            metrics.API_CALL_SECONDS.labels(method).observe(time.perf_counter() - start)
+        data = json.loads(payload)
+        if not data.get('ok'):
+            metrics.API_ERRORS.labels(method).inc()
+            retry_after = (data.get('parameters') or {}).get('retry_after')
+            raise TelegramError(data.get('description', f'HTTP {status}'), data.get('error_code', status), retry_after)
+        return data['result']
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    async def _request(self, method, body):
+        request = (f'POST {self.path}{method} HTTP/1.1\r\n'
+                   f'Host: {self.host}\r\n'
+                   'Content-Type: application/json\r\n'
+                   f'Content-Length: {len(body)}\r\n'
+                   '\r\n').encode('latin-1') + body
+        while self._idle:
+            # A pooled connection may have been closed by the server; fall back to a fresh one
+            reader, writer = self._idle.pop()
+            try:
+                return await self._exchange(reader, writer, request)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        return await self._exchange(reader, writer, request)
+
+    async def _exchange(self, reader, writer, request):
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError('connection closed by server')
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip().lower()
+            keep_alive = headers.get('connection') != 'close'
+            if 'content-length' in headers:
+                payload = await reader.readexactly(int(headers['content-length']))
+            elif headers.get('transfer-encoding') == 'chunked':
+                payload = b''
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    chunk = await reader.readexactly(size + 2)
+                    if not size:
+                        break
+                    payload += chunk[:-2]
+            else:
+                payload = await reader.read()
+                keep_alive = False
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, payload
+
+
+class Context:
+    __slots__ = ('api', 'flow', 'user_data', 'chat_id', 'user_id')
+
+    def __init__(self, api, flow, user_data, chat_id, user_id):
+        self.api = api
+        self.flow = flow
+        self.user_data = user_data
+        self.chat_id = chat_id
+        self.user_id = user_id
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'start')
+async def start(update, context):
+    context.flow.abandon(context.user_id, context.user_data, 'restarted')
+    await context.api.send_message(context.chat_id, MENU_TEXT, reply_markup=MENU_KEYBOARD)
+    return END
+
+
+async def delete_message(context, message_id):
+    try:
+        await context.api.delete_message(context.chat_id, message_id)
+    except (TelegramError, OSError) as e:
+        logger.error(f"Error deleting message: {e}")
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'test_selection')
+async def test_selection(update, context):
+    query = update['callback_query']
+    if not TestFlow.is_test(query.get('data')):
+        # A test the catalog no longer has; a test in progress goes on
+        await drop_callback(context, query)
+        return TestFlow.state(context.user_data)
+
+    old_message_id = context.flow.start_test(context.user_id, context.user_data, query['data'])
+    # Answer the button and delete the question message of a test left unfinished concurrently
+    await asyncio.gather(context.api.answer_callback_query(query['id']),
+                         *([delete_message(context, old_message_id)] if old_message_id else []))
+    return await show_question(update, context)
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'show_question')
+async def show_question(update, context):
+    session = context.user_data['session']
+    question = TestFlow.next_question(session)
+    if question is None:
+        return await end_test(update, context)
+    text, reply_markup = question
+    if session.current_question == 0:
+        sent_message = await context.api.send_message(context.chat_id, text, reply_markup=reply_markup)
+        session.message_id = sent_message['message_id']
+    else:
+        # Not awaited: while the edit waits for the chat's rate limit, the next answer's edit replaces it
+        context.api.submit('editMessageText', chat_id=context.chat_id, message_id=session.message_id,
+                           text=text, reply_markup=reply_markup)
+    return SHOW_QUESTION
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'end_test')
+async def end_test(update, context):
+    message_id = context.user_data['session'].message_id
+    result_message = context.flow.finish_test(context.user_id, context.user_data)
+    await context.api.edit_message_text(context.chat_id, message_id, result_message)
+    # Nothing is kept between tests; the menu's buttons start the next one
+    return END
+
+
+async def drop_callback(context, query, text=None):
+    # Ignores the tap, but answers it so the client stops showing its loading spinner
+    metrics.CALLBACKS_DROPPED.inc()
+    try:
+        await context.api.answer_callback_query(query['id'], text)
+    except (TelegramError, OSError) as e:
+        logger.debug(f"Error answering a dropped callback: {e}")
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handle_answer')
+async def handle_answer(update, context):
+    query = update['callback_query']
+    # Double taps, redelivered callbacks and taps on old keyboards are dropped with no API call
+    # but the callback answer
+    message_id = (query.get('message') or {}).get('message_id')
+    if not TestFlow.record_answer(context.user_data, message_id, query.get('data')):
+        await drop_callback(context, query)
+        return TestFlow.state(context.user_data)
+
+    # Acknowledge the tap while the next question is being sent
+    answering = asyncio.ensure_future(context.api.answer_callback_query(query['id']))
+    try:
+        return await show_question(update, context)
+    finally:
+        await answering
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'cancel_handler')
+async def cancel_handler(update, context):
+    context.flow.abandon(context.user_id, context.user_data, 'cancelled')
+    await context.api.send_message(context.chat_id, CANCEL_TEXT)
+    return END
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'show_history')
+async def show_history(update, context):
+    # The lookup may wait for the results writer, so it runs off the event loop
+    text = await asyncio.get_running_loop().run_in_executor(None, context.flow.history_text, context.user_id)
+    await context.api.send_message(context.chat_id, text)
+
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'show_stats')
+async def show_stats(update, context):
+    text = await asyncio.get_running_loop().run_in_executor(None, context.flow.stats_text, context.user_id)
+    if text is not None:
+        await context.api.send_message(context.chat_id, text)
+
+
+class AsyncBot:
+    """Routes updates to the handlers like bot.py's ConversationHandler.
+
+    Updates from one user are handled in order; different users run concurrently.
+    Tests idle for longer than session_ttl seconds are evicted by run_expiry(). With
+    statistics (a stats.ResultStatistics), finished tests also show their percentile.
+    With a session_database.SessionDatabase, tests in progress survive restarts.
+    """
+
+    def __init__(self, api, results_writer, max_concurrent_updates=512, session_ttl=config.SESSION_IDLE_TTL,
+                 statistics=None, database=None):
+        self.api = api
+        self.flow = TestFlow(results_writer, statistics)
+        self.database = database
+        self.max_concurrent_updates = max_concurrent_updates
+        if database is not None:
+            self.user_data = database.load_user_data()
+            self.states = database.load_conversations(CONVERSATION)
+            # States saved with no test behind them, such as the menu state older versions kept
+            # between tests
+            for key in TestFlow.stale_conversations(self.states, self.user_data):
+                self._set_state(key, END)
+            # Tests left in progress before a restart are still active
+            metrics.ACTIVE_SESSIONS.set(sum('session' in data for data in self.user_data.values()))
+        else:
+            self.user_data = defaultdict(dict)
+            self.states = {}
+        self.sessions = SessionManager(self.user_data, session_ttl, on_evict=self._record_eviction)
+        for user_id in list(self.user_data):
+            self.sessions.touch(user_id)
+        self._locks = {}
+        self._tasks = set()
+        self._slots = None
+
+    async def process_update(self, update):
+        if 'message' in update:
+            message = update['message']
+        elif 'callback_query' in update:
+            message = update['callback_query'].get('message') or {}
+        else:
+            return
+        user_id = (update.get('message') or update['callback_query'])['from']['id']
+        chat_id = message.get('chat', {}).get('id', user_id)
+
+        lock, waiting = self._locks.get(user_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[user_id] = (lock, waiting + 1)
+        try:
+            async with lock:
+                context = Context(self.api, self.flow, self.user_data[user_id], chat_id, user_id)
+                await self._dispatch(update, context)
+        except Exception:
+            logger.exception(f"Error handling update {update.get('update_id')}")
+        finally:
+            if self.database is not None:
+                self.database.save_user_data(user_id, self.user_data.get(user_id, {}))
+            self.sessions.touch(user_id)
+            lock, waiting = self._locks[user_id]
+            if waiting == 1:
+                del self._locks[user_id]
+            else:
+                self._locks[user_id] = (lock, waiting - 1)
+
+    async def _dispatch(self, update, context):
+        key = (context.chat_id, context.user_id)
+        state = self.states.get(key)
+        text = (update.get('message') or {}).get('text', '')
+        # Answered in any state, without changing it
+        if text.startswith('/history'):
+            await show_history(update, context)
+            return
+        if text.startswith('/stats'):
+            await show_stats(update, context)
+            return
+        if text.startswith('/start'):
+            new_state = await start(update, context)
+        elif text.startswith('/cancel') and state is not None:
+            new_state = await cancel_handler(update, context)
+        elif 'callback_query' in update and TestFlow.is_menu_choice(update['callback_query'].get('data')):
+            # The menu's buttons start a test in any state, including none
+            new_state = await test_selection(update, context)
+        elif 'callback_query' in update and state == SHOW_QUESTION:
+            new_state = await handle_answer(update, context)
+        elif 'callback_query' in update:
+            # Taps on the keyboard of a test that finished or expired, with no conversation state left to take them
+            await drop_callback(context, update['callback_query'], STALE_TAP_TEXT)
+            return
+        else:
+            return
+        self._set_state(key, new_state)
+
+    def _set_state(self, key, state):
+        if state == END:
+            if self.states.pop(key, None) is None:
+                return
+            state = None
+        elif self.states.get(key) == state:
+            return
+        else:
+            self.states[key] = state
+        if self.database is not None:
+            self.database.save_conversation(CONVERSATION, key, state)
+
+    def _record_eviction(self, user_id, session):
+        record_abandonment(self.flow.results_writer, user_id, session, 'expired')
+        # Tests are taken in private chats, keyed (user_id, user_id)
+        self._set_state((user_id, user_id), END)
+        if self.database is not None:
+            self.database.save_user_data(user_id, {})
+
+    async def run_expiry(self, interval=config.SESSION_SWEEP_INTERVAL):
+        """Evicts idle sessions every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            self.sessions.expire()
+
+    async def schedule(self, update):
+        """Starts handling an update in the background, waiting while max_concurrent_updates are in flight."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent_updates)
+        await self._slots.acquire()
+        task = asyncio.ensure_future(self.process_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+
+    async def drain(self):
+        """Waits for every scheduled update to be handled."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def run_polling(self, poll_timeout=30):
+        offset = None
+        while True:
+            try:
+                updates = await self.api.get_updates(offset=offset, timeout=poll_timeout)
+            except (TelegramError, OSError, asyncio.TimeoutError) as e:
+                logger.error(f"Error fetching updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                await self.schedule(update)
+
+
+async def run_webhook(bot):
+    """Receives updates on a local HTTP endpoint instead of long polling."""
+    loop = asyncio.get_running_loop()
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    # The server's dispatch thread hands updates to the event loop one at a time, in order
+    webhook = WebhookServer(lambda update: asyncio.run_coroutine_threadsafe(bot.schedule(update), loop).result(),
+                            secret_token, host=config.WEBHOOK_HOST, port=config.WEBHOOK_PORT,
+                            path=config.WEBHOOK_PATH, queue_size=config.WEBHOOK_QUEUE_SIZE).start()
+    try:
+        await bot.api.call('setWebhook', url=config.WEBHOOK_URL, secret_token=secret_token)
+        await asyncio.Event().wait()
+    finally:
+        # stop() joins the dispatch thread, which may be waiting on this loop
+        await loop.run_in_executor(None, webhook.stop)
+
+
+async def run(token, base_url='https://api.telegram.org'):
+    api = OutboundQueue(BotAPI(token, base_url), config.OUTBOUND_GLOBAL_RATE, config.OUTBOUND_CHAT_RATE,
+                        config.OUTBOUND_CHAT_BURST)
+    results_writer = ResultsWriter(open_results_store(config.RESULTS_DB, history_depth=config.HISTORY_LENGTH + 1))
+    statistics = follow_results(results_writer, checkpoint_path(config.RESULTS_DB), config.STATS_CHECKPOINT_INTERVAL)
+    results_writer.start()
+    # In-progress tests and conversation states, in bot.py's format
+    database = SessionDatabase(config.SESSIONS_DB)
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = metrics.MetricsServer(host=config.METRICS_HOST, port=config.METRICS_PORT).start()
+    bot = AsyncBot(api, results_writer, statistics=statistics, database=database)
+    # Ctrl-C and SIGTERM (docker stop) end the bot through the cleanup below
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, asyncio.current_task().cancel)
+    expiry = asyncio.ensure_future(bot.run_expiry())
+    CATALOGS.start(config.CATALOG_RELOAD_INTERVAL)
+    try:
+        if config.BOT_MODE == 'webhook':
+            await run_webhook(bot)
+        else:
+            await bot.run_polling()
+    finally:
+        expiry.cancel()
+        await bot.drain()
+        CATALOGS.stop()
+        await api.close()
+        database.flush()
+        if not results_writer.close():
+            logger.error("Some results could not be saved; they are logged above")
+        statistics.save_checkpoint()
+        if metrics_server:
+            metrics_server.stop()
+
+
+def main() -> None:
+    if config.BOT_MODE == 'webhook':
+        require_webhook_url(config.WEBHOOK_URL)
+    with open("token.txt", "r") as file:
+        token = file.read().strip()
+    try:
+        asyncio.run(run(token, config.TELEGRAM_API_URL))
+    except asyncio.CancelledError:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# batch_scoring.py
+# Vectorized scoring of many completions at once with NumPy, for re-scoring stored
+# results after the rules in scoring_rules.json change:
+#
+#   python batch_scoring.py results.csv --output results.db
+#   python batch_scoring.py results.csv --benchmark --scale 1000
+import argparse
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+import scoring
+from results_store import Completion, completion_keys, open_results_store, read_results_csv
+
+
+class BatchScores(NamedTuple):
+    totals: np.ndarray  # (n,)
+    subscales: np.ndarray  # (n, number of subscales), as in calculate_pcl5_cluster_scores
+    diagnosis: np.ndarray  # (n,) bool, as in make_provisional_diagnosis
+    diagnosis_labels: np.ndarray  # (n,) str
+    labels: np.ndarray  # (n,) str, as in explain_score
+
+
+def band_labels(instrument, totals, diagnosis):
+    """Band label for every total, falling back like Instrument.interpret where diagnosis is False."""
+    index = np.searchsorted(instrument.cutoffs, totals, side='right')
+    labels = np.array(instrument.labels, dtype=object)[index]
+    if instrument.labels_without_diagnosis:
+        fallbacks = instrument.labels_without_diagnosis
+        use_fallback = np.array([label is not None for label in fallbacks])[index] & ~diagnosis
+        labels[use_fallback] = np.array(fallbacks, dtype=object)[index[use_fallback]]
+    return labels
+
+
+def score_matrix(instrument, answers):
+    """Scores an (n_completions x n_items) matrix of option indices for one instrument."""
+    answers = np.asarray(answers)
+    # Running sums with a leading zero column turn every item range sum into one subtraction
+    running = np.zeros((len(answers), answers.shape[1] + 1), dtype=np.int64)
+    np.cumsum(answers, axis=1, out=running[:, 1:])
+    totals = running[:, -1] + instrument.min_item_score * answers.shape[1]
+    subscales = np.empty((len(answers), len(instrument.subscales)), dtype=np.int64)
+    for column, (_, start, stop) in enumerate(instrument.subscales):
+        np.subtract(running[:, stop], running[:, start], out=subscales[:, column])
+    diagnosis = np.ones(len(answers), dtype=bool)
+    for start, stop, minimum in instrument.diagnosis_criteria:
+        diagnosis &= running[:, stop] - running[:, start] >= minimum
+    diagnosis_labels = np.array(instrument.diagnosis_labels, dtype=object)[(~diagnosis).view(np.uint8)]
+    return BatchScores(totals, subscales, diagnosis, diagnosis_labels, band_labels(instrument, totals, diagnosis))
+
+
+def rescore(completions):
+    """Re-scores completions with the current rules, one vectorized pass per test; keeps their order.
+
+    Completions with a full set of answers get a new total and explanation; older rows that
+    only stored a total keep it and get a new explanation. Unknown tests are left as they are.
+    """
+    completions = list(completions)
+    if not completions:
+        return []
+    # Work column-wise so the only per-row Python work is splitting and rebuilding the tuples
+    user_ids, test_names, timestamps, answers, totals, explanations, versions = zip(*completions)
+    tests = np.array(test_names, dtype=object)
+    lengths = np.fromiter(map(len, answers), dtype=np.int64, count=len(answers))
+    totals = np.array(totals, dtype=np.int64)
+    labels = np.array(explanations, dtype=object)
+    for test_name, instrument in scoring.INSTRUMENTS.items():
+        in_test = tests == test_name
+        full = in_test & (lengths == instrument.items)
+        positions = np.flatnonzero(full)
+        if len(positions):
+            matrix = np.frombuffer(b''.join([answers[position] for position in positions.tolist()]),
+                                   dtype=np.uint8).reshape(len(positions), instrument.items)
+            scores = score_matrix(instrument, matrix)
+            totals[positions] = scores.totals
+            labels[positions] = scores.labels
+        positions = np.flatnonzero(in_test & ~full)
+        if len(positions):
+            labels[positions] = band_labels(instrument, totals[positions], np.zeros(len(positions), dtype=bool))
+    return list(map(Completion, user_ids, test_names, timestamps, answers, totals.tolist(), labels.tolist(),
+                    versions))
+
+
+def rescore_one(completion):
+    """Row-by-row equivalent of rescore() using the scalar scoring functions."""
+    instrument = scoring.INSTRUMENTS.get(completion.test_name)
+    if instrument is None:
+        return completion
+    if len(completion.answers) == instrument.items:
+        return completion._replace(total_score=instrument.total(completion.answers),
+                                   explanation=scoring.explain_score(completion.test_name, completion.answers))
+    return completion._replace(explanation=instrument.interpret(completion.total_score))
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(completions, repeat=5):
+    """Best-of-`repeat` seconds for rescore() and for the scalar loop, after checking they agree."""
+    if rescore(completions) != [rescore_one(completion) for completion in completions]:
+        raise AssertionError("vectorized and scalar scoring disagree")
+    return {
+        'vectorized': best_of(lambda: rescore(completions), repeat),
+        'scalar': best_of(lambda: [rescore_one(completion) for completion in completions], repeat),
+    }
+
+
+def benchmark_pcl5(rows, repeat=5, seed=1):
+    """Same as benchmark(), for the scoring alone on a random PCL-5 answer matrix."""
+    pcl5 = scoring.INSTRUMENTS['ptsd']
+    matrix = np.random.default_rng(seed).integers(0, pcl5.max_item_score + 1, (rows, pcl5.items))
+    responses = matrix.tolist()
+
+    def scalar():
+        return [(sum(row), scoring.calculate_pcl5_cluster_scores(row), scoring.make_provisional_diagnosis(row),
+                 scoring.score_pcl5(row)) for row in responses]
+
+    return {
+        'vectorized': best_of(lambda: score_matrix(pcl5, matrix), repeat),
+        'scalar': best_of(scalar, repeat),
+    }
+
+
+def print_timings(title, timings, rows):
+    print(title)
+    for name, seconds in timings.items():
+        print(f"  {name:10s} {seconds * 1000:10.2f} ms  {seconds / rows * 1e9:10.1f} ns/completion")
+    print(f"  speedup: {timings['scalar'] / timings['vectorized']:.1f}x over {rows} completions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score stored completions with the current scoring rules.")
+    parser.add_argument('source', nargs='?', default='results.csv')
+    parser.add_argument('--output', help="new or empty results store (.csv or .db) to write the re-scored "
+                                         "completions to")
+    parser.add_argument('--benchmark', action='store_true', help="time the vectorized pass against scalar scoring")
+    parser.add_argument('--scale', type=int, default=1, help="repeat the completions this many times when benchmarking")
+    args = parser.parse_args()
+
+    completions = list(read_results_csv(args.source))
+    rescored = rescore(completions)
+    changed = sum(old != new for old, new in zip(completions, rescored))
+    print(f"Re-scored {len(completions)} completions from {args.source}, {changed} changed")
+
+    if args.output:
+        store = open_results_store(args.output)
+        try:
+            # Adding to a store that has results would duplicate them, or mix old and new scores
+            if completion_keys(store):
+                parser.error(f"{args.output} already has completions; write the re-scored ones to a new store")
+            store.add_many(rescored)
+        finally:
+            store.close()
+        print(f"Wrote {len(rescored)} completions to {args.output}")
+
+    if args.benchmark:
+        rows = len(completions) * args.scale
+        print_timings(f"re-scoring {args.source}:", benchmark(completions * args.scale), rows)
+        print_timings("PCL-5 totals, clusters, diagnosis and bands:", benchmark_pcl5(rows), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# benchmarks/async_runtime.py
+# Tests completed per second by bot.py (python-telegram-bot 13's Updater and
+# Dispatcher, running handlers one update at a time) and by async_bot.py, each
+# started as a subprocess against the fake Bot API server with every call but
+# getUpdates taking `latency` seconds. The users are loadgen.py's, with no think
+# time, all arriving at once.
+#
+#   python benchmarks/async_runtime.py [users] [latency_ms]
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from loadgen import run_load
+
+
+def run_script(script, users, latency):
+    args = argparse.Namespace(script=script, users=users, think_time=0.0, ramp_up=0.0, latency=latency,
+                              error_rate=0.0, flood_rate=0.0, timeout=60.0, results='results.csv', seed=1)
+    return asyncio.run(run_load(args))
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    # The bots' own logs go to their stderr; keep the fake server's quiet here
+    logging.disable(logging.INFO)
+    print(f"{users} users, simulated Bot API latency: {latency * 1000:.0f} ms per call")
+    for script in ('bot.py', 'async_bot.py'):
+        report = run_script(script, users, latency)
+        print(f"{script:13s} {report['throughput_tests_per_s']:8.2f} tests/s "
+              f"{report['throughput_updates_per_s']:8.1f} updates/s  p50 {report['latency_ms']['p50']:8.1f} ms  "
+              f"completed {report['completed_tests']}/{users}, errors {report['errors']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# benchmarks/catalog_reload.py
+# Hot reload with catalog.CatalogRegistry, on copies of the banks and scoring rules in
+# a temporary directory:
+# - a wording edit and a threshold edit swap in a new version; a test started before
+#   the edit keeps its questions and scoring, one started after gets the new ones
+# - an edit that doesn't validate is refused and the current version stays
+# - time for a rebuild (on the watcher thread) and for the check() the watcher runs
+#   when nothing changed; the handlers only read CatalogRegistry.current
+#
+#   python benchmarks/catalog_reload.py
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalog import CatalogRegistry, build_catalog
+from question_bank import TEST_FILES, parse_all_banks
+from scoring import SCORING_RULES_FILE, explain_score, load_scoring_rules
+from session import Session
+
+TEST_NAME = 'beck_depression'
+
+
+def best_of(func, repeat=20):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def edit(path, change):
+    with open(path, encoding='utf-8') as file:
+        text = file.read()
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(change(text))
+    # Make sure the edit shows up in the mtime even on coarse-grained filesystems
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def main():
+    ok = True
+
+    def check(name, passed):
+        nonlocal ok
+        ok = ok and passed
+        print(f"{name:58s} {'ok' if passed else 'FAILED'}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        test_files = {test_name: shutil.copy(filename, directory) for test_name, filename in TEST_FILES.items()}
+        rules_file = shutil.copy(SCORING_RULES_FILE, directory)
+        instruments = load_scoring_rules(rules_file)
+        registry = CatalogRegistry(build_catalog(parse_all_banks(test_files, instruments), instruments),
+                                   test_files, rules_file)
+        first = registry.current
+        before = Session(TEST_NAME, catalog=registry.current)
+
+        edit(test_files[TEST_NAME], lambda text: text.replace('1 ', '1 (отредактировано) ', 1))
+        edit(rules_file, lambda text: json.dumps(_raise_second_band(json.loads(text)), ensure_ascii=False))
+        check("edit swaps in a new version", registry.check() and registry.current.version != first.version)
+        after = Session(TEST_NAME, catalog=registry.current)
+        check("test in progress keeps its questions",
+              before.questions[0].text == first.banks[TEST_NAME][0].text and before.catalog is first)
+        check("new test gets the edited questions", '(отредактировано)' in after.questions[0].text)
+        # A total of 12: the second band before the edit, still the first after it
+        answers = [1] * 12 + [0] * (len(before.questions) - 12)
+        check("each test is scored under its own version's rules",
+              explain_score(TEST_NAME, answers, before.catalog.instruments)
+              != explain_score(TEST_NAME, answers, after.catalog.instruments))
+        check("a stored session's version resolves to its snapshot", registry.get(first.version) is first)
+
+        rebuild = best_of(lambda: build_catalog(parse_all_banks(test_files, instruments), instruments))
+        idle_check = best_of(registry.check, 1000)
+        lookup = best_of(lambda: registry.current.banks[TEST_NAME], 1000)
+
+        current = registry.current
+        edit(test_files[TEST_NAME], lambda text: text.split('\n', 1)[1])
+        check("edit dropping a question is refused", not registry.check() and registry.current is current)
+    print(f"rebuild on the watcher thread: {rebuild * 1e3:8.2f} ms")
+    print(f"check() with nothing changed:  {idle_check * 1e6:8.2f} us")
+    print(f"current snapshot lookup:       {lookup * 1e9:8.0f} ns")
+    if not ok:
+        sys.exit(1)
+
+
+def _raise_second_band(rules):
+    bands = sorted(rules[TEST_NAME]['bands'], key=lambda band: band['min'])
+    # Move the second band's minimum up to just below the third's
+    bands[1]['min'] = bands[2]['min'] - 1
+    return rules
+
+
+if __name__ == '__main__':
+    main()
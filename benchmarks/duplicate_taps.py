@@ -0,0 +1,159 @@
+# benchmarks/duplicate_taps.py
+# Rapid duplicate taps against both bots: async_bot.AsyncBot on the in-process
+# FakeBotAPI, and bot.py (python-telegram-bot's Dispatcher with
+# SqliteSessionPersistence, in process against the fake Bot API server). Every answer
+# is delivered several times in a row (double taps and Telegram redeliveries), and
+# taps on a finished test's keyboard are replayed at the end. Checks that each
+# completion holds exactly the intended answers and that every callback, dropped or
+# not, is answered (or the client keeps spinning), and counts the API calls the
+# duplicates cost.
+#
+#   python benchmarks/duplicate_taps.py [users] [copies_per_tap]
+import asyncio
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+import bot as ptb_bot
+import metrics
+from async_bot import AsyncBot
+from fake_telegram import FakeBot, FakeBotAPI, FakeTelegramServer, callback_update, command_update
+from flow import TestFlow
+from keyboards import answer_callback_data
+from persistence import SqliteSessionPersistence
+from question_bank import get_questions
+from results_store import ResultsStore
+from results_writer import ResultsWriter
+
+TEST_NAME = 'ptsd'
+REPLAYED_TAPS = 3
+
+
+class MemoryStore(ResultsStore):
+    def __init__(self):
+        self.completions = []
+
+    def add_many(self, completions):
+        self.completions.extend(completions)
+
+
+def expected_answers(users):
+    rng = random.Random(1)
+    questions = get_questions(TEST_NAME)
+    return {1000 + user_id: [rng.randrange(len(question.options)) for question in questions]
+            for user_id in range(users)}
+
+
+async def user(bot, user_id, answers, copies):
+    await bot.process_update(command_update(None, user_id, '/start'))
+    await bot.process_update(callback_update(None, user_id, TEST_NAME, 1))
+    message_id = bot.user_data[user_id]['session'].message_id
+    taps = []
+    for index, option in enumerate(answers):
+        tap = callback_update(None, user_id, answer_callback_data(index, option), message_id)
+        taps.append(tap)
+        # The same callback arrives `copies` times before the bot has handled the first
+        await asyncio.gather(*(bot.process_update(tap) for _ in range(copies)))
+    # Taps on the finished test's keyboard, e.g. scrolled back up in the chat
+    for tap in taps[:REPLAYED_TAPS]:
+        await bot.process_update(tap)
+
+
+async def run_async(expected, copies):
+    store = MemoryStore()
+    writer = ResultsWriter(store)
+    api = FakeBotAPI(0.001)
+    bot = AsyncBot(api, writer)
+    await asyncio.gather(*(user(bot, user_id, answers, copies) for user_id, answers in expected.items()))
+    # Let the fire-and-forget question edits land
+    await asyncio.sleep(0.05)
+    writer.close()
+    return store.completions, api.bot.calls
+
+
+def run_ptb(expected, copies):
+    """The same taps through bot.py's handlers. The Dispatcher handles a user's updates one
+    at a time, so the copies of a tap arrive back to back rather than concurrently."""
+    store = MemoryStore()
+    writer = ResultsWriter(store)
+    fake = FakeBot()
+    server = FakeTelegramServer(fake).start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            bot = Bot('123456:FAKE', base_url=f'{server.url}/bot')
+            persistence = SqliteSessionPersistence(os.path.join(directory, 'sessions.db'))
+            dispatcher = Dispatcher(bot, None, workers=0, persistence=persistence)
+            ptb_bot.add_handlers(dispatcher, TestFlow(writer))
+            update_ids = itertools.count(1)
+
+            def process(data):
+                dispatcher.process_update(Update.de_json(data, bot))
+
+            for user_id, answers in expected.items():
+                process(command_update(next(update_ids), user_id, '/start'))
+                process(callback_update(next(update_ids), user_id, TEST_NAME, 1))
+                message_id = dispatcher.user_data[user_id]['session'].message_id
+                taps = []
+                for index, option in enumerate(answers):
+                    data = answer_callback_data(index, option)
+                    taps.append(data)
+                    for _ in range(copies):
+                        process(callback_update(next(update_ids), user_id, data, message_id))
+                for data in taps[:REPLAYED_TAPS]:
+                    process(callback_update(next(update_ids), user_id, data, message_id))
+            persistence.flush()
+    finally:
+        server.stop()
+    writer.close()
+    return store.completions, fake.calls
+
+
+def report(name, expected, copies, completions, calls, dropped):
+    users = len(expected)
+    questions = len(get_questions(TEST_NAME))
+    recorded = {completion.user_id: list(completion.answers) for completion in completions}
+    wrong = sum(recorded.get(user_id) != answers for user_id, answers in expected.items())
+    taps = users * questions
+    # Test selection, every copy of every tap, and the replayed taps
+    callbacks = users + taps * copies + users * REPLAYED_TAPS
+    answered = sum(method == 'answerCallbackQuery' for method, _ in calls)
+    edits = sum(method == 'editMessageText' for method, _ in calls)
+    print(f"{name}: {users} users x {questions} questions, each tap delivered {copies} times")
+    print(f"completions: {len(recorded)}, with wrong answers: {wrong}")
+    print(f"callbacks dropped: {dropped:.0f} of {taps * copies + users * REPLAYED_TAPS} answer callbacks")
+    print(f"callbacks answered: {answered} of {callbacks}")
+    print(f"question edits: {edits} for {taps} real taps ({edits / taps:.2f} per tap)")
+    return not wrong and len(recorded) == users and answered == callbacks
+
+
+def dropped_during(func, *args):
+    before = metrics.CALLBACKS_DROPPED._value.value
+    result = func(*args)
+    return result, metrics.CALLBACKS_DROPPED._value.value - before
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    logging.disable(logging.INFO)
+    expected = expected_answers(users)
+    (completions, calls), dropped = dropped_during(lambda: asyncio.run(run_async(expected, copies)))
+    ok = report('async_bot.py', expected, copies, completions, calls, dropped)
+    print()
+    (completions, calls), dropped = dropped_during(run_ptb, expected, copies)
+    ok = report('bot.py', expected, copies, completions, calls, dropped) and ok
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# benchmarks/history.py
+# /history lookups against results stores of growing size: SqliteResultsStore walks
+# the completions_user index and CsvResultsStore answers from its in-memory index, so
+# both should stay flat, while filtering a scan of the CSV (what answering /history
+# from results.csv used to take) grows with the file. Both stores must return the
+# same rows as the scan, also when asked for more rows per test than the CSV index
+# was built with.
+#
+#   python benchmarks/history.py [max_rows]
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from history import format_history
+from results_store import Completion, CsvResultsStore, SqliteResultsStore, read_results_csv
+
+TESTS = ('beck_anxiety', 'beck_depression', 'ptsd', 'social_phobia')
+PER_TEST = 6  # HISTORY_LENGTH results plus one for the oldest one's change
+ROWS_PER_USER = 20
+LOOKUPS = 2000
+
+
+def make_completions(rows, seed=1):
+    rng = random.Random(seed)
+    users = max(rows // ROWS_PER_USER, 1)
+    completions = []
+    for index in range(rows):
+        # One completion a minute, so timestamps are distinct and in file order
+        day, minute = divmod(index, 24 * 60)
+        timestamp = f'2023-{1 + day // 28 % 12:02d}-{1 + day % 28:02d} {minute // 60:02d}:{minute % 60:02d}:00'
+        score = rng.randrange(0, 64)
+        completions.append(Completion(rng.randrange(users), rng.choice(TESTS), timestamp, b'', score, '', 'v1'))
+    return completions
+
+
+def scan_history(filename, user_id, per_test):
+    tests = {}
+    for completion in read_results_csv(filename):
+        if completion.user_id == user_id:
+            tests.setdefault(completion.test_name, []).append(completion)
+    return [completion for test_name in sorted(tests) for completion in tests[test_name][::-1][:per_test]]
+
+
+def per_lookup(store, user_ids):
+    start = time.perf_counter()
+    for user_id in user_ids:
+        store.history(user_id, PER_TEST)
+    return (time.perf_counter() - start) / len(user_ids)
+
+
+def run(rows, directory):
+    completions = make_completions(rows)
+    users = max(rows // ROWS_PER_USER, 1)
+    sqlite_store = SqliteResultsStore(os.path.join(directory, f'{rows}.db'))
+    csv_store = CsvResultsStore(os.path.join(directory, f'{rows}.csv'), fsync=False, history_depth=PER_TEST)
+    for offset in range(0, rows, 10000):
+        sqlite_store.add_many(completions[offset:offset + 10000])
+        csv_store.add_many(completions[offset:offset + 10000])
+
+    # What the results writer's thread does at startup
+    start = time.perf_counter()
+    csv_store.preload()
+    index_build = time.perf_counter() - start
+    # Rows written after the index is built must show up too
+    extra = Completion(0, 'ptsd', '2024-01-01 00:00:00', b'', 1, '', 'v2')
+    sqlite_store.add(extra)
+    csv_store.add(extra)
+
+    rng = random.Random(2)
+    user_ids = [rng.randrange(users) for _ in range(LOOKUPS)]
+    sqlite_time = per_lookup(sqlite_store, user_ids)
+    csv_time = per_lookup(csv_store, user_ids)
+    start = time.perf_counter()
+    expected = scan_history(csv_store.filename, user_ids[0], PER_TEST)
+    scan_time = time.perf_counter() - start
+    correct = all(sqlite_store.history(user_id, PER_TEST) == csv_store.history(user_id, PER_TEST)
+                  == scan_history(csv_store.filename, user_id, PER_TEST) for user_id in (0, user_ids[0]))
+    correct = correct and sqlite_store.history(user_ids[0], PER_TEST) == expected
+    correct = correct and extra in sqlite_store.history(0, 1) and extra in csv_store.history(0, 1)
+    deeper = PER_TEST * 2
+    correct = correct and (csv_store.history(user_ids[0], deeper) == sqlite_store.history(user_ids[0], deeper)
+                           == scan_history(csv_store.filename, user_ids[0], deeper))
+    sample = format_history(csv_store.history(0, PER_TEST), PER_TEST - 1)
+    sqlite_store.close()
+    return sqlite_time, csv_time, index_build, scan_time, correct, sample
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{'rows':>8s} {'sqlite':>12s} {'csv index':>12s} {'index build':>12s} {'csv scan':>12s}")
+    ok = True
+    rows = 1000
+    with tempfile.TemporaryDirectory() as directory:
+        while rows <= max_rows:
+            sqlite_time, csv_time, index_build, scan_time, correct, sample = run(rows, directory)
+            ok = ok and correct
+            print(f"{rows:8d} {sqlite_time * 1e6:9.1f} us {csv_time * 1e6:9.1f} us {index_build * 1e3:9.1f} ms "
+                  f"{scan_time * 1e3:9.1f} ms  {'ok' if correct else 'MISMATCH'}")
+            rows *= 10
+    print()
+    print(sample)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# benchmarks/idle_users.py
+# Nothing is kept for a user between tests. Users finish a test and tap its keyboard
+# again, cancel one, switch tests, send /start again midway, or only send /start or
+# /history, against bot.py (python-telegram-bot's Dispatcher with
+# SqliteSessionPersistence, in process against the fake Bot API server) and against
+# async_bot.AsyncBot (on FakeBotAPI, with a SessionDatabase). Afterwards user_data,
+# the conversation states and sessions.db's sessions and conversations tables must
+# all be empty. Both start on a sessions.db holding the menu state older versions
+# saved between tests, which must be dropped on load.
+#
+#   python benchmarks/idle_users.py [users]
+import asyncio
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+import bot as ptb_bot
+from async_bot import AsyncBot
+from fake_telegram import FakeBot, FakeBotAPI, FakeTelegramServer, callback_update, command_update
+from flow import TestFlow
+from keyboards import answer_callback_data
+from persistence import SqliteSessionPersistence
+from question_bank import get_questions
+from results_store import open_results_store
+from results_writer import ResultsWriter
+from session_database import SessionDatabase
+
+TEST_NAME = 'beck_anxiety'
+OTHER_TEST = 'ptsd'
+OLD_MENU_STATE = 0
+OLD_USER_ID = 7
+
+
+def scenario(user_id):
+    """The updates a user sends, as (kind, argument) steps; 'answers' taps the current question's keyboard."""
+    questions = len(get_questions(TEST_NAME))
+    return [
+        # Finishes, then taps the finished test's keyboard
+        [('command', '/start'), ('menu', TEST_NAME), ('answers', questions), ('stale', 0)],
+        # Cancels midway
+        [('command', '/start'), ('menu', TEST_NAME), ('answers', 3), ('command', '/cancel')],
+        # Switches to another test from the old menu, and finishes that one
+        [('command', '/start'), ('menu', TEST_NAME), ('answers', 2), ('menu', OTHER_TEST),
+         ('answers', len(get_questions(OTHER_TEST)))],
+        # Sends /start midway, and leaves at the menu
+        [('command', '/start'), ('menu', TEST_NAME), ('answers', 4), ('command', '/start')],
+        [('command', '/start')],
+        [('command', '/history')],
+    ][user_id % 6]
+
+
+def seed_old_menu_state(path):
+    database = SessionDatabase(path)
+    database.save_conversation('tests', (OLD_USER_ID, OLD_USER_ID), OLD_MENU_STATE)
+    database.flush()
+
+
+def stored_rows(path):
+    with sqlite3.connect(path) as conn:
+        return (conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0],
+                conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0])
+
+
+def updates(user_id, user_data, update_ids):
+    """Yields the user's updates as Bot API dicts; reads the question message id from user_data."""
+    message_id = None
+    for kind, argument in scenario(user_id):
+        if kind == 'command':
+            yield command_update(next(update_ids), user_id, argument)
+        elif kind == 'menu':
+            yield callback_update(next(update_ids), user_id, argument, 1)
+            message_id = user_data[user_id]['session'].message_id
+        elif kind == 'answers':
+            for index in range(argument):
+                yield callback_update(next(update_ids), user_id, answer_callback_data(index, index % 4), message_id)
+        else:
+            yield callback_update(next(update_ids), user_id, answer_callback_data(argument, 0), message_id)
+
+
+def report(name, user_data, conversations, path):
+    sessions, saved_conversations = stored_rows(path)
+    print(f"{name}: user_data entries {len(user_data)}, conversation states {len(conversations)}, "
+          f"sessions.db sessions {sessions}, conversations {saved_conversations}")
+    return not user_data and not conversations and not sessions and not saved_conversations
+
+
+def run_ptb(directory, users):
+    path = os.path.join(directory, 'sessions.db')
+    seed_old_menu_state(path)
+    server = FakeTelegramServer(FakeBot()).start()
+    writer = ResultsWriter(open_results_store(os.path.join(directory, 'results.db')))
+    writer.start()
+    try:
+        bot = Bot('123456:FAKE', base_url=f'{server.url}/bot')
+        dispatcher = Dispatcher(bot, None, workers=0, persistence=SqliteSessionPersistence(path))
+        ptb_bot.add_handlers(dispatcher, TestFlow(writer))
+        update_ids = itertools.count(1)
+        for user_id in range(1000, 1000 + users):
+            for data in updates(user_id, dispatcher.user_data, update_ids):
+                dispatcher.process_update(Update.de_json(data, bot))
+        dispatcher.persistence.flush()
+        conversations = dispatcher.handlers[0][0].conversations
+        return report('bot.py', dispatcher.user_data, conversations, path)
+    finally:
+        writer.close()
+        server.stop()
+
+
+async def run_async(directory, users):
+    path = os.path.join(directory, 'sessions.db')
+    seed_old_menu_state(path)
+    writer = ResultsWriter(open_results_store(os.path.join(directory, 'results.db')))
+    writer.start()
+    database = SessionDatabase(path)
+    bot = AsyncBot(FakeBotAPI(0), writer, database=database)
+    update_ids = itertools.count(1)
+    for user_id in range(1000, 1000 + users):
+        for data in updates(user_id, bot.user_data, update_ids):
+            await bot.process_update(data)
+    database.flush()
+    writer.close()
+    return report('async_bot.py', bot.user_data, bot.states, path)
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        ok = run_ptb(directory, users)
+    with tempfile.TemporaryDirectory() as directory:
+        ok = asyncio.run(run_async(directory, users)) and ok
+    if not ok:
+        print("MISMATCH")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# benchmarks/outbound_queue.py
+# Fast tappers against a fake Bot API that enforces Telegram-like flood limits:
+# every chat gets a question message, then a burst of edits as its user taps
+# through answers faster than once a second, then the result edit. Compares
+# sending directly with sending through outbound.OutboundQueue.
+#
+#   python benchmarks/outbound_queue.py [chats] [taps] [tap_interval_ms]
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import metrics
+from bot_api import TelegramError
+from fake_telegram import FakeBot, FakeBotAPI
+from outbound import QUEUED_METHODS, OutboundQueue
+
+CHAT_LIMIT = 5
+GLOBAL_LIMIT = 30
+LATENCY = 0.02
+
+# The direct path's failed edits would each log an error
+logging.getLogger('bot_api').setLevel(logging.CRITICAL)
+
+
+async def tapper(api, chat_id, taps, tap_interval):
+    try:
+        message = await api.send_message(chat_id, 'question 0')
+    except TelegramError:
+        return None
+    for tap in range(1, taps + 1):
+        await asyncio.sleep(tap_interval)
+        api.submit('editMessageText', chat_id=chat_id, message_id=message['message_id'], text=f'question {tap}')
+    await asyncio.sleep(tap_interval)
+    try:
+        await api.edit_message_text(chat_id, message['message_id'], 'result')
+    except TelegramError:
+        pass
+    return message['message_id']
+
+
+async def run(queued, chats, taps, tap_interval):
+    bot = FakeBot(retry_after=1, chat_limit=CHAT_LIMIT, global_limit=GLOBAL_LIMIT)
+    api = FakeBotAPI(LATENCY, bot)
+    if queued:
+        # The fake limits edits as well as new messages, so pace both
+        api = OutboundQueue(api, global_rate=GLOBAL_LIMIT * 0.9, chat_rate=1.0, chat_burst=CHAT_LIMIT,
+                            limited_methods=QUEUED_METHODS)
+    start = time.perf_counter()
+    message_ids = await asyncio.gather(*(tapper(api, chat_id, taps, tap_interval) for chat_id in range(1, chats + 1)))
+    await api.close()
+    # Let fire-and-forget edits on the direct path settle
+    await asyncio.sleep(LATENCY * 2)
+    elapsed = time.perf_counter() - start
+    results = sum(bot.messages.get((chat_id, message_id), {}).get('text') == 'result'
+                  for chat_id, message_id in zip(range(1, chats + 1), message_ids))
+    return {
+        'requested': chats * (taps + 2),
+        'sent': sum(method in ('sendMessage', 'editMessageText') for method, _ in bot.calls),
+        'flood_errors': bot.flood_errors,
+        'results_shown': results,
+        'elapsed': elapsed,
+    }
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    taps = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    tap_interval = (float(sys.argv[3]) if len(sys.argv) > 3 else 200) / 1000
+    print(f"{chats} chats, {taps} taps each every {tap_interval * 1000:.0f} ms; fake limits: "
+          f"{CHAT_LIMIT}/s per chat, {GLOBAL_LIMIT}/s overall")
+    for name, queued in (('direct', False), ('outbound queue', True)):
+        report = asyncio.run(run(queued, chats, taps, tap_interval))
+        print(f"{name:15s} sent {report['sent']:5d} of {report['requested']} requested, "
+              f"{report['flood_errors']:5d} 429s, results shown {report['results_shown']}/{chats}, "
+              f"{report['elapsed']:.1f} s")
+    print(f"coalesced edits: {metrics.OUTBOUND_COALESCED._value.value:.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# benchmarks/question_lookup.py
+# Per-tap question lookup over a full 21-question Beck depression run:
+# rebuilding list(questions.items()) from a per-user dict (old show_question)
+# versus indexing the shared, preloaded bank through the Session.
+#
+#   python benchmarks/question_lookup.py [runs]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from question_bank import get_questions
+from session import Session
+
+TEST_NAME = 'beck_depression'
+
+
+def legacy_tap(user_data):
+    # Old bot.py handle_answer + show_question, minus the Telegram call
+    current_question_index = user_data['current_question']
+    user_data.setdefault('answers', {})[current_question_index] = '1'
+    user_data['current_question'] += 1
+    question_items = list(user_data['questions'].items())
+    if user_data['current_question'] < len(question_items):
+        return question_items[user_data['current_question']]
+
+
+def session_tap(user_data):
+    session = user_data['session']
+    session.record_answer(1)
+    questions = session.questions
+    if session.current_question < len(questions):
+        return questions[session.current_question]
+
+
+def run(tap, new_user_data, runs):
+    taps = 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        user_data = new_user_data()
+        for _ in range(len(get_questions(TEST_NAME))):
+            tap(user_data)
+            taps += 1
+    return (time.perf_counter() - start) / taps
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bank = {text: list(options) for text, options in get_questions(TEST_NAME)}
+    legacy = run(legacy_tap, lambda: {'questions': dict(bank), 'current_question': 0}, runs)
+    indexed = run(session_tap, lambda: {'session': Session(TEST_NAME)}, runs)
+    print(f"full {TEST_NAME} runs: {runs}")
+    print(f"list(questions.items()) per tap: {legacy * 1e9:,.0f} ns/tap")
+    print(f"indexed shared bank:             {indexed * 1e9:,.0f} ns/tap")
+    print(f"speedup: {legacy / indexed:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
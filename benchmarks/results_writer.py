@@ -0,0 +1,123 @@
+# benchmarks/results_writer.py
+# Completions per second when many handler threads finish tests at once:
+# opening results.csv in append mode per completion (old end_test) versus
+# enqueuing the row for the background ResultsWriter. Then a store that rejects
+# one row: the others must still be saved, the bad row set aside after
+# max_attempts, and flush() and close() must report it.
+#
+#   python benchmarks/results_writer.py [threads] [completions_per_thread]
+import csv
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from results_store import Completion, CsvResultsStore, ResultsStore, SqliteResultsStore
+from results_writer import ResultsWriter
+
+
+def make_completion(user_id, index):
+    answers = bytes([index % 4] * 21)
+    return Completion(user_id, 'beck_depression', '2023-11-29 12:04:36', answers, sum(answers),
+                      "есть симптомы серьезной депрессии.")
+
+
+def legacy_write(filename, c):
+    with open(filename, 'a', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow([c.user_id, c.test_name, c.timestamp] + list(c.answers) + [c.total_score, c.explanation])
+
+
+def run(threads, per_thread, complete):
+    def worker(user_id):
+        for index in range(per_thread):
+            complete(make_completion(user_id, index))
+
+    workers = [threading.Thread(target=worker, args=(user_id,)) for user_id in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def run_writer(store, threads, per_thread):
+    writer = ResultsWriter(store).start()
+    handler_time = run(threads, per_thread, writer.write)
+    start = time.perf_counter()
+    writer.close()
+    return handler_time, time.perf_counter() - start
+
+
+class RejectingStore(ResultsStore):
+    """Saves every batch unless it holds the rejected row."""
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+        self.rows = []
+
+    def add_many(self, rows):
+        if self.rejected in rows:
+            raise ValueError("rejected row")
+        self.rows.extend(rows)
+
+
+def rejected_row():
+    """Whether one row the store keeps rejecting is set aside without blocking the rest."""
+    bad = make_completion(0, 0)
+    good = [make_completion(user_id, 1) for user_id in range(1, 300)]
+    store = RejectingStore(bad)
+    writer = ResultsWriter(store, batch_size=50, flush_interval=0.01).start()
+    writer.write(bad)
+    for row in good[:150]:
+        writer.write(row)
+    first_flush = writer.flush(5.0)
+    for row in good[150:]:
+        writer.write(row)
+    # Rejected again just before closing, where it gets all its attempts at once
+    writer.write(bad)
+    closed = writer.close()
+    print(f"a rejected row, written twice: {len(store.rows)} of {len(good)} others saved, "
+          f"{writer.set_aside} set aside, flush() {first_flush}, close() {closed}")
+    return sorted(store.rows) == sorted(good) and writer.set_aside == 2 and not first_flush and not closed
+
+
+def count_rows(filename):
+    with open(filename, newline='', encoding='utf-8') as file:
+        # 21 answers plus user, test, timestamp, score and explanation, and the catalog version if written
+        return sum(1 for row in csv.reader(file) if len(row) in (26, 27))
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    total = threads * per_thread
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_file = os.path.join(directory, 'legacy.csv')
+        legacy = run(threads, per_thread, lambda row: legacy_write(legacy_file, row))
+
+        print(f"completions: {total} from {threads} threads")
+        print(f"open/append per completion:          {total / legacy:,.0f} completions/s ({count_rows(legacy_file)} rows)")
+
+        batched_file = os.path.join(directory, 'batched.csv')
+        handler_time, drain_time = run_writer(CsvResultsStore(batched_file), threads, per_thread)
+        print(f"ResultsWriter to CSV, handler side:  {total / handler_time:,.0f} completions/s")
+        print(f"ResultsWriter to CSV, with flush:    {total / (handler_time + drain_time):,.0f} completions/s "
+              f"({count_rows(batched_file)} rows)")
+
+        handler_time, drain_time = run_writer(SqliteResultsStore(os.path.join(directory, 'results.db')), threads, per_thread)
+        print(f"ResultsWriter to SQLite, with flush: {total / (handler_time + drain_time):,.0f} completions/s")
+
+    logging.disable(logging.ERROR)
+    if not rejected_row():
+        print("MISMATCH")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/session_expiry.py
+# Idle-session eviction with session_manager.SessionManager:
+# - cost of touch() and of a sweep that evicts nothing or everything, against
+#   scanning every user's last-active time
+# - async_bot.AsyncBot end to end: users start a test, some walk away midway, and a
+#   sweep past the TTL must evict exactly those, free their user_data and record
+#   one 'expired' abandonment each
+#
+#   python benchmarks/session_expiry.py [users]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from async_bot import AsyncBot
+from fake_telegram import FakeBotAPI, callback_update, command_update
+from keyboards import answer_callback_data
+from question_bank import get_questions
+from results_store import Abandonment, ResultsStore
+from results_writer import ResultsWriter
+from session import Session
+from session_manager import SessionManager
+
+TEST_NAME = 'beck_depression'
+TTL = 3600
+
+
+class MemoryStore(ResultsStore):
+    def __init__(self):
+        self.rows = []
+
+    def add_many(self, rows):
+        self.rows.extend(rows)
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def micro(users):
+    user_data = {user_id: {'session': Session(TEST_NAME)} for user_id in range(users)}
+    manager = SessionManager(user_data, TTL)
+    touch = timed(lambda: [manager.touch(user_id, now=user_id / users) for user_id in range(users)])
+    # A sweep every minute with nobody due
+    idle_sweep = timed(lambda: manager.expire(now=60))
+    # The alternative: remember last-active times and scan them all on every sweep
+    last_active = {user_id: user_id / users for user_id in range(users)}
+    scan = timed(lambda: [user_id for user_id, seen in last_active.items() if seen + TTL <= 60])
+    evict_all = timed(lambda: manager.expire(now=TTL + 2))
+    print(f"{users} sessions")
+    print(f"touch:                  {touch / users * 1e9:8.0f} ns/user")
+    print(f"sweep, none due:        {idle_sweep * 1e6:8.1f} us  (scanning all users: {scan * 1e6:.0f} us)")
+    print(f"sweep, all due:         {evict_all / users * 1e9:8.0f} ns/evicted session")
+    print(f"left in user_data:      {len(user_data)}")
+
+
+async def walk_away(bot, user_id, answered):
+    await bot.process_update(command_update(None, user_id, '/start'))
+    await bot.process_update(callback_update(None, user_id, TEST_NAME, 1))
+    message_id = bot.user_data[user_id]['session'].message_id
+    for index in range(answered):
+        await bot.process_update(callback_update(None, user_id, answer_callback_data(index, index % 4), message_id))
+
+
+async def end_to_end(users):
+    store = MemoryStore()
+    writer = ResultsWriter(store)
+    bot = AsyncBot(FakeBotAPI(0), writer, session_ttl=TTL)
+    questions = len(get_questions(TEST_NAME))
+    # Every third user finishes; the rest stop somewhere in the middle
+    answered = {1000 + i: questions if i % 3 == 0 else i % (questions - 1) for i in range(users)}
+    await asyncio.gather(*(walk_away(bot, user_id, count) for user_id, count in answered.items()))
+    live_before = bot.sessions.stats().live
+    bot.sessions.expire(now=time.monotonic() + TTL / 2)
+    early = bot.sessions.stats().evicted
+    bot.sessions.expire(now=time.monotonic() + TTL + 2)
+    writer.close()
+    abandoned = {row.user_id: row.answered for row in store.rows
+                 if isinstance(row, Abandonment) and row.reason == 'expired'}
+    expected = {user_id: count for user_id, count in answered.items() if count < questions}
+    print(f"{users} users, {len(expected)} walked away midway")
+    print(f"live before sweep: {live_before}, evicted before TTL: {early}, after: {bot.sessions.stats().evicted}")
+    print(f"user_data entries left: {len(bot.user_data)}, expired abandonments recorded: {len(abandoned)}")
+    return abandoned == expected and live_before == len(expected) and not early and not bot.user_data
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    micro(users)
+    print()
+    if not asyncio.run(end_to_end(min(users, 3000))):
+        print("MISMATCH")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
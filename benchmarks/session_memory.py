@@ -0,0 +1,67 @@
+# benchmarks/session_memory.py
+# Bytes per active session: private copy of the question bank in user_data
+# (the old bot.py layout) versus a Session referring to the shared bank.
+#
+#   python benchmarks/session_memory.py [sessions]
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from question_bank import TEST_FILES
+from session import Session
+
+ANSWERED = 10
+
+
+def legacy_load_test_questions(filename):
+    questions = {}
+    with open(filename, 'r', encoding='utf-8') as file:
+        for line in file:
+            parts = line.strip().split('\t')
+            questions[parts[0]] = parts[1:]
+    return questions
+
+
+def legacy_session(test_name, message_id):
+    return {
+        'questions': legacy_load_test_questions(TEST_FILES[test_name]),
+        'current_question': ANSWERED,
+        'test_name': test_name,
+        'answers': {index: str(index % 4) for index in range(ANSWERED)},
+        'question_message_id': message_id,
+    }
+
+
+def compact_session(test_name, message_id):
+    session = Session(test_name, message_id)
+    for index in range(ANSWERED):
+        session.record_answer(index % 4)
+    return {'session': session}
+
+
+def bytes_per_session(factory, count):
+    test_names = list(TEST_FILES)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = {user_id: factory(test_names[user_id % len(test_names)], 1000 + user_id) for user_id in range(count)}
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sessions
+    return (after - before) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    legacy = bytes_per_session(legacy_session, count)
+    compact = bytes_per_session(compact_session, count)
+    print(f"sessions: {count}")
+    print(f"legacy user_data (private question copy): {legacy:,.0f} bytes/session")
+    print(f"Session (shared bank):                    {compact:,.0f} bytes/session")
+    print(f"reduction: {legacy / compact:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
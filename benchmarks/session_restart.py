@@ -0,0 +1,122 @@
+# benchmarks/session_restart.py
+# Tests in progress survive a restart with persistence.SqliteSessionPersistence:
+# - round trip: user_data and conversation states written by one instance are what
+#   a fresh one on the same file loads
+# - end to end, for bot.py and for async_bot.py (which uses the same sessions.db through
+#   session_database.SessionDatabase): the bot runs against the fake Bot API server, a
+#   user answers part of a test, the bot is killed (SIGKILL, after one flush interval)
+#   and started again on the same working directory, and the user finishes the test on
+#   the same message. The saved result must have every answer.
+#
+#   python benchmarks/session_restart.py [answered_before_kill]
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_telegram import FakeBot, FakeTelegramServer, callback_update, command_update, launch_bot
+from loadgen import LoadGenerator, wait_until_ready
+from persistence import SqliteSessionPersistence
+from question_bank import get_questions
+from session import Session
+
+TEST_NAME = 'beck_depression'
+USER_ID = 42
+FLUSH_INTERVAL = 1.0  # SessionDatabase's default, in both bots
+
+
+def round_trip(directory):
+    path = os.path.join(directory, 'sessions.db')
+    session = Session(TEST_NAME, message_id=7)
+    for option in (1, 0, 3):
+        session.record_answer(option)
+    persistence = SqliteSessionPersistence(path)
+    persistence.update_user_data(USER_ID, {'session': session})
+    persistence.update_user_data(USER_ID + 1, {})
+    persistence.update_conversation('tests', (USER_ID, USER_ID), 1)
+    persistence.flush()
+
+    loaded = SqliteSessionPersistence(path)
+    restored = loaded.get_user_data()[USER_ID]['session']
+    return (restored.test_name == session.test_name and restored.current_question == session.current_question
+            and restored.answers == session.answers and restored.message_id == session.message_id
+            and restored.catalog.version == session.catalog.version
+            and USER_ID + 1 not in loaded.get_user_data()
+            and loaded.get_conversations('tests') == {(USER_ID, USER_ID): 1})
+
+
+async def answer(generator, message, option):
+    button = message['reply_markup']['inline_keyboard'][option][0]
+    return await generator.request(USER_ID, callback_update(None, USER_ID, button['callback_data'],
+                                                            message['message_id']))
+
+
+async def restart_mid_test(directory, answered_before_kill, script):
+    bot = FakeBot(seed=1)
+    server = FakeTelegramServer(bot).start()
+    generator = LoadGenerator(bot, timeout=10.0)
+    generator._loop = asyncio.get_running_loop()
+    questions = len(get_questions(TEST_NAME))
+    answers = [index % 4 for index in range(questions)]
+    process = launch_bot(server, script, workdir=directory)
+    try:
+        if not await wait_until_ready(generator, 30):
+            raise SystemExit(f"{script} did not answer /start against the fake API")
+        menu = await generator.request(USER_ID, command_update(None, USER_ID, '/start'))
+        question = await generator.request(USER_ID, callback_update(None, USER_ID, TEST_NAME, menu['message_id']))
+        for option in answers[:answered_before_kill]:
+            question = await answer(generator, question, option)
+        # Sessions are written in batches once per flush interval; a kill before that loses the last taps
+        await asyncio.sleep(FLUSH_INTERVAL * 1.5)
+        process.kill()
+        process.wait()
+        print(f"killed {script} after {answered_before_kill} of {questions} answers")
+
+        process = launch_bot(server, script, workdir=directory)
+        if not await wait_until_ready(generator, 30):
+            raise SystemExit(f"{script} did not come back after the restart")
+        start = time.perf_counter()
+        for option in answers[answered_before_kill:]:
+            question = await answer(generator, question, option)
+            if question is None:
+                break
+        elapsed = time.perf_counter() - start
+    finally:
+        process.stop()
+        server.stop()
+
+    finished = question is not None and 'reply_markup' not in question
+    print(f"after the restart: {'finished' if finished else 'NOT finished'} in {elapsed:.2f} s, "
+          f"result message: {question['text'].splitlines()[0] if question else None!r}")
+    with sqlite3.connect(os.path.join(directory, 'results.db')) as conn:
+        rows = conn.execute('SELECT answers, total_score FROM completions WHERE user_id = ? AND test_name = ?',
+                            (USER_ID, TEST_NAME)).fetchall()
+    print(f"saved results for the user: {len(rows)}")
+    return finished and rows == [(bytes(answers), sum(answers))]
+
+
+def main():
+    answered_before_kill = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    logging.disable(logging.INFO)
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        passed = round_trip(directory)
+        ok = ok and passed
+        print(f"user_data and conversation round trip: {'ok' if passed else 'FAILED'}")
+    for script in ('bot.py', 'async_bot.py'):
+        with tempfile.TemporaryDirectory() as directory:
+            passed = asyncio.run(restart_mid_test(directory, answered_before_kill, script))
+            ok = ok and passed
+            print(f"{script}: test resumed after a restart and saved complete: {'ok' if passed else 'FAILED'}")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
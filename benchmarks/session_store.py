@@ -0,0 +1,85 @@
+# benchmarks/session_store.py
+# The session stores under contention from several "replicas" (threads with their own
+# store connection) answering questions for the same users: each answer is a
+# load -> record_answer -> save round, retried from a fresh load when the save loses
+# the version race. With optimistic versioning no answer may be lost or doubled, so
+# every user must end with exactly the answers that were sent. Also reports the time
+# per load + save round for each backend.
+#
+#   python benchmarks/session_store.py [users] [answers_per_user] [replicas]
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_redis import FakeRedisServer
+from session import Session
+from session_store import MemorySessionStore, open_session_store
+
+TEST_NAME = 'ptsd'
+SHOW_QUESTION = 1
+
+
+def replica(store, users, answers, conflicts):
+    for index in range(answers):
+        for user_id in users:
+            while True:
+                record = store.load(user_id)
+                session = record.session or Session(TEST_NAME, message_id=user_id)
+                session.record_answer(index % 5)
+                if store.save(user_id, SHOW_QUESTION, session, record.version):
+                    break
+                conflicts.append(user_id)
+
+
+def run(open_store, users, answers, replicas):
+    stores = [open_store() for _ in range(replicas)]
+    conflicts = []
+    user_ids = list(range(1, users + 1))
+    # Every replica works through the same users, so saves for a user race constantly
+    threads = [threading.Thread(target=replica, args=(store, user_ids, answers, conflicts)) for store in stores]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    expected = bytes(index % 5 for index in range(answers) for _ in range(replicas))
+    correct = all(sorted(stores[0].load(user_id).session.answers) == sorted(expected) for user_id in user_ids)
+    rounds = users * answers * replicas + len(conflicts)
+    for store in stores:
+        store.close()
+    return elapsed / rounds, len(conflicts), correct
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    answers = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    replicas = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    print(f"{replicas} replicas x {users} users x {answers} answers each")
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        redis = FakeRedisServer().start()
+        memory = MemorySessionStore()
+        backends = {
+            # One shared object stands in for replicas sharing a process's store
+            'memory': lambda: memory,
+            'sqlite': lambda: open_session_store(f"sqlite:///{os.path.join(directory, 'sessions.db')}"),
+            'redis (fake_redis)': lambda: open_session_store(redis.url),
+        }
+        for name, open_store in backends.items():
+            per_round, conflicts, correct = run(open_store, users, answers, replicas)
+            ok = ok and correct
+            print(f"{name:20s} {per_round * 1e6:8.1f} us per load+save, {conflicts:6d} lost races retried, "
+                  f"answers {'ok' if correct else 'LOST OR DOUBLED'}")
+        redis.stop()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# benchmarks/sharding.py
+# Updates per second through sharding.ShardedBot with 1..N worker processes. Every
+# simulated user runs /start, picks the test and answers every question; all updates
+# are routed up front, as from a backlog of getUpdates batches. Workers talk to an
+# in-process Bot API stand-in, so the numbers are handler and routing CPU time.
+# Afterwards every user must have exactly one completion with their answers in the
+# shared SQLite results store.
+#
+#   python benchmarks/sharding.py [users] [max_workers]
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bot_api import BotAPIMethods
+from fake_telegram import callback_update, command_update
+from keyboards import answer_callback_data
+from question_bank import get_questions
+from sharding import ShardedBot
+
+TEST_NAME = 'beck_depression'
+BATCH_SIZE = 100  # getUpdates' default limit
+
+
+class EchoAPI(BotAPIMethods):
+    """Answers instantly; a chat's question message always gets the chat id as message_id."""
+
+    async def call(self, method, **params):
+        if method == 'sendMessage':
+            return {'message_id': params['chat_id'], 'chat': {'id': params['chat_id']}, 'text': params['text']}
+        return True
+
+    async def close(self):
+        pass
+
+
+def user_answers(user_id, questions):
+    return [(user_id + index) % len(question.options) for index, question in enumerate(questions)]
+
+
+def make_updates(users):
+    questions = get_questions(TEST_NAME)
+    per_user = []
+    for user_id in range(1, users + 1):
+        updates = [command_update(None, user_id, '/start'), callback_update(None, user_id, TEST_NAME, 1)]
+        updates += [callback_update(None, user_id, answer_callback_data(index, option), user_id)
+                    for index, option in enumerate(user_answers(user_id, questions))]
+        per_user.append(updates)
+    # Interleave users as they would arrive
+    updates = [update for step in zip(*per_user) for update in step]
+    for update_id, update in enumerate(updates, 1):
+        update['update_id'] = update_id
+    return updates
+
+
+def check_results(results_db, users):
+    questions = get_questions(TEST_NAME)
+    with sqlite3.connect(results_db) as conn:
+        rows = conn.execute('SELECT user_id, answers FROM completions').fetchall()
+    answers = {user_id: list(stored) for user_id, stored in rows}
+    return len(rows) == users and all(answers.get(user_id) == user_answers(user_id, questions)
+                                      for user_id in range(1, users + 1))
+
+
+def run(workers, updates, users):
+    with tempfile.TemporaryDirectory() as directory:
+        results_db = os.path.join(directory, 'results.db')
+        sharded = ShardedBot(workers, EchoAPI, results_db).start()
+        start = time.perf_counter()
+        for offset in range(0, len(updates), BATCH_SIZE):
+            sharded.route(updates[offset:offset + BATCH_SIZE])
+        sharded.stop()
+        elapsed = time.perf_counter() - start
+        return len(updates) / elapsed, check_results(results_db, users)
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else min(os.cpu_count() or 1, 8)
+    updates = make_updates(users)
+    print(f"{users} users, {len(updates)} updates, {os.cpu_count()} CPUs")
+    baseline = None
+    ok = True
+    workers = 1
+    while workers <= max_workers:
+        rate, correct = run(workers, updates, users)
+        baseline = baseline or rate
+        ok = ok and correct
+        print(f"{workers} workers: {rate:9,.0f} updates/s  ({rate / baseline:.2f}x)  results "
+              f"{'ok' if correct else 'MISMATCH'}")
+        workers *= 2
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
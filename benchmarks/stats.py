@@ -0,0 +1,164 @@
+# benchmarks/stats.py
+# stats.ResultStatistics against results stores of growing size:
+# - rebuild: folding every completion from scratch, which grows with the history
+# - restart: loading the checkpoint and reading the completions written after it
+# - update: refresh() after one more batch, as the results writer calls it
+# - query: the /stats report
+# - percentile: the line end_test adds, against sorting the test's scores on each request
+# Everything but the rebuild and the sort should stay flat. Aggregates built in two halves
+# through a checkpoint, and from the CSV store, must match the rebuild, and percentiles
+# must match the sorted scores'. Per-day counts keep only the last PER_DAY_LIMIT days,
+# with the older ones still counted in the total.
+#
+#   python benchmarks/stats.py [max_rows]
+import os
+import random
+import sys
+import tempfile
+import time
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalog import current_catalog
+from results_store import Completion, CsvResultsStore, SqliteResultsStore
+from scoring import explain_score
+from stats import PER_DAY_LIMIT, ResultStatistics, TestStats
+
+BATCH = 100
+TEST_NAME = 'beck_depression'
+
+
+def make_completions(rows, seed=1):
+    rng = random.Random(seed)
+    instruments = current_catalog().instruments
+    tests = sorted(instruments)
+    completions = []
+    for index in range(rows):
+        test_name = rng.choice(tests)
+        instrument = instruments[test_name]
+        answers = bytes(rng.randint(0, instrument.max_item_score - instrument.min_item_score)
+                        for _ in range(instrument.items))
+        day, second = divmod(index * 60, 86400)
+        timestamp = f'2023-{1 + day // 28 % 12:02d}-{1 + day % 28:02d} {second // 3600:02d}:{second // 60 % 60:02d}:00'
+        completions.append(Completion(rng.randrange(1000), test_name, timestamp, answers, sum(answers),
+                                      explain_score(test_name, answers, instruments), 'v1'))
+    return completions
+
+
+def snapshot(statistics):
+    return {test_name: stats.to_json() for test_name, stats in statistics.tests.items()}
+
+
+def refreshed(statistics):
+    statistics.refresh()
+    return statistics
+
+
+def bounded_days(days=3 * PER_DAY_LIMIT):
+    # Three years of completions, a few a day, plus a late one from the first day
+    stats = TestStats()
+    start = date(2021, 1, 1)
+    timestamps = [f'{date.fromordinal(start.toordinal() + day).isoformat()} 12:00:00'
+                  for day in range(days) for _ in range(day % 3 + 1)]
+    for timestamp in timestamps + timestamps[:1]:
+        stats.add(Completion(1, TEST_NAME, timestamp, b'', 0, ''))
+    restored = TestStats.from_json(stats.to_json())
+    return (len(stats.per_day) == PER_DAY_LIMIT and stats.completions == len(timestamps) + 1
+            and sum(stats.per_day.values()) + stats.earlier_days == stats.completions
+            and min(stats.per_day) == date.fromordinal(start.toordinal() + days - PER_DAY_LIMIT).isoformat()
+            and restored.to_json() == stats.to_json())
+
+
+def sorted_percentile(scores, score):
+    ordered = sorted(scores)
+    below, upto = bisect_left(ordered, score), bisect_right(ordered, score)
+    return 100.0 * (below + (upto - below) / 2) / len(ordered)
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def run(rows, directory):
+    completions = make_completions(rows + BATCH)
+    history, batch = completions[:rows], completions[rows:]
+    store = SqliteResultsStore(os.path.join(directory, f'{rows}.db'))
+    csv_store = CsvResultsStore(os.path.join(directory, f'{rows}.csv'), fsync=False)
+    for offset in range(0, rows, 10000):
+        store.add_many(history[offset:offset + 10000])
+        csv_store.add_many(history[offset:offset + 10000])
+    checkpoint = os.path.join(directory, f'{rows}.json')
+
+    # Half the history before the checkpoint, half after it
+    first = ResultStatistics(SqliteResultsStore(os.path.join(directory, f'{rows}-half.db')), checkpoint)
+    first.store.add_many(history[:rows // 2])
+    first.refresh()
+    first.save_checkpoint()
+    first.store.add_many(history[rows // 2:])
+    restart, restarted = timed(lambda: refreshed(ResultStatistics(first.store, checkpoint)))
+    rebuild, full = timed(lambda: refreshed(ResultStatistics(store, None)))
+    correct = snapshot(restarted) == snapshot(full)
+    correct = correct and snapshot(refreshed(ResultStatistics(csv_store, None))) == snapshot(full)
+
+    # A checkpoint taken at the end of the history, then one more batch from the writer
+    full.checkpoint = checkpoint
+    full.save_checkpoint()
+    restart_end, _ = timed(lambda: refreshed(ResultStatistics(store, checkpoint)))
+    store.add_many(batch)
+    update, added = timed(full.refresh)
+    correct = correct and added == len(batch) and sum(stats.completions for stats in full.tests.values()) == rows + BATCH
+    # The week up to the last completion, since the generated history isn't recent
+    query, report = timed(lambda: full.report(today=date.fromisoformat(batch[-1].timestamp[:10])))
+
+    scores = [completion.total_score for completion in history + batch if completion.test_name == TEST_NAME]
+    stats = full.tests[TEST_NAME]
+    correct = correct and all(abs(stats.percentile(score) - sorted_percentile(scores, score)) < 1e-9
+                              for score in range(min(scores) - 1, max(scores) + 2))
+    percentile = best_of(lambda: full.percentile_text(TEST_NAME, 32), 1000)
+    sort = best_of(lambda: sorted_percentile(scores, 32), 5)
+    store.close()
+    csv_store.close()
+    first.store.close()
+    return (rebuild, restart, restart_end, update, query, percentile, sort, correct, report)
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{'rows':>8s} {'rebuild':>12s} {'restart':>12s} {'restart@end':>12s} "
+          f"{f'+{BATCH} rows':>12s} {'query':>12s} {'percentile':>12s} {'sort':>12s}")
+    ok = True
+    rows = 1000
+    with tempfile.TemporaryDirectory() as directory:
+        while rows <= max_rows:
+            rebuild, restart, restart_end, update, query, percentile, sort, correct, report = run(rows, directory)
+            ok = ok and correct
+            print(f"{rows:8d} {rebuild * 1e3:9.1f} ms {restart * 1e3:9.1f} ms {restart_end * 1e3:9.2f} ms "
+                  f"{update * 1e3:9.2f} ms {query * 1e3:9.2f} ms {percentile * 1e6:9.2f} us {sort * 1e3:9.2f} ms  "
+                  f"{'ok' if correct else 'MISMATCH'}")
+            rows *= 10
+    print("(restart reads the half written after the checkpoint; restart@end reads nothing new)")
+    bounded = bounded_days()
+    ok = ok and bounded
+    print(f"per-day counts bounded to {PER_DAY_LIMIT} days: {'ok' if bounded else 'FAILED'}")
+    print()
+    print(report)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# benchmarks/suite.py
+# Benchmark suite for the handler hot paths and the scoring functions, with
+# stable JSON output that can be compared across commits:
+#
+#   python benchmarks/suite.py --output before.json
+#   ... change things ...
+#   python benchmarks/suite.py --output after.json --compare before.json
+#
+# Handlers are driven with stand-in Update/CallbackContext objects, so no network
+# or token is needed; they still need python-telegram-bot installed to import bot.py.
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scoring
+from flow import TestFlow
+from question_bank import TEST_FILES, compile_banks, get_questions, load_test_questions, parse_all_banks, \
+    read_compiled_banks
+from results_store import Completion, CsvResultsStore, SqliteResultsStore
+from results_writer import ResultsWriter
+from session import Session
+from stats import follow_results
+
+# Slower than this ratio against the baseline counts as a regression
+REGRESSION_THRESHOLD = 1.25
+
+PCL5_RESPONSES = [2, 1, 3, 4, 0, 4, 4, 3, 3, 3, 2, 4, 1, 4, 4, 0, 3, 3, 2, 1]
+BECK_RESPONSES = bytearray([2] * 20 + [1])
+K10_RESPONSES = bytearray([1, 2, 0, 3, 1, 2, 4, 1, 0, 2])
+
+
+def measure(func, number=None, repeat=5):
+    """Best-of-`repeat` nanoseconds per call."""
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def scoring_cases():
+    return {
+        'scoring.score_becks_depression': lambda: scoring.score_becks_depression(25),
+        'scoring.score_becks_anxiety': lambda: scoring.score_becks_anxiety(25),
+        'scoring.score_social_phobia': lambda: scoring.score_social_phobia(25),
+        'scoring.calculate_pcl5_cluster_scores': lambda: scoring.calculate_pcl5_cluster_scores(PCL5_RESPONSES),
+        'scoring.make_provisional_diagnosis': lambda: scoring.make_provisional_diagnosis(PCL5_RESPONSES),
+        'scoring.score_pcl5': lambda: scoring.score_pcl5(PCL5_RESPONSES),
+        'scoring.explain_score': lambda: scoring.explain_score('beck_depression', BECK_RESPONSES),
+        'scoring.explain_score_ptsd': lambda: scoring.explain_score('ptsd', PCL5_RESPONSES),
+        'scoring.explain_score_k10': lambda: scoring.explain_score('k10', K10_RESPONSES),
+    }
+
+
+def storage_cases(directory):
+    completions = [Completion(759407451, 'beck_depression', '2023-11-29 12:04:36', bytes(BECK_RESPONSES),
+                              sum(BECK_RESPONSES), scoring.score_becks_depression(sum(BECK_RESPONSES)))] * 100
+    csv_store = CsvResultsStore(os.path.join(directory, 'results.csv'), fsync=False)
+    sqlite_store = SqliteResultsStore(os.path.join(directory, 'results.db'))
+    banks_file = os.path.join(directory, 'question_banks.bin')
+    with open(banks_file, 'wb') as file:
+        file.write(compile_banks(parse_all_banks()))
+    return {
+        'question_bank.load_test_questions': lambda: load_test_questions(TEST_FILES['beck_depression']),
+        'question_bank.parse_all_banks': parse_all_banks,
+        'question_bank.read_compiled_banks': lambda: read_compiled_banks(banks_file),
+        'results_store.csv_add_100': lambda: csv_store.add_many(completions),
+        'results_store.sqlite_add_100': lambda: sqlite_store.add_many(completions),
+    }
+
+
+def _noop(*args, **kwargs):
+    return None
+
+
+def make_update(user_id=759407451, data=None):
+    # Lightweight stand-ins: unittest.mock objects would cost more than the handlers themselves
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id),
+        callback_query=SimpleNamespace(data=data, answer=_noop, edit_message_text=_noop,
+                                       message=SimpleNamespace(message_id=42)),
+        message=SimpleNamespace(reply_text=_noop),
+    )
+
+
+SENT_MESSAGE = SimpleNamespace(message_id=42)
+BOT_DATA = {}  # Dispatcher.bot_data, shared by every context
+
+
+def make_context(user_data):
+    bot = SimpleNamespace(send_message=lambda **kwargs: SENT_MESSAGE, edit_message_text=_noop, delete_message=_noop)
+    return SimpleNamespace(user_data=user_data, bot=bot, bot_data=BOT_DATA)
+
+
+def handler_cases(directory):
+    import bot
+
+    results_writer = ResultsWriter(CsvResultsStore(os.path.join(directory, 'bot_results.csv'), fsync=False))
+    # end_test ranks each result against the ones written before it, as in bot.main()
+    BOT_DATA['flow'] = TestFlow(results_writer, follow_results(results_writer, None))
+    questions = get_questions('beck_depression')
+    # Answers question 10, where mid_test_context leaves off
+    update = make_update(data='10.2')
+
+    def mid_test_context():
+        session = Session('beck_depression', 42)
+        for _ in range(10):
+            session.record_answer(2)
+        return make_context({'session': session})
+
+    def finished_context():
+        session = Session('beck_depression', 42)
+        for _ in range(len(questions)):
+            session.record_answer(2)
+        return make_context({'session': session})
+
+    def show_question():
+        bot.show_question(update, mid_test_context())
+
+    def handle_answer():
+        bot.handle_answer(update, mid_test_context())
+
+    def end_test():
+        bot.end_test(update, finished_context())
+        # Keep the writer's queue from growing across iterations
+        results_writer.flush()
+
+    return {
+        'bot.context_setup': lambda: mid_test_context(),
+        'bot.show_question': show_question,
+        'bot.handle_answer': handle_answer,
+        'bot.end_test': end_test,
+    }
+
+
+def bytes_per(factory, count=2000):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory(index) for index in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return round((after - before) / count)
+
+
+def memory_section():
+    def session_user_data(answered):
+        def factory(index):
+            session = Session('beck_depression', index)
+            for _ in range(answered):
+                session.record_answer(index % 4)
+            return {'session': session}
+        return factory
+
+    return {
+        'user_data_bytes.new_test': bytes_per(session_user_data(0)),
+        'user_data_bytes.mid_test': bytes_per(session_user_data(10)),
+        'user_data_bytes.last_question': bytes_per(session_user_data(len(get_questions('beck_depression')) - 1)),
+    }
+
+
+def run_suite():
+    results = {}
+    skipped = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cases = {**scoring_cases(), **storage_cases(directory)}
+        try:
+            cases.update(handler_cases(directory))
+        except ImportError as e:
+            skipped['bot'] = f"bot.py not importable: {e}"
+        for name, func in sorted(cases.items()):
+            results[name] = round(measure(func), 1)
+    return {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'timings_ns_per_op': results,
+        'memory': memory_section(),
+        'skipped': skipped,
+    }
+
+
+def compare(report, baseline):
+    """Prints per-benchmark ratios against a baseline report; returns the names that regressed."""
+    regressions = []
+    sections = (('timings_ns_per_op', 'ns'), ('memory', 'bytes'))
+    for section, unit in sections:
+        for name, value in sorted(report[section].items()):
+            old = baseline.get(section, {}).get(name)
+            if not old:
+                print(f"{name:45s} {value:>12,.1f} {unit}   (new)")
+                continue
+            ratio = value / old
+            flag = '  REGRESSION' if ratio > REGRESSION_THRESHOLD else ''
+            if flag:
+                regressions.append(name)
+            print(f"{name:45s} {value:>12,.1f} {unit}   {ratio:5.2f}x vs {old:,.1f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the psy_bot benchmark suite.")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--compare', help="baseline JSON report to compare against")
+    args = parser.parse_args()
+
+    report = run_suite()
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file))
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {REGRESSION_THRESHOLD}x: {', '.join(regressions)}")
+            sys.exit(1)
+    elif not args.output:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 import logging
-import csv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, CallbackContext, ConversationHandler, CallbackQueryHandler
 import datetime
+from results_writer import ResultsWriter
+from results_store import Completion, CsvResultsStore
+from scoring import score_becks_depression
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -14,10 +16,11 @@ SELECTING_QUESTIONS = 1
 # Constants for this example
 QUESTIONS_FILE = "questions.tsv"
 RESULTS_FILE = "results.csv"
+results_writer = ResultsWriter(CsvResultsStore(RESULTS_FILE))
 QUESTIONS_PER_TEST = 21
 
-# A dictionary containing the questions and options read from the questions.tsv file
-questions = {}
+# A list of (question, options) pairs read from the questions.tsv file, indexed by question number - 1
+questions = []
 
 
 def read_questions_from_file():
@@ -29,7 +32,7 @@ def read_questions_from_file():
                 if len(data) == 5:
                     question = data[0]
                     options = data[1:]
-                    questions[question] = options
+                    questions.append((question, options))
     except FileNotFoundError:
         raise Exception(f"Failed to read questions from the file '{QUESTIONS_FILE}'. Make sure it exists.")
     return questions
@@ -94,8 +97,7 @@ def start_exam(update: Update, _: CallbackContext):
         # Clear ongoing test data to start a new one
         user_data.clear()
 
-    # Start a new test
-    read_questions_from_file()
+    # Start a new test (questions are loaded once in main)
     user_data['current_question'] = 1  # Start from the first question
     user_data['answers'] = {}  # Initialize or reset answers dictionary
 
@@ -117,8 +119,7 @@ def send_question(update: Update, _: CallbackContext):
         show_results(update, _)
         return SELECTING_QUESTIONS
 
-    question = list(questions.keys())[current_question_number - 1]
-    options = questions[question]
+    question, options = questions[current_question_number - 1]
 
     keyboard = []
     for idx, option in enumerate(options):
@@ -172,30 +173,12 @@ def show_results(update: Update, _: CallbackContext):
     answers = user_data.get('answers', {})
     total_score = sum(answers.values())
 
-    result = ""
-    if total_score <= 10:
-        result = "отсутствуют или не выражены симптомы депрессии."
-    elif 11 <= total_score <= 16:
-        result = "имеются нарушения настроения."
-    elif 17 <= total_score <= 20:
-        result = "есть симптомы на границе клинической депрессии."
-    elif 21 <= total_score <= 30:
-        result = "есть симптомы которые свидетельствуют или могут привести к умеренной депрессии."
-    elif 31 <= total_score <= 40:
-        result = "имеются серьезные нарушения настроения либо выраженная депрессия."
-    else:
-        result = "есть симптомы серьезной депрессии."
+    result = score_becks_depression(total_score)
 
     # Save results in CSV file
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(RESULTS_FILE, 'a', newline='') as csvfile:
-        fieldnames = ['user_id', 'timestamp', 'result', 'answers']  # Add 'answers' to the header
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        # Convert answers dictionary to a comma-separated string
-        answers_str = ",".join([str(answers[q]) for q in sorted(answers.keys())])
-
-        writer.writerow({'user_id': user_id, 'timestamp': timestamp, 'result': total_score, 'answers': answers_str})
+    answers_bytes = bytes(answers[q] for q in sorted(answers.keys()))
+    results_writer.write(Completion(user_id, 'beck_depression', timestamp, answers_bytes, total_score, result))
 
     # Compose the message with the test results
     message = (
@@ -222,6 +205,9 @@ def main():
     with open("token.txt", "r") as file:
         token = file.read().strip()
 
+    # Load the question bank once for all users
+    read_questions_from_file()
+
     updater = Updater(token, use_context=True)
 
     # Get the dispatcher to register handlers
@@ -247,10 +233,14 @@ def main():
     dp.add_handler(conversation_handler)
 
     # Start the Bot
+    results_writer.start()
     updater.start_polling()
 
     # Run the bot until the user presses Ctrl-C or the process receives SIGINT, SIGTERM, or SIGABRT
     updater.idle()
 
+    # Flush any queued results before exiting
+    results_writer.close()
+
 if __name__ == '__main__':
     main()
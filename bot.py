@@ -1,211 +1,370 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackContext, ConversationHandler, CallbackQueryHandler
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import Updater, CommandHandler, CallbackContext, ConversationHandler, CallbackQueryHandler, TypeHandler, DispatcherHandlerStop
+from telegram.utils.request import Request
 import logging
-import csv
-from datetime import datetime
-from scoring import score_becks_depression, score_becks_anxiety, score_pcl5, make_provisional_diagnosis, score_social_phobia
+import secrets
+import signal
+import threading
+import time
+import config
+import metrics
+from catalog import CATALOGS
+from flow import CANCEL_TEXT, MENU_TEXT, SHOW_QUESTION, STALE_TAP_TEXT, TestFlow
+from session_manager import SessionManager, record_abandonment
+from session_store import open_session_store
+from stats import checkpoint_path, follow_results
+from keyboards import MENU_KEYBOARD, MENU_PATTERN
+from results_writer import ResultsWriter
+from results_store import open_results_store
+from persistence import SqliteSessionPersistence
+from webhook import WebhookServer, require_webhook_url
+from outbound import QUEUED_METHODS, OutboundThread
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+# The job queue would log every session sweep
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
-# Define conversation states
-SELECTING_TEST, SHOW_QUESTION = range(2)
+class TimedRequest(Request):
+    """Records the duration and failures of every Bot API call in the metrics registry."""
 
-def start(update: Update, context: CallbackContext) -> int:
-    # Send message with four inline buttons for the tests
-    keyboard = [
-        [InlineKeyboardButton("тест депрессии Бека", callback_data='beck_depression')],
-        [InlineKeyboardButton("тест тревожности Бека", callback_data='beck_anxiety')],
-        [InlineKeyboardButton("тест ПТСР", callback_data='ptsd')],
-        [InlineKeyboardButton("тест социальных фобий", callback_data='social_phobia')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    # Ensure that the message is always sent as a new message to keep the menu visible
-    update.message.reply_text('Выберите тест:', reply_markup=reply_markup)
-    # Clear any existing conversation data to reset the state
-    context.user_data.clear()
-    return SELECTING_TEST
-
-def send_menu(update: Update, context: CallbackContext):
-    keyboard = [
-        [InlineKeyboardButton("тест депрессии Бека", callback_data='beck_depression')],
-        [InlineKeyboardButton("тест тревожности Бека", callback_data='beck_anxiety')],
-        [InlineKeyboardButton("тест ПТСР", callback_data='ptsd')],
-        [InlineKeyboardButton("тест социальных фобий", callback_data='social_phobia')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(chat_id=update.effective_chat.id, text='Выберите тест:', reply_markup=reply_markup)    
-
-def delete_previous_questions(update: Update, context: CallbackContext):
-    """Deletes previously sent test questions."""
-    chat_id = update.effective_chat.id
-    question_message_id = context.user_data.get('question_message_id')
-
-    if question_message_id:
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
         try:
-            context.bot.delete_message(chat_id=chat_id, message_id=question_message_id)
-        except Exception as e:
-            logger.error(f"Error deleting message: {e}")
-        context.user_data.pop('question_message_id', None)
+            return super().post(url, data, timeout)
+        except TelegramError:
+            metrics.API_ERRORS.labels(method).inc()
+            raise
+        finally:
+            metrics.API_CALL_SECONDS.labels(method).observe(time.perf_counter() - start)
+
+class QueuedRequest(TimedRequest):
+    """Sends messages and edits through the rate-limited outbound queue; other calls go straight out.
+
+    PTB raises RetryAfter for 429s, which the queue retries after its retry_after.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._base_url = None
+        self.outbound = OutboundThread(self._send, global_rate=config.OUTBOUND_GLOBAL_RATE,
+                                       chat_rate=config.OUTBOUND_CHAT_RATE, chat_burst=config.OUTBOUND_CHAT_BURST)
+
+    def post(self, url, data, timeout=None):
+        base_url, method = url.rsplit('/', 1)
+        if method not in QUEUED_METHODS:
+            return super().post(url, data, timeout)
+        self._base_url = base_url
+        return self.outbound.call(method, **data)
+
+    def _send(self, method, params):
+        return super().post(f'{self._base_url}/{method}', params)
+
+class SharedSessions:
+    """Keeps nothing between updates, so any replica can take a user's next update.
+
+    load() runs before the conversation handler and puts the user's stored session and
+    conversation state in place; save() runs after it and writes them back, unless
+    another replica saved the user in between, in which case this update's changes
+    are dropped and the other replica's stand.
+    """
+
+    def __init__(self, store, conversation_handler, results_writer):
+        self.store = store
+        self.results_writer = results_writer
+        self.conversations = conversation_handler.conversations
+        self._versions = {}  # user_id -> version loaded for the update being handled
+
+    @staticmethod
+    def _key(update: Update):
+        # The ConversationHandler's key with its default per_chat and per_user
+        if update.effective_user is None or update.effective_chat is None:
+            return None
+        return update.effective_chat.id, update.effective_user.id
+
+    def load(self, update: Update, context: CallbackContext):
+        key = self._key(update)
+        if key is None:
+            return
+        record = self.store.load(key[1])
+        self._versions[key[1]] = record.version
+        context.user_data.clear()
+        if record.session is not None:
+            context.user_data['session'] = record.session
+        if record.state is None:
+            self.conversations.pop(key, None)
+        else:
+            self.conversations[key] = record.state
+
+    def save(self, update: Update, context: CallbackContext):
+        key = self._key(update)
+        if key is None:
+            return
+        user_id = key[1]
+        state = self.conversations.pop(key, None)
+        session = context.user_data.get('session')
+        context.dispatcher.user_data.pop(user_id, None)
+        if not self.store.save(user_id, state, session, self._versions.pop(user_id)):
+            metrics.SESSION_CONFLICTS.inc()
+            logger.warning(f"User {user_id} was saved by another replica during update {update.update_id}; "
+                           f"dropping this update's changes")
+
+    def record_expired(self, user_id, record):
+        if record.session is not None:
+            metrics.SESSIONS_EVICTED.inc()
+            record_abandonment(self.results_writer, user_id, record.session, 'expired')
+
+def track_session(update: Update, context: CallbackContext):
+    """Runs after the conversation handlers, restarting the user's idle clock."""
+    if update.effective_user:
+        context.bot_data['sessions'].touch(update.effective_user.id)
+
+class ExpirySweep(Update):
+    """Queued with the updates so idle sessions are evicted on the thread that handles them."""
+
+    def __init__(self):
+        super().__init__(update_id=0)
+
+def queue_sweep(context: CallbackContext):
+    # Job queue callback; the job's context puts the sweep where updates are queued
+    context.job.context(ExpirySweep())
+
+def sweep_sessions(update: Update, context: CallbackContext):
+    context.bot_data['sessions'].expire()
+    # Not a user's update: no other handler runs and no user is written back
+    raise DispatcherHandlerStop()
+
+def flow(context: CallbackContext) -> TestFlow:
+    return context.bot_data['flow']
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'start')
+def start(update: Update, context: CallbackContext) -> int:
+    # The menu is always sent as a new message, so it stays visible
+    update.message.reply_text(MENU_TEXT, reply_markup=MENU_KEYBOARD)
+    flow(context).abandon(update.effective_user.id, context.user_data, 'restarted')
+    return ConversationHandler.END
 
+@metrics.timed(metrics.HANDLER_SECONDS, 'test_selection')
 def test_selection(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
+    if not TestFlow.is_test(query.data):
+        # A test the catalog no longer has; a test in progress goes on
+        drop_callback(query)
+        return TestFlow.state(context.user_data)
     query.answer()
 
-    # Delete any previous test question messages
-    delete_previous_questions(update, context)
-
-    # Clear previous data if any
-    context.user_data.clear()
-
-    # Load the selected test questions
-    test_files = {
-        'beck_depression': 'Becks_depress.tsv',
-        'beck_anxiety': 'Becks_anxiety.tsv',
-        'ptsd': 'post_Traumatic_PCL-5.tsv',
-        'social_phobia': 'social_Phobia_SPIN.tsv'
-    }
-    context.user_data['questions'] = load_test_questions(test_files[query.data])
-    context.user_data['current_question'] = 0
-    context.user_data['test_name'] = query.data
-
-    # Send the first question
+    old_message_id = flow(context).start_test(update.effective_user.id, context.user_data, query.data)
+    if old_message_id:
+        # The question message of a test left unfinished
+        try:
+            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=old_message_id)
+        except Exception as e:
+            logger.error(f"Error deleting message: {e}")
     return show_question(update, context)
 
-def load_test_questions(filename):
-    questions = {}
-    with open(filename, 'r', encoding='utf-8') as file:
-        for line in file:
-            parts = line.strip().split('\t')
-            question_num_and_text = parts[0]
-            options = parts[1:]
-            questions[question_num_and_text] = options
-    return questions
-
+@metrics.timed(metrics.HANDLER_SECONDS, 'end_test')
 def end_test(update: Update, context: CallbackContext):
-    # Calculate the test results
-    total_score = calculate_results(context.user_data)
-    test_name = context.user_data['test_name']
-    
-    # Determine the appropriate scoring explanation
-    if test_name == 'beck_depression':
-        score_explanation = score_becks_depression(total_score)
-    elif test_name == 'beck_anxiety':
-        score_explanation = score_becks_anxiety(total_score)
-    elif test_name == 'ptsd':
-        responses = [int(v) for v in context.user_data.get('answers', {}).values() if v.isdigit()]
-        score_explanation = score_pcl5(responses)
-    elif test_name == 'social_phobia':
-        score_explanation = score_social_phobia(total_score)
-    else:
-        score_explanation = "Unknown test type."
-
-    # Prepare data for CSV
-    user_id = update.effective_user.id
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    answers = context.user_data.get('answers', {})
-    csv_row = [user_id, test_name, timestamp] + list(answers.values()) + [total_score, score_explanation]
-
-    # Write data to CSV
-    with open('results.csv', 'a', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(csv_row)
-
-    # Send the results to the user
-    result_message = f"ваш результат {test_name}: {total_score}\n{score_explanation}"
+    result_message = flow(context).finish_test(update.effective_user.id, context.user_data)
     if update.callback_query:
         update.callback_query.edit_message_text(text=result_message)
     else:
         update.message.reply_text(result_message)
+    # Nothing is kept between tests; the menu's buttons start the next one
+    return ConversationHandler.END
 
-    # Clear user data for a new test
-    context.user_data.clear()
-
-    # Return to the main menu
-    return SELECTING_TEST
-
+@metrics.timed(metrics.HANDLER_SECONDS, 'show_question')
 def show_question(update: Update, context: CallbackContext) -> int:
-    current_question_index = context.user_data['current_question']
-    questions = context.user_data['questions']
-    question_items = list(questions.items())
-
-    if current_question_index < len(question_items):
-        question_text, options = question_items[current_question_index]
-        keyboard = [[InlineKeyboardButton(option, callback_data=str(index))] for index, option in enumerate(options)]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        # If this is the first question, send a new message
-        if current_question_index == 0:
-            sent_message = context.bot.send_message(chat_id=update.effective_chat.id, text=question_text, reply_markup=reply_markup)
-            # Store the message ID for editing later
-            context.user_data['question_message_id'] = sent_message.message_id
-        else:
-            # Edit the existing message for subsequent questions
-            message_id = context.user_data.get('question_message_id')
-            context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=message_id, text=question_text, reply_markup=reply_markup)
-
-        return SHOW_QUESTION
-    else:
-        # End of test, handle accordingly
+    session = context.user_data['session']
+    question = TestFlow.next_question(session)
+    if question is None:
         return end_test(update, context)
+    text, reply_markup = question
+    if session.current_question == 0:
+        # The first question is a new message; the rest edit it
+        sent_message = context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
+        session.message_id = sent_message.message_id
+    else:
+        context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=session.message_id, text=text,
+                                      reply_markup=reply_markup)
+    return SHOW_QUESTION
 
-
-def calculate_results(user_data):
-    answers = user_data.get('answers', {})
-    valid_answers = [int(v) for v in answers.values() if v.isdigit()]
-    total_score = sum(valid_answers)
-    return total_score
-
-def save_results(user_id, test_name, results):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open('results.csv', 'a', newline='') as csvfile:
-        result_writer = csv.writer(csvfile, delimiter=',')
-        result_writer.writerow([user_id, test_name, timestamp, results])
-
+@metrics.timed(metrics.HANDLER_SECONDS, 'handle_answer')
 def handle_answer(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
+    # Double taps, redelivered callbacks and taps on old keyboards are dropped here, with no
+    # API call but the callback answer
+    if not TestFlow.record_answer(context.user_data, query.message.message_id, query.data):
+        drop_callback(query)
+        return TestFlow.state(context.user_data)
     query.answer()
+    return show_question(update, context)
 
-    # Handle test selection if the callback data matches test names
-    if query.data in ['beck_depression', 'beck_anxiety', 'ptsd', 'social_phobia']:
-        return test_selection(update, context)
-
-    # Otherwise, handle it as an answer to a question
-    current_question_index = context.user_data['current_question']
-    context.user_data.setdefault('answers', {})[current_question_index] = query.data
+def drop_callback(query, text=None):
+    # Ignores the tap, but answers it so the client stops showing its loading spinner
+    metrics.CALLBACKS_DROPPED.inc()
+    try:
+        query.answer(text=text)
+    except TelegramError as e:
+        logger.debug(f"Error answering a dropped callback: {e}")
 
-    # Increment the question index and show next question
-    context.user_data['current_question'] += 1
-    return show_question(update, context)
+def drop_stale_callback(update: Update, context: CallbackContext):
+    drop_callback(update.callback_query, STALE_TAP_TEXT)
 
+@metrics.timed(metrics.HANDLER_SECONDS, 'cancel_handler')
 def cancel_handler(update: Update, context: CallbackContext) -> int:
-    update.message.reply_text('Test cancelled. Type /start to begin again.')
-    context.user_data.clear()
+    update.message.reply_text(CANCEL_TEXT)
+    flow(context).abandon(update.effective_user.id, context.user_data, 'cancelled')
     return ConversationHandler.END
 
-def main() -> None:
-    with open("token.txt", "r") as file:
-        token = file.read().strip()
-
-    updater = Updater(token)
-
-    dispatcher = updater.dispatcher
+@metrics.timed(metrics.HANDLER_SECONDS, 'show_history')
+def show_history(update: Update, context: CallbackContext):
+    # Works in any state and leaves a test in progress as it is
+    update.message.reply_text(flow(context).history_text(update.effective_user.id))
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'show_stats')
+def show_stats(update: Update, context: CallbackContext):
+    text = flow(context).stats_text(update.effective_user.id)
+    if text is not None:
+        update.message.reply_text(text)
+
+def add_handlers(dispatcher, flow: TestFlow, store=None) -> None:
+    """Runs the test flow on the dispatcher: sessions in the shared store when one is given,
+    whose expiry sweep this starts, otherwise in the dispatcher's user_data, kept by its
+    persistence."""
+    dispatcher.bot_data['flow'] = flow
+    # Tests left in progress before a restart are still active
+    metrics.ACTIVE_SESSIONS.set(sum('session' in data for data in dispatcher.user_data.values()))
+
+    # Tests left idle past the TTL are dropped from memory and the sessions database, along with
+    # the conversation state; tests are taken in private chats, keyed (user_id, user_id)
+    def evict_session(user_id, session):
+        record_abandonment(flow.results_writer, user_id, session, 'expired')
+        key = (user_id, user_id)
+        conversation_handler.conversations.pop(key, None)
+        dispatcher.persistence.update_user_data(user_id, {})
+        dispatcher.persistence.update_conversation(conversation_handler.name, key, None)
+
+    sessions = SessionManager(dispatcher.user_data, config.SESSION_IDLE_TTL, on_evict=evict_session)
+    for user_id in list(dispatcher.user_data):
+        sessions.touch(user_id)
+    dispatcher.bot_data['sessions'] = sessions
 
     conversation_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        # The menu's buttons start a test in any state, including none
+        entry_points=[CommandHandler('start', start), CallbackQueryHandler(test_selection, pattern=MENU_PATTERN)],
         states={
-            SELECTING_TEST: [CallbackQueryHandler(test_selection)],
             SHOW_QUESTION: [CallbackQueryHandler(handle_answer)],
         },
         fallbacks=[CommandHandler('cancel', cancel_handler)],
-        allow_reentry=True  # Allow re-entering the same state
+        allow_reentry=True,  # Allow re-entering the same state
+        name='tests',
+        persistent=store is None
     )
 
     dispatcher.add_handler(conversation_handler)
+    if store is None:
+        # States saved with no test behind them, such as the menu state older versions kept
+        # between tests
+        for key in TestFlow.stale_conversations(conversation_handler.conversations, dispatcher.user_data):
+            del conversation_handler.conversations[key]
+            dispatcher.persistence.update_conversation(conversation_handler.name, key, None)
+    # Commands the conversation doesn't handle fall through to the next handler in its group
+    dispatcher.add_handler(CommandHandler('history', show_history))
+    dispatcher.add_handler(CommandHandler('stats', show_stats))
+    # Taps on the keyboard of a test that finished or expired, with no conversation state left to take them
+    dispatcher.add_handler(CallbackQueryHandler(drop_stale_callback))
+    if store:
+        shared = SharedSessions(store, conversation_handler, flow.results_writer)
+        dispatcher.add_handler(TypeHandler(Update, shared.load), group=-1)
+        dispatcher.add_handler(TypeHandler(Update, shared.save), group=1)
+        # The store also expires idle sessions
+        store.start(config.SESSION_SWEEP_INTERVAL, shared.record_expired)
+    else:
+        dispatcher.add_handler(TypeHandler(ExpirySweep, sweep_sessions), group=-2)
+        dispatcher.add_handler(TypeHandler(Update, track_session), group=1)
+
+def main() -> None:
+    if config.BOT_MODE == 'webhook':
+        require_webhook_url(config.WEBHOOK_URL)
+    with open("token.txt", "r") as file:
+        token = file.read().strip()
 
-    updater.start_polling()
-    updater.idle()
+    # Pool sized for the Updater's 4 workers and poller plus the outbound queue's 8 senders
+    request = QueuedRequest(con_pool_size=16)
+    bot = Bot(token, base_url=f'{config.TELEGRAM_API_URL}/bot', request=request)
+    store = open_session_store(config.SESSION_STORE, config.SESSION_IDLE_TTL) if config.SESSION_STORE else None
+    if store:
+        # Replicas share sessions through the store
+        updater = Updater(bot=bot)
+    else:
+        updater = Updater(bot=bot, persistence=SqliteSessionPersistence(config.SESSIONS_DB))
+
+    dispatcher = updater.dispatcher
+    # Completed tests are saved to the results database in batches by a background thread; a CSV
+    # store keeps as many results per test in memory as /history shows, plus one
+    results_writer = ResultsWriter(open_results_store(config.RESULTS_DB, history_depth=config.HISTORY_LENGTH + 1))
+    # Aggregates for /stats and result percentiles, caught up from the last checkpoint and then
+    # updated with every saved batch
+    statistics = follow_results(results_writer, checkpoint_path(config.RESULTS_DB), config.STATS_CHECKPOINT_INTERVAL)
+    add_handlers(dispatcher, TestFlow(results_writer, statistics), store)
+
+    results_writer.start()
+    CATALOGS.start(config.CATALOG_RELOAD_INTERVAL)
+    request.outbound.start()
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = metrics.MetricsServer(host=config.METRICS_HOST, port=config.METRICS_PORT).start()
+    if config.BOT_MODE == 'webhook':
+        run_webhook(updater, sweep=store is None)
+    else:
+        if store is None:
+            updater.job_queue.run_repeating(queue_sweep, config.SESSION_SWEEP_INTERVAL,
+                                            context=dispatcher.update_queue.put)
+        updater.start_polling()
+        updater.idle()
+    if metrics_server:
+        metrics_server.stop()
+    CATALOGS.stop()
+    if store:
+        store.stop()
+        store.close()
+    request.outbound.stop()
+    # Flush any queued results before exiting
+    if not results_writer.close():
+        logger.error("Some results could not be saved; they are logged above")
+    statistics.save_checkpoint()
+
+def run_webhook(updater: Updater, sweep=False) -> None:
+    """Receives updates on a local HTTP endpoint instead of long polling."""
+    dispatcher = updater.dispatcher
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    webhook = WebhookServer(
+        lambda data: dispatcher.process_update(data if isinstance(data, Update) else Update.de_json(data, updater.bot)),
+        secret_token,
+        host=config.WEBHOOK_HOST,
+        port=config.WEBHOOK_PORT,
+        path=config.WEBHOOK_PATH,
+        queue_size=config.WEBHOOK_QUEUE_SIZE
+    ).start()
+    updater.bot.set_webhook(url=config.WEBHOOK_URL, api_kwargs={'secret_token': secret_token})
+    if sweep:
+        updater.job_queue.run_repeating(queue_sweep, config.SESSION_SWEEP_INTERVAL, context=webhook.enqueue)
+        updater.job_queue.start()
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+
+    updater.job_queue.stop()
+    webhook.stop()
+    if dispatcher.persistence:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,8 +1,11 @@
 import logging
-import csv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, CallbackContext, ConversationHandler, CallbackQueryHandler
 import datetime
+from results_writer import ResultsWriter
+from results_store import Completion, CsvResultsStore
+from question_bank import get_questions
+from scoring import explain_score
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -10,6 +13,7 @@ logger = logging.getLogger(__name__)
 
 
 RESULTS_FILE = "results.csv"
+results_writer = ResultsWriter(CsvResultsStore(RESULTS_FILE))
 
 # State definitions for top-level conversation
 SELECTING_TEST = 1
@@ -23,43 +27,27 @@ TESTS = {
     "Social Phobia SPIN test": "social_Phobia_SPIN.tsv"
 }
 
-QUESTIONS_FILES = {
-    "Beck's depression test": "Beck's_depress.tsv",
-    "Beck's anxiety test": "Beck's_anxiety.tsv",
-    "Post-Traumatic PCL-5 test": "post_Traumatic_PCL-5.tsv",
-    "Social Phobia SPIN test": "social_Phobia_SPIN.tsv"
+# Test name -> instrument in scoring_rules.json
+SCORING_KEYS = {
+    "Beck's depression test": 'beck_depression',
+    "Beck's anxiety test": 'beck_anxiety',
+    "Post-Traumatic PCL-5 test": 'ptsd',
+    "Social Phobia SPIN test": 'social_phobia',
+    "тест депрессии Бека": 'beck_depression',
+    "тест тревожности Бека": 'beck_anxiety',
+    "тест симптомов ПТСР": 'ptsd',
+    "тест социальных фобий": 'social_phobia'
 }
 
-# A dictionary containing the number of questions for each test
-QUESTIONS_COUNT = {
-    "Beck's depression test": 21,
-    "Beck's anxiety test": 10,
-    "Post-Traumatic PCL-5 test": 15,
-    "Social Phobia SPIN test": 8
-}
-
-# A dictionary containing the questions and options read from the Beck's_depress.tsv file
-# questions = {}
-
 
 def read_questions_from_file(test_name: str):
-    filename = QUESTIONS_FILES.get(test_name)
-    if filename is None:
+    # The same validated banks as bot.py; a bad TSV fails the bank build instead of
+    # silently losing rows here
+    instrument = SCORING_KEYS.get(test_name)
+    if instrument is None:
         raise Exception(f"Invalid test name '{test_name}'.")
-
-    try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-            questions = {}  # Initialize 'questions' for each test separately
-            for line in lines:
-                data = line.strip().split('\t')
-                if len(data) == 5:
-                    question = data[0]
-                    options = data[1:]
-                    questions[question] = options
-    except FileNotFoundError:
-        raise Exception(f"Failed to read questions from the file '{filename}'. Make sure it exists.")
-    return questions, QUESTIONS_COUNT.get(test_name, 0)
+    questions = get_questions(instrument)
+    return questions, len(questions)
 
 
 def start(update: Update, _: CallbackContext) -> int:
@@ -181,8 +169,7 @@ def send_question(update: Update, _: CallbackContext, test_name: str):
         show_results(update, _, test_name)
         return SELECTING_QUESTIONS
 
-    question = list(questions.keys())[current_question_number - 1]
-    options = questions[question]
+    question, options = questions[current_question_number - 1]
 
     keyboard = []
     for idx, option in enumerate(options):
@@ -211,7 +198,7 @@ def handle_answer(update: Update, _: CallbackContext) -> int:
         return ConversationHandler.END
 
     question_number = user_data.get('current_question')
-    questions_count = QUESTIONS_COUNT.get(user_data.get('test_name', ''), 0)
+    questions_count = user_data.get('questions_count', 0)
     
     if not question_number or question_number > questions_count:
         # Should not happen, but just in case
@@ -241,78 +228,14 @@ def show_results(update: Update, _: CallbackContext, test_name: str) -> None:
     total_score = sum(answers.get(q, 0) for q in range(1, questions_count + 1))
 
     test_name = user_data.get('current_test', '')
-    result = ""
-
-    if test_name == "тест депрессии Бека":
-        if total_score <= 10:
-            result = "отсутствуют или не выражены симптомы депрессии."
-        elif 11 <= total_score <= 16:
-            result = "имеются нарушения настроения."
-        elif 17 <= total_score <= 20:
-            result = "есть симптомы на границе клинической депрессии."
-        elif 21 <= total_score <= 30:
-            result = "есть симптомы которые свидетельствуют или могут привести к умеренной депрессии."
-        elif 31 <= total_score <= 40:
-            result = "имеются серьезные нарушения настроения либо выраженная депрессия."
-        else:
-            result = "есть симптомы серьезной депрессии."
-
-    elif test_name == "тест тревожности Бека":
-        # Define the scoring scale for the Beck's anxiety test
-        # You can replace these values with the correct scoring scale
-        if total_score <= 7:
-            result = "минимальный уровень тревожности."
-        elif 8 <= total_score <= 15:
-            result = "легкая тревожность и беспокойство."
-        elif 16 <= total_score <= 25:
-            result = "умеренная тревожность."
-        else:
-            result = "сильная тревога."
-
-    elif test_name == "тест симптомов ПТСР":
-        # Define the scoring scale for the PCL-5 test (Post-Traumatic Stress Disorder Checklist for DSM-5)
-        # You can replace these values with the correct scoring scale
-        if total_score <= 20:
-            result = "отсутствуют или не выражены симптомы ПТСР."
-        elif 21 <= total_score <= 35:
-            result = "имеются легкие симптомы ПТСР."
-        elif 36 <= total_score <= 50:
-            result = "есть умеренные симптомы ПТСР."
-        elif 51 <= total_score <= 65:
-            result = "есть симптомы ПТСР средней тяжести."
-        elif 66 <= total_score <= 80:
-            result = "есть серьезные симптомы ПТСР."
-        else:
-            result = "есть симптомы тяжелого ПТСР."
-
-    elif test_name == "тест социальных фобий":
-        # Define the scoring scale for the SPIN test (Social Phobia Inventory)
-        # You can replace these values with the correct scoring scale
-        if total_score <= 10:
-            result = "отсутствует или не выражены симптомы социальной фобии."
-        elif 11 <= total_score <= 20:
-            result = "имеются легкие симптомы социальной фобии."
-        elif 21 <= total_score <= 30:
-            result = "есть умеренные симптомы социальной фобии."
-        elif 31 <= total_score <= 40:
-            result = "есть симптомы социальной фобии средней тяжести."
-        elif 41 <= total_score <= 50:
-            result = "есть серьезные симптомы социальной фобии."
-        else:
-            result = "есть симптомы тяжелой социальной фобии."
-
-    # Add similar elif blocks for other tests as needed
+    scoring_key = SCORING_KEYS.get(test_name)
+    responses = [answers.get(q, 0) for q in range(1, questions_count + 1)]
+    result = explain_score(scoring_key, responses) if scoring_key else ""
 
     # Save results in CSV file
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(RESULTS_FILE, 'a', newline='') as csvfile:
-        fieldnames = ['user_id', 'timestamp', 'test_name', 'result', 'answers']  # Add 'test_name' to the header
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        # Convert answers dictionary to a comma-separated string
-        answers_str = ",".join([str(answers[q]) for q in sorted(answers.keys())])
-
-        writer.writerow({'user_id': user_id, 'timestamp': timestamp, 'test_name': test_name, 'result': total_score, 'answers': answers_str})
+    answers_bytes = bytes(answers[q] for q in sorted(answers.keys()))
+    results_writer.write(Completion(user_id, test_name, timestamp, answers_bytes, total_score, result))
 
     # Compose the message with the test results
     message = (
@@ -333,36 +256,6 @@ def show_results(update: Update, _: CallbackContext, test_name: str) -> None:
     # Clear user data after showing results
     user_data.clear()
 
-    # Save results in CSV file
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(RESULTS_FILE, 'a', newline='') as csvfile:
-        fieldnames = ['user_id', 'timestamp', 'test_name', 'result', 'answers']  # Add 'test_name' to the header
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        # Convert answers dictionary to a comma-separated string
-        answers_str = ",".join([str(answers[q]) for q in sorted(answers.keys())])
-
-        writer.writerow({'user_id': user_id, 'timestamp': timestamp, 'test_name': test_name, 'result': total_score, 'answers': answers_str})
-
-    # Compose the message with the test results
-    message = (
-        f"Вы прошли тест ({timestamp}), судя по вашим ответам ваш результат по тесту '{test_name}': {total_score} . "
-        f"Вероятнее всего у вас {result}"
-    )
-
-    # If there was a previous message, edit it with the results, otherwise send a new message
-    previous_message_id = user_data.get('previous_message')
-    if previous_message_id:
-        update.callback_query.edit_message_text(
-            text=message,
-            reply_markup=None  # Remove the "Cancel" button from the message
-        )
-    else:
-        update.effective_message.reply_text(message)
-
-    # Clear user data after showing results
-    user_data.clear()
-
 
 def main():
     # Create the Updater and pass it your bot's token
@@ -394,11 +287,15 @@ def main():
     dp.add_handler(conversation_handler)
 
     # Start the Bot
+    results_writer.start()
     updater.start_polling()
 
     # Run the bot until the user presses Ctrl-C or the process receives SIGINT, SIGTERM, or SIGABRT
     updater.idle()
 
+    # Flush any queued results before exiting
+    results_writer.close()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,47 @@
+# bot_api.py
+# The Bot API surface shared by the async runtime, the outbound queue and the fakes.
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramError(Exception):
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Bot API call failed: {future.exception()}")
+
+
+class BotAPIMethods:
+    """The Bot API methods the bot uses, on top of an async call(method, **params)."""
+
+    async def call(self, method, **params):
+        raise NotImplementedError
+
+    def submit(self, method, **params):
+        """Starts a call without waiting for its result; failures are logged."""
+        future = asyncio.ensure_future(self.call(method, **params))
+        future.add_done_callback(_log_failure)
+        return future
+
+    async def get_updates(self, offset=None, timeout=0):
+        return await self.call('getUpdates', offset=offset, timeout=timeout)
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self.call('sendMessage', chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        return await self.call('editMessageText', chat_id=chat_id, message_id=message_id, text=text,
+                               reply_markup=reply_markup)
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.call('deleteMessage', chat_id=chat_id, message_id=message_id)
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id, text=text)
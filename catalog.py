@@ -0,0 +1,143 @@
+# catalog.py
+# Versioned snapshots of the question banks and scoring rules. A background thread
+# watches the TSVs and scoring_rules.json; after an edit it rebuilds and validates a
+# new snapshot off the hot path and swaps it in with one assignment, so no restart
+# (and no loss of in-memory sessions) is needed. New tests start on the current
+# snapshot, a test in progress keeps the one it started with, and its result records
+# that snapshot's version.
+import hashlib
+import logging
+import os
+import threading
+from typing import Mapping, NamedTuple, Tuple
+
+import metrics
+from keyboards import build_question_keyboards
+from question_bank import QUESTION_BANKS, TEST_FILES, Question, compile_banks, parse_all_banks
+from scoring import INSTRUMENTS, SCORING_RULES_FILE, Instrument, load_scoring_rules
+
+logger = logging.getLogger(__name__)
+
+
+class Catalog(NamedTuple):
+    # Hash of the content, so every replica loading the same files agrees on it
+    version: str
+    banks: Mapping[str, Tuple[Question, ...]]
+    instruments: Mapping[str, Instrument]
+    # Prebuilt reply_markup JSON per test and question, as in keyboards.py
+    keyboards: Mapping[str, Tuple[str, ...]]
+
+    def question_keyboard(self, test_name, index):
+        return self.keyboards[test_name][index]
+
+
+def content_version(banks, instruments):
+    digest = hashlib.sha1(compile_banks(banks))
+    digest.update(repr(sorted(instruments.items())).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def build_catalog(banks, instruments):
+    return Catalog(content_version(banks, instruments), banks, instruments, build_question_keyboards(banks))
+
+
+class CatalogRegistry:
+    """The current Catalog plus every earlier one a session may still be using.
+
+    Old snapshots are kept for the life of the process: they are a few tens of KB
+    each and only an edit makes a new one.
+    """
+
+    def __init__(self, catalog, test_files=TEST_FILES, rules_file=SCORING_RULES_FILE):
+        self.current = catalog
+        self.test_files = test_files
+        self.rules_file = rules_file
+        self._catalogs = {catalog.version: catalog}
+        self._mtimes = self._source_mtimes()
+        # One rebuild at a time; readers never take it
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, version):
+        """The snapshot a stored session started on, or the current one if it's unknown."""
+        catalog = self._catalogs.get(version)
+        if catalog is None and version:
+            # Another replica may have picked up an edit before this one
+            self.check()
+            catalog = self._catalogs.get(version)
+            if catalog is None:
+                logger.warning(f"Unknown catalog version {version}; continuing on {self.current.version}")
+        return catalog or self.current
+
+    def check(self):
+        """Reloads if any source file changed since the last load; True if a new snapshot was swapped in."""
+        mtimes = self._source_mtimes()
+        if mtimes == self._mtimes:
+            return False
+        return self.reload(mtimes)
+
+    def reload(self, mtimes=None):
+        with self._lock:
+            mtimes = mtimes or self._source_mtimes()
+            try:
+                instruments = load_scoring_rules(self.rules_file)
+                catalog = build_catalog(parse_all_banks(self.test_files, instruments), instruments)
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                # Includes BankError and malformed JSON. Not retried until the files change again
+                self._mtimes = mtimes
+                metrics.CATALOG_RELOADS.labels('failed').inc()
+                logger.error(f"Keeping catalog {self.current.version}; the edited banks or scoring rules "
+                             f"are invalid:\n{e}")
+                return False
+            self._mtimes = mtimes
+            if catalog.version == self.current.version:
+                return False
+            # Reverting an edit brings back the earlier snapshot rather than a copy of it
+            self.current = self._catalogs.setdefault(catalog.version, catalog)
+            metrics.CATALOG_RELOADS.labels('ok').inc()
+            logger.info(f"Loaded catalog {self.current.version}; tests in progress keep their version")
+            return True
+
+    def _source_mtimes(self):
+        mtimes = []
+        for path in (*self.test_files.values(), self.rules_file):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def start(self, interval):
+        """Runs check() every `interval` seconds from a background thread; 0 leaves reloading off."""
+        if self._thread is None and interval:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='catalog-reload',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Error reloading the catalog")
+
+
+# Starts from the banks and rules loaded at import
+CATALOGS = CatalogRegistry(build_catalog(QUESTION_BANKS, INSTRUMENTS))
+
+
+def current_catalog():
+    return CATALOGS.current
+
+
+def get_catalog(version):
+    return CATALOGS.get(version)
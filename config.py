@@ -0,0 +1,68 @@
+# config.py
+# Deployment settings, read from environment variables.
+import os
+
+# Bot API server; point at a local fake_telegram.py server for offline runs
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# 'polling' (default) or 'webhook'
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+
+# Public HTTPS URL Telegram should POST updates to, e.g. https://bot.example.com/webhook; required
+# in webhook mode
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+# Local address the webhook server listens on (usually behind a TLS-terminating proxy)
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+# Shared secret Telegram sends in X-Telegram-Bot-Api-Secret-Token; generated at startup if empty
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+# Updates waiting for the dispatcher beyond this are rejected so Telegram retries them later
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+
+# Local port for the Prometheus /metrics endpoint; 0 (default) leaves it off
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+
+# Outbound rate limits for new messages: per second across all chats, and per chat with a short
+# burst allowance. Edits and deletes (answer taps redraw the question message) are only kept in
+# order per chat and slowed down after a 429; pacing them too would hold every tap past the burst
+# for a second, while leaving them unpaced risks more 429s in chats that edit very fast
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', '5'))
+
+# Tests left untouched this many seconds are dropped from memory and recorded as abandoned;
+# idle sessions are looked for every SESSION_SWEEP_INTERVAL seconds
+SESSION_IDLE_TTL = float(os.environ.get('SESSION_IDLE_TTL', '86400'))
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '60'))
+
+# Completed tests are saved to RESULTS_DB (SQLite, or CSV for a .csv path); tests in progress
+# and conversation states to SESSIONS_DB, so a restart resumes them. Relative paths are taken
+# from the working directory
+RESULTS_DB = os.environ.get('RESULTS_DB', 'results.db')
+SESSIONS_DB = os.environ.get('SESSIONS_DB', 'sessions.db')
+
+# Shared session store for running several bot.py replicas: memory://, sqlite:///sessions_shared.db
+# or redis://host:6379/0. Empty (default) keeps sessions in this process, saved to SESSIONS_DB
+SESSION_STORE = os.environ.get('SESSION_STORE', '')
+
+# Seconds between checks for edited question banks or scoring rules, which are then reloaded
+# without a restart (see catalog.py); 0 turns reloading off
+CATALOG_RELOAD_INTERVAL = float(os.environ.get('CATALOG_RELOAD_INTERVAL', '5'))
+
+# Results per test shown by /history
+HISTORY_LENGTH = int(os.environ.get('HISTORY_LENGTH', '5'))
+
+# Telegram user ids allowed to use /stats, comma-separated
+ADMIN_USER_IDS = frozenset(int(user_id) for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',') if user_id.strip())
+# Seconds between saves of the /stats aggregates (see stats.py)
+STATS_CHECKPOINT_INTERVAL = float(os.environ.get('STATS_CHECKPOINT_INTERVAL', '60'))
+# Seconds between re-reads of the results store by each sharding.py worker, which only sees
+# its own batches as they are written; the others' reach its percentiles within this interval
+STATS_REFRESH_INTERVAL = float(os.environ.get('STATS_REFRESH_INTERVAL', '5'))
+# A finished test shows its score's percentile once the test has this many completions
+PERCENTILE_MIN_COMPLETIONS = int(os.environ.get('PERCENTILE_MIN_COMPLETIONS', '20'))
+
+# Worker processes for sharding.py; each user's updates always go to the same one
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '4'))
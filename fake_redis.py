@@ -0,0 +1,182 @@
+# fake_redis.py
+# Local stand-in for Redis, speaking its protocol (RESP) with just the commands
+# session_store.RedisSessionStore uses: GET, SET [EX], DEL, WATCH/UNWATCH and
+# MULTI/EXEC/DISCARD, plus PING, AUTH and SELECT. Lets the Redis session store run
+# offline:
+#
+#   python fake_redis.py --port 6379
+#   SESSION_STORE=redis://127.0.0.1:6379/0 python bot.py
+import argparse
+import logging
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FakeRedis:
+    """Keys in a dict; every write bumps the key's revision so WATCH can spot it."""
+
+    def __init__(self):
+        self.values = {}  # key -> (value, expires_at or None)
+        self.revisions = {}  # key -> writes so far
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            # Expiring a key counts as a write for WATCH, as in Redis
+            del self.values[key]
+            self._touch(key)
+            entry = None
+        return None if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        self.values[key] = (value, None if ttl is None else time.monotonic() + ttl)
+        self._touch(key)
+
+    def delete(self, key):
+        if self.values.pop(key, None) is None:
+            return 0
+        self._touch(key)
+        return 1
+
+    def revision(self, key):
+        self.get(key)
+        return self.revisions.get(key, 0)
+
+    def _touch(self, key):
+        self.revisions[key] = self.revisions.get(key, 0) + 1
+
+
+class _RedisRequestHandler(socketserver.StreamRequestHandler):
+    # Pipelined replies go out in separate writes; don't let Nagle hold them back
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.watched = {}  # key -> revision when watched
+        self.queued = None  # commands between MULTI and EXEC
+
+    def handle(self):
+        while True:
+            try:
+                args = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            self.wfile.write(self._execute(args))
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command, as typed into telnet
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _execute(self, args):
+        name = args[0].upper().decode('ascii')
+        if self.queued is not None and name not in ('EXEC', 'DISCARD', 'MULTI', 'WATCH'):
+            self.queued.append(args)
+            return b'+QUEUED\r\n'
+        redis = self.server.redis
+        with redis.lock:
+            if name == 'MULTI':
+                self.queued = []
+                return b'+OK\r\n'
+            if name == 'DISCARD':
+                self.queued = None
+                self.watched = {}
+                return b'+OK\r\n'
+            if name == 'EXEC':
+                if self.queued is None:
+                    return b'-ERR EXEC without MULTI\r\n'
+                queued, self.queued = self.queued, None
+                watched, self.watched = self.watched, {}
+                if any(redis.revision(key) != revision for key, revision in watched.items()):
+                    return b'*-1\r\n'
+                return b'*%d\r\n' % len(queued) + b''.join(self._run(redis, command) for command in queued)
+            if name == 'WATCH':
+                for key in args[1:]:
+                    self.watched[key] = redis.revision(key)
+                return b'+OK\r\n'
+            if name == 'UNWATCH':
+                self.watched = {}
+                return b'+OK\r\n'
+            return self._run(redis, args)
+
+    @staticmethod
+    def _run(redis, args):
+        name = args[0].upper().decode('ascii')
+        if name == 'PING':
+            return b'+PONG\r\n'
+        if name in ('AUTH', 'SELECT'):
+            return b'+OK\r\n'
+        if name == 'GET':
+            value = redis.get(args[1])
+            return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+        if name == 'SET':
+            ttl = None
+            if len(args) == 5 and args[3].upper() == b'EX':
+                ttl = int(args[4])
+            redis.set(args[1], args[2], ttl)
+            return b'+OK\r\n'
+        if name == 'DEL':
+            return b':%d\r\n' % sum(redis.delete(key) for key in args[1:])
+        return b"-ERR unknown command '%s'\r\n" % args[0]
+
+
+class _RedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeRedisServer:
+    """Serves a FakeRedis on a local port."""
+
+    def __init__(self, redis=None, host='127.0.0.1', port=0):
+        self.redis = redis or FakeRedis()
+        self.server = _RedisServer((host, port), _RedisRequestHandler)
+        self.server.redis = self.redis
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'redis://{host}:{port}/0'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-redis', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local Redis stand-in for the session store.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+
+    server = FakeRedisServer(host=args.host, port=args.port).start()
+    print(f"Fake Redis listening; point the bot at it with SESSION_STORE={server.url}")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
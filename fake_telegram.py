@@ -0,0 +1,342 @@
+# fake_telegram.py
+# Offline stand-ins for the Telegram Bot API, for tests, benchmarks and load runs.
+#
+# FakeTelegramServer speaks the Bot API over HTTP, so either runtime can be pointed at it:
+#   python fake_telegram.py --port 8081 --latency 0.05 --error-rate 0.01
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+# or from Python, launch_bot(server) runs bot.py against a server started in-process and
+# process.stop() ends it and removes its scratch directory.
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bot_api import BotAPIMethods, TelegramError
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'psy_bot', 'username': 'psy_bot'}
+
+# Methods counted against the flood limits
+FLOOD_LIMITED_METHODS = frozenset({'sendMessage', 'editMessageText', 'deleteMessage'})
+
+
+def command_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': int(time.time()), 'from': {'id': user_id, 'is_bot': False,
+                    'first_name': str(user_id)}, 'chat': {'id': user_id, 'type': 'private'}, 'text': text,
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+                    if text.startswith('/') else []},
+    }
+
+
+def callback_update(update_id, user_id, data, message_id=None):
+    return {
+        'update_id': update_id,
+        'callback_query': {'id': str(update_id), 'chat_instance': str(user_id), 'data': data,
+                           'from': {'id': user_id, 'is_bot': False, 'first_name': str(user_id)},
+                           'message': {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                                       'chat': {'id': user_id, 'type': 'private'}}},
+    }
+
+
+class FakeBot:
+    """Bot API state shared by the fake clients: messages, pending updates and injected failures.
+
+    error_rate and flood_rate are the chances that an outgoing call fails with a 500 or
+    with a 429 asking to retry after `retry_after` seconds. chat_limit and global_limit,
+    if set, are the messages per second (over a sliding second) that a chat and the whole
+    bot may send before getting that 429, like Telegram's flood control.
+    """
+
+    def __init__(self, error_rate=0.0, flood_rate=0.0, retry_after=1, seed=None, chat_limit=None,
+                 global_limit=None):
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.flood_errors = 0
+        self.messages = {}  # (chat_id, message_id) -> {'text': ..., 'reply_markup': ...}
+        self.calls = []
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates = []
+        self._listeners = []
+        self._sent = defaultdict(deque)  # chat_id, or None for all chats -> send times in the last second
+        self._lock = threading.Lock()
+        self._new_updates = threading.Condition(self._lock)
+
+    def add_listener(self, listener):
+        """Calls listener(method, params, result) after every successful call."""
+        self._listeners.append(listener)
+
+    def push_update(self, update):
+        """Queues an update for getUpdates, numbering it if it has no update_id."""
+        with self._lock:
+            if update.get('update_id') is None:
+                update['update_id'] = next(self._update_ids)
+                # PTB rejects messages without an id
+                message = update.get('message')
+                if message is not None and message.get('message_id') is None:
+                    message['message_id'] = update['update_id']
+            self._updates.append(update)
+            self._new_updates.notify_all()
+        return update['update_id']
+
+    def handle(self, method, params):
+        if method == 'getUpdates':
+            return self._getUpdates(**params)
+        with self._lock:
+            self.calls.append((method, params))
+            roll = self._random.random()
+            if roll < self.flood_rate:
+                self.flood_errors += 1
+                raise TelegramError(f'Too Many Requests: retry after {self.retry_after}', 429, self.retry_after)
+            if roll < self.flood_rate + self.error_rate:
+                raise TelegramError('Internal Server Error', 500)
+            handler = getattr(self, f'_{method}', None)
+            if handler is None:
+                raise TelegramError(f'Not Found: method {method} not found', 404)
+            if method in FLOOD_LIMITED_METHODS:
+                self._check_flood_limits(int(params['chat_id']))
+            result = handler(**params)
+        for listener in self._listeners:
+            listener(method, params, result)
+        return result
+
+    def _check_flood_limits(self, chat_id):
+        now = time.monotonic()
+        for key, limit in ((chat_id, self.chat_limit), (None, self.global_limit)):
+            if not limit:
+                continue
+            sent = self._sent[key]
+            while sent and sent[0] <= now - 1:
+                sent.popleft()
+            if len(sent) >= limit:
+                self.flood_errors += 1
+                raise TelegramError(f'Too Many Requests: retry after {self.retry_after}', 429, self.retry_after)
+        for key, limit in ((chat_id, self.chat_limit), (None, self.global_limit)):
+            if limit:
+                self._sent[key].append(now)
+
+    def _getUpdates(self, offset=None, timeout=0, limit=100, **_):
+        deadline = time.monotonic() + float(timeout or 0)
+        with self._lock:
+            if offset is not None:
+                # Confirms (drops) every update before offset
+                self._updates = [u for u in self._updates if u['update_id'] >= int(offset)]
+            while not self._updates and time.monotonic() < deadline:
+                self._new_updates.wait(deadline - time.monotonic())
+            return self._updates[:int(limit)]
+
+    def _getMe(self, **_):
+        return BOT_USER
+
+    def _getMyCommands(self, **_):
+        # PTB's Bot looks these up right after getMe
+        return []
+
+    def _deleteWebhook(self, **_):
+        return True
+
+    def _setWebhook(self, **_):
+        return True
+
+    def _message(self, chat_id, message_id, text, reply_markup):
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        self.messages[(chat_id, message_id)] = {'text': text, 'reply_markup': reply_markup}
+        message = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                   'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        return message
+
+    def _sendMessage(self, chat_id, text, reply_markup=None, **_):
+        return self._message(int(chat_id), next(self._message_ids), text, reply_markup)
+
+    def _editMessageText(self, chat_id, message_id, text, reply_markup=None, **_):
+        if (int(chat_id), int(message_id)) not in self.messages:
+            raise TelegramError('Bad Request: message to edit not found', 400)
+        return self._message(int(chat_id), int(message_id), text, reply_markup)
+
+    def _deleteMessage(self, chat_id, message_id, **_):
+        if self.messages.pop((int(chat_id), int(message_id)), None) is None:
+            raise TelegramError('Bad Request: message to delete not found', 400)
+        return True
+
+    def _answerCallbackQuery(self, callback_query_id, **_):
+        return True
+
+
+class FakeBotAPI(BotAPIMethods):
+    """In-process replacement for async_bot.BotAPI; `latency` seconds are awaited per call."""
+
+    def __init__(self, latency=0.0, bot=None):
+        self.latency = latency
+        self.bot = bot or FakeBot()
+
+    async def call(self, method, **params):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.bot.handle(method, {k: v for k, v in params.items() if v is not None})
+
+    async def close(self):
+        pass
+
+
+class _BotAPIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+        self._handle(params)
+
+    def do_GET(self):
+        self._handle(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query)))
+
+    def _handle(self, params):
+        server = self.server.fake
+        # /bot<token>/<method>
+        method = urllib.parse.urlsplit(self.path).path.rsplit('/', 1)[-1]
+        if server.latency and method != 'getUpdates':
+            time.sleep(server.latency)
+        try:
+            status, response = 200, {'ok': True, 'result': server.bot.handle(method, params)}
+        except TelegramError as e:
+            status = e.error_code or 400
+            response = {'ok': False, 'error_code': status, 'description': str(e)}
+            if e.retry_after:
+                response['parameters'] = {'retry_after': e.retry_after}
+        data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections on shutdown are expected here
+        logger.debug(f"Error serving {client_address}", exc_info=True)
+
+
+class FakeTelegramServer:
+    """Serves a FakeBot over HTTP on a local port, adding `latency` seconds to every call but getUpdates."""
+
+    def __init__(self, bot=None, latency=0.0, host='127.0.0.1', port=0):
+        self.bot = bot or FakeBot()
+        self.latency = latency
+        self.httpd = _QuietHTTPServer((host, port), _BotAPIRequestHandler)
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+
+
+class BotProcess(subprocess.Popen):
+    """A bot script started by launch_bot; stop() ends it and removes the scratch directory it created."""
+
+    def __init__(self, args, workdir, remove_workdir, **kwargs):
+        super().__init__(args, cwd=workdir, **kwargs)
+        self.workdir = workdir
+        self.remove_workdir = remove_workdir
+
+    def stop(self, timeout=10.0):
+        if self.poll() is None:
+            self.terminate()
+            try:
+                self.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.kill()
+                self.wait()
+        if self.remove_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def launch_bot(server, script='bot.py', token='123456:FAKE', workdir=None, env=None):
+    """Starts a bot script as a subprocess talking to `server` instead of api.telegram.org.
+
+    The bot runs in `workdir` if given, so a restarted bot finds the databases the last one
+    left, and otherwise in a scratch directory that BotProcess.stop() removes. `env` adds
+    environment variables.
+    """
+    env = dict(os.environ, **(env or {}), TELEGRAM_API_URL=server.url, BOT_MODE='polling')
+    remove_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='psy_bot_')
+    repo = os.path.dirname(os.path.abspath(__file__))
+    # The bot reads token.txt, the question banks and the scoring rules from its working directory
+    for name in os.listdir(repo):
+        if name.endswith('.tsv') or name == 'scoring_rules.json':
+            shutil.copy(os.path.join(repo, name), workdir)
+    with open(os.path.join(workdir, 'token.txt'), 'w') as file:
+        file.write(token)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo, env.get('PYTHONPATH')]))
+    return BotProcess([sys.executable, os.path.join(repo, script)], workdir, remove_workdir, env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake Telegram Bot API server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls failing with 500")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="fraction of calls failing with 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--chat-limit', type=int, help="messages per second a chat may receive before 429s")
+    parser.add_argument('--global-limit', type=int, help="messages per second the bot may send before 429s")
+    args = parser.parse_args()
+
+    bot = FakeBot(args.error_rate, args.flood_rate, args.retry_after, chat_limit=args.chat_limit,
+                  global_limit=args.global_limit)
+    server = FakeTelegramServer(bot, args.latency, args.host, args.port).start()
+    print(f"Fake Bot API listening on {server.url}; point the bot at it with TELEGRAM_API_URL={server.url}")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# flow.py
+# The test flow shared by bot.py (python-telegram-bot's Dispatcher) and async_bot.py
+# (asyncio): what /start, a test pick, an answer tap, /cancel, /history and /stats do
+# to a user's data, and the texts sent back. The runtimes only route updates here and
+# make the Bot API calls.
+from datetime import datetime
+
+import config
+import metrics
+from catalog import current_catalog
+from history import format_history
+from keyboards import MENU_PATTERN, parse_answer
+from results_store import TIMESTAMP_FORMAT, Completion
+from scoring import explain_score
+from session import Session
+from session_manager import record_abandonment
+
+# Conversation states; END is python-telegram-bot's ConversationHandler.END. Between tests a
+# user has no state and no user_data, so nothing is kept for them; the menu's buttons start a
+# test from any state. State 0, the menu, is only found in conversations saved by older versions.
+END = -1
+SHOW_QUESTION = 1
+
+MENU_TEXT = 'Выберите тест:'
+CANCEL_TEXT = 'Test cancelled. Type /start to begin again.'
+STALE_TAP_TEXT = 'Этот тест уже завершён или прерван. Начните заново: /start'
+
+
+class TestFlow:
+    """Runs tests on the sessions kept in each user's user_data.
+
+    Finished and abandoned tests go to results_writer. With statistics (a
+    stats.ResultStatistics), finished tests also show their percentile and admins get /stats.
+    """
+
+    def __init__(self, results_writer, statistics=None):
+        self.results_writer = results_writer
+        self.statistics = statistics
+
+    def abandon(self, user_id, user_data, reason):
+        """Records the test in progress, if any, as left for `reason`, and clears the user's data."""
+        session = user_data.get('session')
+        if session is not None:
+            record_abandonment(self.results_writer, user_id, session, reason)
+        user_data.clear()
+
+    @staticmethod
+    def is_menu_choice(data):
+        return MENU_PATTERN.match(data or '') is not None
+
+    @staticmethod
+    def is_test(data):
+        return data in current_catalog().banks
+
+    def start_test(self, user_id, user_data, test_name):
+        """Replaces the user's session with a new one of test_name.
+
+        Returns the message id of the question the old session left on screen, or None.
+        """
+        old = user_data.get('session')
+        message_id = old.message_id if old is not None else None
+        self.abandon(user_id, user_data, 'switched')
+        # The session only keeps the test key, answers and catalog snapshot; questions come from the shared bank
+        user_data['session'] = Session(test_name)
+        metrics.test_started(test_name)
+        return message_id
+
+    @staticmethod
+    def record_answer(user_data, message_id, data):
+        """Records a tap on the current question's keyboard.
+
+        Returns False for double taps, redelivered callbacks and taps on old keyboards,
+        which are dropped.
+        """
+        session = user_data.get('session')
+        answer = parse_answer(data or '')
+        if session is None or answer is None or not session.accepts_answer(message_id, *answer):
+            return False
+        session.record_answer(answer[1])
+        return True
+
+    @staticmethod
+    def state(user_data):
+        """SHOW_QUESTION while a test is in progress, END between tests."""
+        return END if user_data.get('session') is None else SHOW_QUESTION
+
+    @staticmethod
+    def stale_conversations(conversations, user_data):
+        """Keys of the saved conversation states with no test in progress behind them."""
+        return [key for key, state in conversations.items()
+                if state != SHOW_QUESTION or 'session' not in user_data.get(key[1], {})]
+
+    @staticmethod
+    def next_question(session):
+        """(text, prebuilt reply_markup JSON) of the session's current question, or None once all are answered."""
+        index = session.current_question
+        if index >= len(session.questions):
+            return None
+        return session.questions[index].text, session.catalog.question_keyboard(session.test_name, index)
+
+    def finish_test(self, user_id, user_data):
+        """Saves the finished test, clears the user's data and returns the result message."""
+        session = user_data['session']
+        test_name = session.test_name
+        total_score = session.total_score()
+        # Scored under the rules the test started with
+        score_explanation = explain_score(test_name, session.answers, session.catalog.instruments)
+        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+        self.results_writer.write(Completion(user_id, test_name, timestamp, bytes(session.answers), total_score,
+                                             score_explanation, session.catalog.version))
+        metrics.test_completed(test_name)
+
+        # The result, with where the score falls among everyone's so far
+        result_message = f"ваш результат {test_name}: {total_score}\n{score_explanation}"
+        if self.statistics is not None:
+            ranking = self.statistics.percentile_text(test_name, total_score, config.PERCENTILE_MIN_COMPLETIONS)
+            if ranking:
+                result_message += f"\n{ranking}"
+        user_data.clear()
+        return result_message
+
+    def history_text(self, user_id):
+        """The /history reply; blocks while the results writer flushes."""
+        completions = self.results_writer.history(user_id, config.HISTORY_LENGTH + 1)
+        return format_history(completions, config.HISTORY_LENGTH)
+
+    def stats_text(self, user_id):
+        """The /stats reply for admins, or None; blocks while the results writer flushes."""
+        if user_id not in config.ADMIN_USER_IDS or self.statistics is None:
+            return None
+        # The aggregates follow the results writer, so flushing brings them up to date
+        self.results_writer.flush(5.0)
+        return self.statistics.report()
@@ -0,0 +1,22 @@
+# history.py
+# The /history reply: a user's latest results of each test, with the change in score
+# from the result before.
+from itertools import groupby
+
+from keyboards import TEST_TITLES
+
+
+def format_history(completions, per_test):
+    """Formats ResultsStore.history(user_id, per_test + 1) rows; the extra row only gives the oldest one's change."""
+    if not completions:
+        return "У вас пока нет завершённых тестов. Пройдите тест: /start"
+    lines = ["Ваши последние результаты:"]
+    for test_name, rows in groupby(completions, key=lambda completion: completion.test_name):
+        rows = list(rows)
+        lines.append('')
+        lines.append(f"{TEST_TITLES.get(test_name, test_name)}:")
+        for completion, previous in zip(rows[:per_test], rows[1:] + [None]):
+            change = '' if previous is None else f" ({completion.total_score - previous.total_score:+d})"
+            # Minutes are enough; seconds only clutter the list
+            lines.append(f"{completion.timestamp[:16]}  {completion.total_score}{change}")
+    return '\n'.join(lines)
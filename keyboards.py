@@ -0,0 +1,49 @@
+# keyboards.py
+import json
+import re
+from types import MappingProxyType
+
+
+# Test key -> button title in the test selection menu
+TEST_TITLES = {
+    'beck_depression': "тест депрессии Бека",
+    'beck_anxiety': "тест тревожности Бека",
+    'ptsd': "тест ПТСР",
+    'social_phobia': "тест социальных фобий"
+}
+
+
+def inline_keyboard(buttons):
+    """Serializes (text, callback_data) pairs, one button per row, into a reply_markup payload."""
+    keyboard = [[{'text': text, 'callback_data': callback_data}] for text, callback_data in buttons]
+    return json.dumps({'inline_keyboard': keyboard}, ensure_ascii=False)
+
+
+def answer_callback_data(question_index, option_index):
+    # The question index lets handlers tell a fresh tap from a double tap or a stale keyboard;
+    # which test session it belongs to comes from the message the keyboard is attached to
+    return f'{question_index}.{option_index}'
+
+
+def parse_answer(callback_data):
+    """(question index, option index) from an answer button's callback_data, or None."""
+    question, _, option = callback_data.partition('.')
+    if not (question.isdigit() and option.isdigit()):
+        return None
+    return int(question), int(option)
+
+
+def build_question_keyboards(banks):
+    return MappingProxyType({
+        test_name: tuple(inline_keyboard((option, answer_callback_data(question_index, option_index))
+                                         for option_index, option in enumerate(question.options))
+                         for question_index, question in enumerate(questions))
+        for test_name, questions in banks.items()
+    })
+
+
+# Built once at import, and the question keyboards once per catalog snapshot (see catalog.py);
+# the JSON strings are passed straight to the Bot API as reply_markup
+MENU_KEYBOARD = inline_keyboard((title, test_name) for test_name, title in TEST_TITLES.items())
+# Matches the callback_data of the menu's buttons
+MENU_PATTERN = re.compile('^(' + '|'.join(re.escape(test_name) for test_name in TEST_TITLES) + ')$')
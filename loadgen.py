@@ -0,0 +1,195 @@
+# loadgen.py
+# Synthetic load: N simulated users each pick a test from the /start menu, answer
+# every question with a think time and finish, against a bot running on the
+# local fake Bot API. Reports handler latency percentiles, throughput and errors.
+#
+#   python loadgen.py --users 200 --think-time 0.5 --script async_bot.py
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from collections import defaultdict
+
+from fake_telegram import FakeBot, FakeTelegramServer, callback_update, command_update, launch_bot
+from question_bank import QUESTION_BANKS
+from results_store import read_results_csv
+
+
+def load_score_distributions(filename='results.csv'):
+    """Historical total scores per test, to draw simulated users' scores from."""
+    scores = defaultdict(list)
+    try:
+        for completion in read_results_csv(filename):
+            scores[completion.test_name].append(completion.total_score)
+    except FileNotFoundError:
+        pass
+    return scores
+
+
+def draw_answers(rng, test_name, scores):
+    # Spread a total drawn from the test's historical scores over its questions
+    questions = QUESTION_BANKS[test_name]
+    limits = [len(question.options) - 1 for question in questions]
+    if not scores.get(test_name):
+        return [rng.randint(0, limit) for limit in limits]
+    target = min(rng.choice(scores[test_name]), sum(limits))
+    answers = [0] * len(limits)
+    open_items = [index for index, limit in enumerate(limits) if limit]
+    for _ in range(target):
+        index = rng.choice(open_items)
+        answers[index] += 1
+        if answers[index] == limits[index]:
+            open_items.remove(index)
+    return answers
+
+
+class LoadGenerator:
+    def __init__(self, bot, timeout=10.0):
+        self.bot = bot
+        self.timeout = timeout
+        self.latencies = []
+        self.requests = 0
+        self.errors = 0
+        self.completed = 0
+        self._waiting = {}
+        self._loop = None
+        bot.add_listener(self._on_call)
+
+    def _on_call(self, method, params, result):
+        # Called from the fake server's threads; a sent or edited message answers the user's last update
+        if method not in ('sendMessage', 'editMessageText'):
+            return
+        future = self._waiting.get(int(params['chat_id']))
+        if future is not None:
+            self._loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+    async def request(self, user_id, update):
+        future = self._loop.create_future()
+        self._waiting[user_id] = future
+        self.requests += 1
+        start = time.perf_counter()
+        self.bot.push_update(update)
+        try:
+            message = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            return None
+        finally:
+            self._waiting.pop(user_id, None)
+        self.latencies.append(time.perf_counter() - start)
+        return message
+
+    async def user(self, user_id, rng, scores, think_time):
+        menu = await self.request(user_id, command_update(None, user_id, '/start'))
+        if menu is None:
+            return
+        test_button = rng.choice(menu['reply_markup']['inline_keyboard'])[0]
+        message = await self.request(user_id, callback_update(None, user_id, test_button['callback_data'],
+                                                              menu['message_id']))
+        for answer in draw_answers(rng, test_button['callback_data'], scores):
+            if message is None or 'reply_markup' not in message:
+                return
+            await asyncio.sleep(rng.expovariate(1 / think_time) if think_time else 0)
+            button = message['reply_markup']['inline_keyboard'][answer][0]
+            message = await self.request(user_id, callback_update(None, user_id, button['callback_data'],
+                                                                  message['message_id']))
+        if message is not None and 'reply_markup' not in message:
+            self.completed += 1
+
+    async def run(self, users, think_time, ramp_up, scores, seed):
+        self._loop = asyncio.get_running_loop()
+        tasks = []
+        for user_id in range(1, users + 1):
+            tasks.append(asyncio.ensure_future(self.user(1000 + user_id, random.Random(seed + user_id),
+                                                         scores, think_time)))
+            if ramp_up:
+                await asyncio.sleep(ramp_up / users)
+        await asyncio.gather(*tasks)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1] if len(values) > 1 else values[0]
+
+
+async def wait_until_ready(generator, timeout):
+    # The bot process needs a moment to start polling
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await generator.request(1, command_update(None, 1, '/start')) is not None:
+            generator.latencies.clear()
+            generator.requests = generator.errors = 0
+            return True
+    return False
+
+
+async def run_load(args):
+    bot = FakeBot(args.error_rate, args.flood_rate, seed=args.seed)
+    server = FakeTelegramServer(bot, args.latency).start()
+    process = launch_bot(server, args.script)
+    generator = LoadGenerator(bot, args.timeout)
+    generator._loop = asyncio.get_running_loop()
+    try:
+        if not await wait_until_ready(generator, 30):
+            raise SystemExit(f"{args.script} did not answer /start against the fake API")
+        start = time.perf_counter()
+        await generator.run(args.users, args.think_time, args.ramp_up, load_score_distributions(args.results),
+                            args.seed)
+        elapsed = time.perf_counter() - start
+    finally:
+        process.stop()
+        server.stop()
+
+    latencies_ms = [latency * 1000 for latency in generator.latencies]
+    return {
+        'script': args.script,
+        'users': args.users,
+        'completed_tests': generator.completed,
+        'requests': generator.requests,
+        'errors': generator.errors,
+        'error_rate': generator.errors / generator.requests if generator.requests else 0.0,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_updates_per_s': round(generator.requests / elapsed, 1),
+        'throughput_tests_per_s': round(generator.completed / elapsed, 2),
+        'latency_ms': {
+            'p50': round(percentile(latencies_ms, 50), 2),
+            'p95': round(percentile(latencies_ms, 95), 2),
+            'p99': round(percentile(latencies_ms, 99), 2),
+            'max': round(max(latencies_ms, default=0.0), 2),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay simulated test sessions against the bot on a fake Bot API.")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--think-time', type=float, default=0.5, help="mean seconds between answers")
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="seconds over which users arrive")
+    parser.add_argument('--script', default='bot.py', help="bot entry point: bot.py or async_bot.py")
+    parser.add_argument('--latency', type=float, default=0.05, help="fake Bot API latency per call, seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=10.0, help="seconds to wait for the bot's reply")
+    parser.add_argument('--results', default='results.csv', help="historical results to draw scores from")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    latency = report['latency_ms']
+    print(f"{report['script']}: {report['users']} users, {report['completed_tests']} tests completed "
+          f"in {report['elapsed_s']} s")
+    print(f"throughput: {report['throughput_updates_per_s']} updates/s, {report['throughput_tests_per_s']} tests/s")
+    print(f"handler latency: p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+          f"max {latency['max']} ms")
+    print(f"errors: {report['errors']} of {report['requests']} ({report['error_rate']:.2%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+# metrics.py
+# In-process counters, gauges and histograms, exposed in the Prometheus text format
+# on a local /metrics endpoint:
+#
+#   METRICS_PORT=9100 python bot.py
+#   curl http://127.0.0.1:9100/metrics
+#
+# Recording a value takes a lock and a couple of additions, so instrumentation stays on.
+import asyncio
+import functools
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds; Bot API round trips are tens to hundreds of milliseconds, handlers far less
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _CounterValue:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class _GaugeValue(_CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount=1, floor=None):
+        with self._lock:
+            self.value -= amount
+            if floor is not None and self.value < floor:
+                self.value = floor
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bucket plus the +Inf overflow; made cumulative only when exposed
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', (('le', _format_value(bound)),), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+
+class Metric:
+    """A named metric; with labelnames, values are kept per label combination via labels()."""
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        self._value = None if self.labelnames else self.labels()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        value = self._values.get(values)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(values, self._new_value())
+        return value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for label_values, value in sorted(self._values.items()):
+            labels = tuple(zip(self.labelnames, label_values))
+            for suffix, extra_labels, sample in value.samples():
+                lines.append(f'{self.name}{suffix}{_format_labels(labels + extra_labels)} {_format_value(sample)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._value.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self._value.inc(amount)
+
+    def dec(self, amount=1, floor=None):
+        """Decrements the gauge, but not below floor if one is given."""
+        self._value.dec(amount, floor)
+
+    def set(self, value):
+        self._value.set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._value.observe(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def expose(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = Histogram('psy_bot_handler_seconds', 'Time spent handling an update, by handler.', ('handler',))
+API_CALL_SECONDS = Histogram('psy_bot_api_call_seconds', 'Duration of Telegram Bot API calls, by method.', ('method',))
+API_ERRORS = Counter('psy_bot_api_errors_total', 'Telegram Bot API calls that failed, by method.', ('method',))
+TESTS_STARTED = Counter('psy_bot_tests_started_total', 'Tests started, by test.', ('test',))
+TESTS_COMPLETED = Counter('psy_bot_tests_completed_total', 'Tests answered to the end, by test.', ('test',))
+TESTS_ABANDONED = Counter('psy_bot_tests_abandoned_total', 'Tests left unfinished by /start, /cancel, '
+                          'picking another test or going idle, by test.', ('test',))
+# Counted by each process from the tests it starts and ends. With replicas sharing a session store
+# a test can end on another replica than the one it started on, so the value is only a rough
+# per-replica figure there, and is kept from going negative
+ACTIVE_SESSIONS = Gauge('psy_bot_active_sessions', 'Tests in progress, as counted by this process from '
+                        'the tests it started and ended; approximate with a shared session store.')
+SESSIONS_EVICTED = Counter('psy_bot_sessions_evicted_total', 'Sessions dropped after SESSION_IDLE_TTL seconds '
+                           'without an update.')
+SESSION_CONFLICTS = Counter('psy_bot_session_conflicts_total', 'Updates whose session changes were dropped '
+                            'because another replica saved the same user first.')
+CALLBACKS_DROPPED = Counter('psy_bot_callbacks_dropped_total', 'Answer taps ignored as duplicate, stale or '
+                            'invalid.')
+OUTBOUND_QUEUE_DEPTH = Gauge('psy_bot_outbound_queue_depth', 'Messages and edits waiting in the outbound queue.')
+OUTBOUND_WAIT_SECONDS = Histogram('psy_bot_outbound_wait_seconds', 'Time a queued call waited for the rate limits.')
+OUTBOUND_COALESCED = Counter('psy_bot_outbound_coalesced_total', 'Queued edits replaced by a newer edit of the '
+                             'same message before being sent.')
+OUTBOUND_RETRIES = Counter('psy_bot_outbound_retries_total', 'Calls retried after a 429, by method.', ('method',))
+CATALOG_RELOADS = Counter('psy_bot_catalog_reloads_total', 'Reloads of edited question banks or scoring rules, '
+                          "by outcome ('ok', or 'failed' when the edit didn't validate).", ('outcome',))
+
+
+def test_started(test_name):
+    TESTS_STARTED.labels(test_name).inc()
+    ACTIVE_SESSIONS.inc()
+
+
+def test_completed(test_name):
+    TESTS_COMPLETED.labels(test_name).inc()
+    ACTIVE_SESSIONS.dec(floor=0)
+
+
+def test_abandoned(test_name):
+    TESTS_ABANDONED.labels(test_name).inc()
+    ACTIVE_SESSIONS.dec(floor=0)
+
+
+def timed(histogram, *label_values):
+    """Decorator recording the duration of every call, for plain functions and coroutines."""
+    value = histogram.labels(*label_values)
+
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_coroutine(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    value.observe(perf_counter() - start)
+            return timed_coroutine
+
+        @functools.wraps(func)
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                value.observe(perf_counter() - start)
+        return timed_function
+    return decorate
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer:
+    """Serves a registry on GET /metrics from a background thread."""
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9100):
+        self.httpd = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-http', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
@@ -0,0 +1,233 @@
+# outbound.py
+# Outbound queue for Bot API calls that post to a chat. It keeps new messages under
+# Telegram's per-chat and global flood limits, merges queued edits of the same message
+# and retries 429s after the advertised retry_after.
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from bot_api import BotAPIMethods
+
+logger = logging.getLogger(__name__)
+
+# Calls that must reach a chat in order
+QUEUED_METHODS = frozenset({'sendMessage', 'editMessageText', 'deleteMessage'})
+# Calls paced to the rate limits by default. Telegram's flood limits are on new messages;
+# edits of the bot's own message in a private chat (every answer tap) would otherwise wait
+# a second each once the burst is used up. Unpaced calls still back off after a 429.
+RATE_LIMITED_METHODS = frozenset({'sendMessage'})
+
+
+class RateLimiter:
+    """Generic cell rate algorithm: `rate` calls per second on average, up to `burst` back to back.
+
+    reserve() books the next slot and returns how long to wait for it, so waiters are
+    served in the order they reserved without polling.
+    """
+    __slots__ = ('interval', 'tolerance', 'next_slot')
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.next_slot = 0.0
+
+    def reserve(self, now):
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        return max(slot - self.tolerance - now, 0.0)
+
+    def delay(self, now):
+        """How long a call would wait for a slot, without booking one."""
+        return max(self.next_slot - self.tolerance - now, 0.0)
+
+    def pause(self, now, seconds):
+        # After a 429 nothing may go out before retry_after, burst allowance included
+        self.next_slot = max(self.next_slot, now + seconds + self.tolerance)
+
+    def idle(self, now):
+        """True once a fresh limiter would behave the same, so this one can be dropped."""
+        return self.next_slot <= now
+
+
+class _Request:
+    __slots__ = ('method', 'params', 'futures', 'queued_at')
+
+    def __init__(self, method, params, future):
+        self.method = method
+        self.params = params
+        self.futures = [future]
+        self.queued_at = time.perf_counter()
+
+    def edits_same_message(self, method, params):
+        return (method == self.method == 'editMessageText'
+                and params.get('message_id') == self.params.get('message_id')
+                and params.get('inline_message_id') == self.params.get('inline_message_id'))
+
+    def resolve(self, result=None, error=None):
+        for future in self.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+
+class OutboundQueue(BotAPIMethods):
+    """Wraps a BotAPIMethods client, sending QUEUED_METHODS through per-chat queues.
+
+    Each chat's calls go out one at a time and in order; limited_methods among them also
+    wait for the chat's rate limit and the global one, and the rest only for a 429's
+    retry_after. An edit queued right behind an unsent edit of the same message
+    replaces it, and everyone waiting on either gets the result of the newer one.
+    Other methods pass straight through.
+    """
+
+    def __init__(self, api, global_rate=30.0, chat_rate=1.0, chat_burst=5, max_retries=5,
+                 limited_methods=RATE_LIMITED_METHODS):
+        self.api = api
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.limited_methods = limited_methods
+        self._global = RateLimiter(global_rate)
+        self._chats = {}  # chat_id -> deque of unsent _Requests; present while the chat's worker runs
+        self._limiters = {}  # chat_id -> RateLimiter, kept until it has fully recovered
+        self._workers = set()
+
+    async def call(self, method, **params):
+        if method not in QUEUED_METHODS:
+            return await self.api.call(method, **params)
+        future = asyncio.get_running_loop().create_future()
+        chat_id = params['chat_id']
+        pending = self._chats.get(chat_id)
+        if pending is None:
+            pending = self._chats[chat_id] = deque()
+            worker = asyncio.ensure_future(self._drain(chat_id, pending))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        if pending and pending[-1].edits_same_message(method, params):
+            pending[-1].params = params
+            pending[-1].futures.append(future)
+            metrics.OUTBOUND_COALESCED.inc()
+        else:
+            pending.append(_Request(method, params, future))
+            metrics.OUTBOUND_QUEUE_DEPTH.inc()
+        return await future
+
+    async def close(self):
+        """Sends whatever is still queued, then closes the wrapped client."""
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        await self.api.close()
+
+    async def _drain(self, chat_id, pending):
+        limiter = self._limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._limiters[chat_id] = RateLimiter(self.chat_rate, self.chat_burst)
+        request = None
+        try:
+            while pending:
+                # The head stays queued while it waits, so newer edits can still replace it
+                if pending[0].method in self.limited_methods:
+                    await self._wait(limiter.reserve(time.monotonic()))
+                    await self._wait(self._global.reserve(time.monotonic()))
+                else:
+                    await self._wait(limiter.delay(time.monotonic()))
+                request = pending.popleft()
+                metrics.OUTBOUND_QUEUE_DEPTH.dec()
+                metrics.OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - request.queued_at)
+                await self._send(limiter, request)
+                request = None
+        finally:
+            # Only reached with work left if the worker was cancelled
+            del self._chats[chat_id]
+            if request is not None:
+                request.cancel()
+            for request in pending:
+                metrics.OUTBOUND_QUEUE_DEPTH.dec()
+                request.cancel()
+            if limiter.idle(time.monotonic()):
+                del self._limiters[chat_id]
+            self._prune_limiters()
+
+    async def _send(self, limiter, request):
+        for attempt in itertools.count():
+            try:
+                result = await self.api.call(request.method, **request.params)
+            except Exception as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if not retry_after or attempt >= self.max_retries:
+                    request.resolve(error=e)
+                    return
+                metrics.OUTBOUND_RETRIES.labels(request.method).inc()
+                logger.warning(f"Flood limit on {request.method}, retrying in {retry_after} s")
+                limiter.pause(time.monotonic(), retry_after)
+                await asyncio.sleep(retry_after)
+                continue
+            request.resolve(result)
+            return
+
+    @staticmethod
+    async def _wait(delay):
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _prune_limiters(self):
+        # Chats that went quiet leave limiters behind; sweep them once they outnumber active chats
+        if len(self._limiters) < 2 * len(self._chats) + 1024:
+            return
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, limiter in self._limiters.items()
+                        if chat_id not in self._chats and limiter.idle(now)]:
+            del self._limiters[chat_id]
+
+
+class _BlockingAPI(BotAPIMethods):
+    """Runs a blocking post(method, params) on a thread pool, for bot.py's synchronous client."""
+
+    def __init__(self, post, workers):
+        self.post = post
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbound')
+
+    async def call(self, method, **params):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.post, method, params)
+
+    async def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class OutboundThread:
+    """An OutboundQueue on its own event loop thread, for callers that block on each call.
+
+    `post(method, params)` performs one Bot API call and raises on failure; exceptions
+    carrying a retry_after attribute are retried like 429s.
+    """
+
+    def __init__(self, post, workers=8, **queue_kwargs):
+        self.queue = OutboundQueue(_BlockingAPI(post, workers), **queue_kwargs)
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop.run_forever, name='outbound', daemon=True)
+        self._thread.start()
+        return self
+
+    def call(self, method, **params):
+        return asyncio.run_coroutine_threadsafe(self.queue.call(method, **params), self._loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.queue.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,62 @@
+# persistence.py
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from session_database import SessionDatabase
+
+
+class SqliteSessionPersistence(BasePersistence):
+    """Keeps test sessions and conversation states in a SessionDatabase so a restart resumes
+    in-progress tests.
+
+    The dispatcher reports every user_data change; only the users that changed are
+    written, at most once per flush_interval, from a background thread.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.database = SessionDatabase(path, flush_interval)
+        # The user_data handed to the dispatcher by get_user_data
+        self.user_data = {}
+
+    # Sessions are written as rows, never pickled, so there is no Bot to strip out or put
+    # back; skipping the walk also spares copying every Session and its catalog per update
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def insert_bot(self, obj):
+        return obj
+
+    def get_user_data(self):
+        self.user_data = self.database.load_user_data()
+        return self.user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return self.database.load_conversations(name)
+
+    def update_conversation(self, name, key, new_state):
+        self.database.save_conversation(name, key, new_state)
+
+    def update_user_data(self, user_id, data):
+        self.database.save_user_data(user_id, data)
+        if not data:
+            # Nothing is kept between tests; the dispatcher recreates the entry when the user
+            # comes back
+            self.user_data.pop(user_id, None)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        self.database.flush()
@@ -0,0 +1,221 @@
+# question_bank.py
+# Question banks. The TSV sources (a numbered question, then its answer options, per
+# row) are validated and compiled into one binary file by the build step:
+#
+#   python question_bank.py            # writes question_banks.bin, fails on a bad TSV
+#   python question_bank.py --check    # validates only
+#
+# At startup the bot reads the compiled file in one go; without it, or if a TSV is
+# newer, it parses the TSVs with the same checks.
+import argparse
+import logging
+import os
+import re
+import struct
+import sys
+import zlib
+from types import MappingProxyType
+from typing import NamedTuple, Tuple
+
+from scoring import INSTRUMENTS, SCORING_RULES_FILE
+
+logger = logging.getLogger(__name__)
+
+# Test key -> question bank file, in the order the tests are offered to the user
+TEST_FILES = {
+    'beck_depression': 'Becks_depress.tsv',
+    'beck_anxiety': 'Becks_anxiety.tsv',
+    'ptsd': 'post_Traumatic_PCL-5.tsv',
+    'social_phobia': 'social_Phobia_SPIN.tsv'
+}
+
+BANKS_FILE = 'question_banks.bin'
+
+# Compiled layout, little-endian:
+#   header     magic, format version, tests, questions, strings, CRC-32 of everything after the header
+#   tests      per test: name string, first question, question count
+#   questions  per question: text string, first option string, option count
+#   offsets    strings + 1 offsets into the decoded text, so string i is text[offsets[i]:offsets[i + 1]]
+#   text       every string back to back, UTF-8 encoded and decoded in one call
+MAGIC = b'PSQB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHIII')
+TEST_ENTRY = struct.Struct('<IIH')
+QUESTION_ENTRY = struct.Struct('<IIH')
+
+# "1 Как часто..." or "1. Бывает ли..."
+QUESTION_NUMBER = re.compile(r'(\d+)\.?(?:\s|$)')
+
+
+class Question(NamedTuple):
+    text: str
+    options: Tuple[str, ...]
+
+
+class BankError(ValueError):
+    """A question bank that must not ship; the message lists every problem found."""
+
+
+def load_test_questions(filename, instrument=None):
+    """Parses and validates a TSV question bank into a tuple of immutable questions.
+
+    Questions must be numbered 1, 2, ... with no empty fields and the same number of
+    options throughout. Given its scoring Instrument, the bank must also have exactly
+    its items, each with one option per possible item score.
+    """
+    questions = []
+    errors = []
+    last_number = 0
+    with open(filename, 'r', encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            parts = line.strip().split('\t')
+            if not parts[0]:
+                continue
+            where = f"{filename}:{line_number}"
+            number = QUESTION_NUMBER.match(parts[0])
+            if number is None or int(number.group(1)) != last_number + 1:
+                errors.append(f"{where}: expected question {last_number + 1}, got {parts[0][:40]!r}")
+            # Carry on from the number found, so one missing row is reported once
+            last_number = int(number.group(1)) if number else last_number + 1
+            if len(parts) < 3:
+                errors.append(f"{where}: {len(parts)} fields, expected a question and at least two options")
+            if not all(part.strip() for part in parts):
+                errors.append(f"{where}: empty field")
+            if questions and len(parts) - 1 != len(questions[0].options):
+                errors.append(f"{where}: {len(parts) - 1} options, the first question has {len(questions[0].options)}")
+            questions.append(Question(parts[0], tuple(parts[1:])))
+    if instrument is not None:
+        options = instrument.max_item_score - instrument.min_item_score + 1
+        if len(questions) != instrument.items:
+            errors.append(f"{filename}: {len(questions)} questions, {instrument.title} has {instrument.items}")
+        if questions and len(questions[0].options) != options:
+            errors.append(f"{filename}: {len(questions[0].options)} options per question, {instrument.title} "
+                          f"scores items {instrument.min_item_score}-{instrument.max_item_score}")
+    if errors:
+        raise BankError('\n'.join(errors))
+    return tuple(questions)
+
+
+def parse_all_banks(test_files=TEST_FILES, instruments=INSTRUMENTS):
+    """Validates every bank against its scoring rules; raises BankError listing the problems of all of them."""
+    banks = {}
+    errors = []
+    for test_name, filename in test_files.items():
+        instrument = instruments.get(test_name)
+        if instrument is None:
+            errors.append(f"{filename}: no scoring rules for {test_name!r} in {SCORING_RULES_FILE}")
+        try:
+            banks[test_name] = load_test_questions(filename, instrument)
+        except (BankError, OSError) as e:
+            errors.append(str(e))
+    if errors:
+        raise BankError('\n'.join(errors))
+    return banks
+
+
+def compile_banks(banks):
+    """The compiled file's bytes for a {test_name: questions} mapping."""
+    strings = []
+    tests = []
+    questions = []
+    for test_name, bank in banks.items():
+        tests.append((len(strings), len(questions), len(bank)))
+        strings.append(test_name)
+        for question in bank:
+            questions.append((len(strings), len(strings) + 1, len(question.options)))
+            strings.append(question.text)
+            strings.extend(question.options)
+    offsets = [0]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    body = b''.join([
+        *(TEST_ENTRY.pack(*test) for test in tests),
+        *(QUESTION_ENTRY.pack(*question) for question in questions),
+        struct.pack(f'<{len(offsets)}I', *offsets),
+        ''.join(strings).encode('utf-8'),
+    ])
+    return HEADER.pack(MAGIC, FORMAT_VERSION, len(tests), len(questions), len(strings), zlib.crc32(body)) + body
+
+
+def read_compiled_banks(filename=BANKS_FILE):
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if len(data) < HEADER.size:
+        raise BankError(f"{filename}: truncated")
+    magic, version, test_count, question_count, string_count, checksum = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise BankError(f"{filename}: not a version {FORMAT_VERSION} question bank file")
+    if zlib.crc32(memoryview(data)[HEADER.size:]) != checksum:
+        raise BankError(f"{filename}: checksum mismatch")
+    position = HEADER.size
+    tests = list(TEST_ENTRY.iter_unpack(data[position:position + test_count * TEST_ENTRY.size]))
+    position += test_count * TEST_ENTRY.size
+    entries = list(QUESTION_ENTRY.iter_unpack(data[position:position + question_count * QUESTION_ENTRY.size]))
+    position += question_count * QUESTION_ENTRY.size
+    offsets = struct.unpack_from(f'<{string_count + 1}I', data, position)
+    text = data[position + (string_count + 1) * 4:].decode('utf-8')
+    strings = [text[start:end] for start, end in zip(offsets, offsets[1:])]
+    banks = {}
+    for name, first, count in tests:
+        banks[strings[name]] = tuple(
+            Question(strings[text_index], tuple(strings[option:option + options]))
+            for text_index, option, options in entries[first:first + count])
+    return banks
+
+
+def _compiled_is_current(filename, test_files):
+    try:
+        compiled = os.stat(filename).st_mtime
+    except FileNotFoundError:
+        return False
+    sources = [os.stat(source).st_mtime for source in test_files.values()]
+    sources.append(os.stat(SCORING_RULES_FILE).st_mtime)
+    if max(sources) > compiled:
+        logger.warning(f"{filename} is older than its sources; parsing the TSVs. Run `python question_bank.py`.")
+        return False
+    return True
+
+
+def load_all_banks(test_files=TEST_FILES, compiled=BANKS_FILE):
+    if _compiled_is_current(compiled, test_files):
+        banks = read_compiled_banks(compiled)
+        if list(banks) == list(test_files):
+            return MappingProxyType(banks)
+        logger.warning(f"{compiled} holds other tests than TEST_FILES; parsing the TSVs")
+    return MappingProxyType(parse_all_banks(test_files))
+
+
+# Loaded once at import and shared read-only by every session; the build step
+# validates the TSVs itself rather than failing on them here
+QUESTION_BANKS = load_all_banks() if __name__ != '__main__' else None
+
+
+def get_questions(test_name):
+    return QUESTION_BANKS[test_name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the TSV question banks and compile them into one file.")
+    parser.add_argument('--output', default=BANKS_FILE)
+    parser.add_argument('--check', action='store_true', help="only validate the banks")
+    args = parser.parse_args()
+
+    try:
+        banks = parse_all_banks()
+    except BankError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    questions = sum(len(bank) for bank in banks.values())
+    if args.check:
+        print(f"{len(banks)} banks, {questions} questions: ok")
+        return
+    data = compile_banks(banks)
+    # Write then rename, so a running bot never reads a half-written file
+    with open(f'{args.output}.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(f'{args.output}.tmp', args.output)
+    print(f"Compiled {len(banks)} banks, {questions} questions into {args.output} ({len(data)} bytes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+# results_store.py
+import argparse
+import ast
+import csv
+import io
+import os
+import sqlite3
+import threading
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import NamedTuple
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Results per user and test that CsvResultsStore keeps in its history index unless told otherwise;
+# the bots pass their /history length plus one (see history.format_history)
+HISTORY_DEPTH = 10
+
+
+class Completion(NamedTuple):
+    user_id: int
+    test_name: str
+    timestamp: str
+    answers: bytes  # one byte per question, in question order
+    total_score: int
+    explanation: str
+    version: str = ''  # catalog version (see catalog.py) the test was taken and scored under
+
+
+class Abandonment(NamedTuple):
+    user_id: int
+    test_name: str
+    timestamp: str
+    answered: int  # questions answered before the test was left
+    reason: str  # 'restarted', 'switched', 'cancelled' or 'expired'
+
+
+class ResultsStore:
+    def add_many(self, rows):
+        """Saves a batch of Completion rows, possibly mixed with Abandonment rows."""
+        raise NotImplementedError
+
+    def add(self, completion):
+        self.add_many([completion])
+
+    def history(self, user_id, per_test):
+        """The user's latest `per_test` completions of each test, by test name and then newest first."""
+        raise NotImplementedError
+
+    def preload(self):
+        """Reads whatever the store serves from memory, so the first request doesn't wait for it."""
+
+    def completions_since(self, position):
+        """(new position, completions) for a batch of completions written after `position`.
+
+        Positions only grow, start at 0 and mean nothing outside the store; an empty batch
+        at an unchanged position means everything written so far has been read.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CsvResultsStore(ResultsStore):
+    """Appends completions in bot.py's row format: user_id, test, timestamp, answers..., score, explanation,
+    catalog version.
+
+    Abandonments go to a sibling <name>_abandoned.csv as user_id, test, timestamp, answered, reason.
+    history() is served from an in-memory index of each user's last history_depth results per
+    test, read from the file by preload() or on first use and kept up to date by add_many().
+    A history() call asking for more than history_depth results rebuilds the index deeper.
+    """
+
+    def __init__(self, filename, fsync=True, history_depth=HISTORY_DEPTH):
+        self.filename = filename
+        self.abandoned_filename = f'{os.path.splitext(filename)[0]}_abandoned.csv'
+        self.fsync = fsync
+        self.history_depth = history_depth
+        self._index = None  # user_id -> test_name -> deque of completions, oldest first
+        self._lock = threading.Lock()
+
+    def add_many(self, rows):
+        completions = io.StringIO()
+        abandonments = io.StringIO()
+        completion_writer = csv.writer(completions)
+        abandonment_writer = csv.writer(abandonments)
+        for row in rows:
+            if isinstance(row, Abandonment):
+                abandonment_writer.writerow(row)
+            else:
+                completion_writer.writerow([row.user_id, row.test_name, row.timestamp] + list(row.answers)
+                                           + [row.total_score, row.explanation, row.version])
+        with self._lock:
+            self._append(self.filename, completions.getvalue())
+            self._append(self.abandoned_filename, abandonments.getvalue())
+            if self._index is not None:
+                for row in rows:
+                    if not isinstance(row, Abandonment):
+                        self._index_completion(row)
+
+    def preload(self):
+        with self._lock:
+            self._load_index()
+
+    def history(self, user_id, per_test):
+        with self._lock:
+            if per_test > self.history_depth:
+                self.history_depth = per_test
+                self._index = None
+            self._load_index()
+            tests = self._index.get(user_id, {})
+            return [completion for test_name in sorted(tests)
+                    for completion in list(reversed(tests[test_name]))[:per_test]]
+
+    def completions_since(self, position, chunk_size=1 << 20):
+        # Positions are byte offsets; a line still being appended is left for the next call
+        try:
+            with open(self.filename, 'rb') as file:
+                file.seek(position)
+                data = file.read(chunk_size)
+        except FileNotFoundError:
+            return position, []
+        end = data.rfind(b'\n') + 1
+        if not end and len(data) == chunk_size:
+            raise ValueError(f"{self.filename}: line at byte {position} is longer than {chunk_size} bytes")
+        lines = io.StringIO(data[:end].decode('utf-8'), newline='')
+        return position + end, list(parse_results_rows(csv.reader(lines)))
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = defaultdict(dict)
+            if os.path.exists(self.filename):
+                for completion in read_results_csv(self.filename):
+                    self._index_completion(completion)
+
+    def _index_completion(self, completion):
+        tests = self._index[completion.user_id]
+        if completion.test_name not in tests:
+            tests[completion.test_name] = deque(maxlen=self.history_depth)
+        tests[completion.test_name].append(completion)
+
+    def _append(self, filename, data):
+        if not data:
+            return
+        with open(filename, 'a', newline='', encoding='utf-8') as file:
+            file.write(data)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    test_name TEXT NOT NULL,
+    completed_at TEXT NOT NULL,
+    answers BLOB NOT NULL,
+    total_score INTEGER NOT NULL,
+    explanation TEXT NOT NULL,
+    version TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS completions_user ON completions (user_id, test_name, completed_at);
+CREATE INDEX IF NOT EXISTS completions_test ON completions (test_name, completed_at);
+CREATE INDEX IF NOT EXISTS completions_time ON completions (completed_at);
+CREATE TABLE IF NOT EXISTS abandonments (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    test_name TEXT NOT NULL,
+    abandoned_at TEXT NOT NULL,
+    answered INTEGER NOT NULL,
+    reason TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS abandonments_test ON abandonments (test_name, abandoned_at);
+"""
+
+INSERT_COMPLETION = """
+INSERT INTO completions (user_id, test_name, completed_at, answers, total_score, explanation, version)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# The user's tests, then each one's latest rows; both walk the completions_user index
+SELECT_USER_TESTS = 'SELECT DISTINCT test_name FROM completions WHERE user_id = ? ORDER BY test_name'
+SELECT_HISTORY = """
+SELECT user_id, test_name, completed_at, answers, total_score, explanation, version FROM completions
+WHERE user_id = ? AND test_name = ? ORDER BY completed_at DESC, id DESC LIMIT ?
+"""
+
+SELECT_SINCE = """
+SELECT id, user_id, test_name, completed_at, answers, total_score, explanation, version FROM completions
+WHERE id > ? ORDER BY id LIMIT ?
+"""
+
+INSERT_ABANDONMENT = """
+INSERT INTO abandonments (user_id, test_name, abandoned_at, answered, reason)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+
+class SqliteResultsStore(ResultsStore):
+    """One row per completion, and per abandoned test, in a WAL-mode SQLite database."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        if 'version' not in [column[1] for column in self._conn.execute('PRAGMA table_info(completions)')]:
+            # Databases from before catalog versions; their completions keep an empty version
+            self._conn.execute("ALTER TABLE completions ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+
+    def add_many(self, rows):
+        completions = [row for row in rows if not isinstance(row, Abandonment)]
+        abandonments = [row for row in rows if isinstance(row, Abandonment)]
+        with self._lock, self._conn:
+            self._conn.executemany(INSERT_COMPLETION, completions)
+            if abandonments:
+                self._conn.executemany(INSERT_ABANDONMENT, abandonments)
+
+    def history(self, user_id, per_test):
+        with self._lock:
+            tests = [test_name for test_name, in self._conn.execute(SELECT_USER_TESTS, (user_id,))]
+            return [Completion(*row) for test_name in tests
+                    for row in self._conn.execute(SELECT_HISTORY, (user_id, test_name, per_test))]
+
+    def completions_since(self, position, batch_size=10000):
+        # Positions are row ids, which only grow
+        with self._lock:
+            rows = self._conn.execute(SELECT_SINCE, (position, batch_size)).fetchall()
+        return (rows[-1][0] if rows else position), [Completion(*row[1:]) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_results_store(path, history_depth=HISTORY_DEPTH):
+    """Picks the backend from the file extension: .db/.sqlite is SQLite, anything else CSV."""
+    if os.path.splitext(path)[1] in ('.db', '.sqlite', '.sqlite3'):
+        return SqliteResultsStore(path)
+    return CsvResultsStore(path, history_depth=history_depth)
+
+
+def _is_timestamp(value):
+    try:
+        datetime.strptime(value, TIMESTAMP_FORMAT)
+    except ValueError:
+        return False
+    return True
+
+
+def _parse_answers(value):
+    # Either "0,1,2,..." or a repr'd dict "{1: 0, 2: 1, ...}"
+    value = value.strip()
+    if not value:
+        return b''
+    if value.startswith('{'):
+        answers = ast.literal_eval(value)
+        return bytes(answers[q] for q in sorted(answers))
+    return bytes(int(v) for v in value.split(','))
+
+
+def parse_results_row(row):
+    """Normalizes one row of the historical results.csv, or returns None for rows that can't be read."""
+    if len(row) < 3 or not row[0].isdigit():
+        return None
+    user_id = int(row[0])
+    if _is_timestamp(row[1]):
+        # Rows without a test column come from the single-test bots, which only ran Beck depression
+        if len(row) == 3:
+            # user_id, timestamp, score
+            return Completion(user_id, 'beck_depression', row[1], b'', int(row[2]), '')
+        if len(row) == 4:
+            # user_id, timestamp, score, answers
+            return Completion(user_id, 'beck_depression', row[1], _parse_answers(row[3]), int(row[2]), '')
+        if len(row) == 5:
+            # user_id, timestamp, test_name, score, answers
+            return Completion(user_id, row[2] or 'unknown', row[1], _parse_answers(row[4]), int(row[3]), '')
+        return None
+    if not _is_timestamp(row[2]):
+        return None
+    if len(row) == 4:
+        # user_id, test, timestamp, score
+        return Completion(user_id, row[1], row[2], b'', int(row[3]), '')
+    if row[-2].lstrip('-').isdigit():
+        # user_id, test, timestamp, answers..., score, explanation
+        return Completion(user_id, row[1], row[2], bytes(int(v) for v in row[3:-2]), int(row[-2]), row[-1])
+    # user_id, test, timestamp, answers..., score, explanation, catalog version
+    return Completion(user_id, row[1], row[2], bytes(int(v) for v in row[3:-3]), int(row[-3]), row[-2], row[-1])
+
+
+def parse_results_rows(rows):
+    previous = None
+    for row in rows:
+        try:
+            completion = parse_results_row(row)
+        except (ValueError, SyntaxError, KeyError):
+            completion = None
+        # bot2.py used to write every row twice
+        if completion is None or completion == previous:
+            continue
+        previous = completion
+        yield completion
+
+
+def read_results_csv(filename):
+    with open(filename, newline='', encoding='utf-8') as file:
+        yield from parse_results_rows(csv.reader(file))
+
+
+def completion_keys(store):
+    """(user_id, test_name, timestamp) of every completion in the store."""
+    keys = set()
+    position = 0
+    while True:
+        new_position, completions = store.completions_since(position)
+        keys.update(completion[:3] for completion in completions)
+        if new_position == position:
+            return keys
+        position = new_position
+
+
+def import_results_csv(filename, store, batch_size=1000):
+    """Adds the file's completions that the store doesn't have yet, matched on (user_id,
+    test_name, timestamp), so importing the same file again adds nothing.
+
+    Returns (imported, skipped).
+    """
+    existing = completion_keys(store)
+    imported = skipped = 0
+    batch = []
+    for completion in read_results_csv(filename):
+        key = completion[:3]
+        if key in existing:
+            skipped += 1
+            continue
+        existing.add(key)
+        batch.append(completion)
+        if len(batch) >= batch_size:
+            store.add_many(batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        store.add_many(batch)
+        imported += len(batch)
+    return imported, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the historical results.csv into a results store.")
+    parser.add_argument('source', nargs='?', default='results.csv')
+    parser.add_argument('target', nargs='?', default='results.db')
+    args = parser.parse_args()
+
+    store = open_results_store(args.target)
+    try:
+        imported, skipped = import_results_csv(args.source, store)
+    finally:
+        store.close()
+    print(f"Imported {imported} completions from {args.source} into {args.target}, "
+          f"skipped {skipped} already there")
+
+
+if __name__ == '__main__':
+    main()
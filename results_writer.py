@@ -0,0 +1,175 @@
+# results_writer.py
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Flush(threading.Event):
+    """A flush() request; ok is set with it to whether everything before it was saved."""
+    ok = False
+
+
+class ResultsWriter:
+    """Saves completed tests to a results store from a single background thread.
+
+    Handlers only enqueue completions; the writer thread batches them and hands
+    each batch to the store in one call, so rows from concurrent users never interleave.
+    The thread preloads the store first, before handling anything queued.
+    on_written, if set, is called on the writer thread with each batch once it is saved.
+
+    Rows of a batch the store rejects are retried one at a time with the next batches,
+    so a row that can't be saved doesn't hold up the rest. After max_attempts it is set
+    aside: logged in full and counted in set_aside.
+    """
+
+    def __init__(self, store, batch_size=100, flush_interval=1.0, on_written=None, max_attempts=3):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_written = on_written
+        self.max_attempts = max_attempts
+        self.set_aside = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._failed = []  # (row, attempts) waiting to be retried
+        self._reported = 0  # set_aside as of the last flush
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='results-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def write(self, row):
+        self._queue.put(row)
+
+    def flush(self, timeout=None):
+        """Blocks until every row enqueued so far has been handed to the store.
+
+        Returns False on timeout, if some rows are waiting to be retried, or if rows were
+        set aside since the previous flush.
+        """
+        if self._thread is None:
+            return self._write_pending()
+        done = _Flush()
+        self._queue.put(done)
+        return done.wait(timeout) and done.ok
+
+    def history(self, user_id, per_test, timeout=5.0):
+        """The store's history() for the user, after writing out anything still queued."""
+        self.flush(timeout)
+        return self.store.history(user_id, per_test)
+
+    def close(self):
+        """Writes out everything queued, retrying failed rows up to max_attempts, and closes the store.
+
+        Returns False if rows were set aside since the last flush.
+        """
+        if self._thread is None:
+            saved = self._write_pending(final=True)
+        else:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+            saved = self._report()
+        self.store.close()
+        return saved
+
+    def _run(self):
+        try:
+            self.store.preload()
+        except Exception:
+            logger.exception("Error preloading the results store")
+        running = True
+        while running:
+            rows = []
+            waiters = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    rows.append(item)
+                if not running or waiters or len(rows) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if not running:
+                rows.extend(self._take_queued(waiters))
+            self._write_rows(rows, final=not running)
+            if waiters:
+                self._answer(waiters)
+
+    def _take_queued(self, waiters):
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item is not _STOP:
+                items.append(item)
+
+    def _write_pending(self, final=False):
+        waiters = []
+        self._write_rows(self._take_queued(waiters), final)
+        return self._answer(waiters)
+
+    def _report(self):
+        """Whether nothing is waiting to be retried or was set aside since the last report."""
+        saved = not self._failed and self.set_aside == self._reported
+        self._reported = self.set_aside
+        return saved
+
+    def _answer(self, waiters):
+        saved = self._report()
+        for waiter in waiters:
+            waiter.ok = saved
+            waiter.set()
+        return saved
+
+    def _write_rows(self, rows, final=False):
+        # Rows that failed before are retried one at a time, apart from the new ones, so a
+        # row the store keeps rejecting only holds up itself
+        failed, self._failed = self._failed, []
+        for row, attempts in failed:
+            if not self._save([row]):
+                self._retry_later(row, attempts + 1)
+        if rows and not self._save(rows):
+            for row in rows:
+                self._retry_later(row, 1)
+        if final and self._failed:
+            # Closing: the failed rows get their remaining attempts now
+            self._write_rows([], final)
+
+    def _retry_later(self, row, attempts):
+        if attempts < self.max_attempts:
+            self._failed.append((row, attempts))
+            return
+        self.set_aside += 1
+        logger.error(f"Giving up on saving a result after {attempts} attempts: {row!r}")
+
+    def _save(self, rows):
+        try:
+            self.store.add_many(rows)
+        except Exception as e:
+            logger.error(f"Error saving {len(rows)} results: {e}")
+            return False
+        if self.on_written is not None:
+            try:
+                self.on_written(rows)
+            except Exception:
+                logger.exception(f"Error after saving {len(rows)} results")
+        return True
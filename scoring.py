@@ -1,71 +1,133 @@
 # scoring.py
+# Score interpretation. Each instrument's bands, labels and subscales are data in
+# scoring_rules.json, compiled at import into sorted cutoff tuples searched with bisect.
+import json
+from bisect import bisect_right
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Tuple
+
+SCORING_RULES_FILE = 'scoring_rules.json'
+
+
+class Instrument(NamedTuple):
+    name: str
+    title: str
+    items: int
+    min_item_score: int
+    max_item_score: int
+    # Lowest total of each band, ascending. labels[i] covers totals from cutoffs[i - 1] up to
+    # cutoffs[i] - 1, and labels[0] repeats the first band for totals below its minimum
+    cutoffs: Tuple[int, ...]
+    labels: Tuple[str, ...]
+    # Indexed like labels: for bands that also require the diagnosis criteria, the label used
+    # when they aren't met. Empty if no band does.
+    labels_without_diagnosis: Tuple[Optional[str], ...]
+    # (name, start, stop) slice bounds into the responses
+    subscales: Tuple[Tuple[str, int, int], ...]
+    # (start, stop, minimum subscale score) for every subscale the diagnosis requires
+    diagnosis_criteria: Tuple[Tuple[int, int, int], ...]
+    diagnosis_labels: Tuple[str, str]
+
+    def total(self, responses):
+        # Responses are option indices; instruments scored from 1 shift every item up
+        return sum(responses) + self.min_item_score * len(responses)
+
+    def subscale_scores(self, responses):
+        return tuple([sum(responses[start:stop]) for _, start, stop in self.subscales])
+
+    def meets_diagnosis(self, responses):
+        for start, stop, minimum in self.diagnosis_criteria:
+            if sum(responses[start:stop]) < minimum:
+                return False
+        return True
+
+    def interpret(self, total_score, responses=()):
+        index = bisect_right(self.cutoffs, total_score)
+        if self.labels_without_diagnosis:
+            fallback = self.labels_without_diagnosis[index]
+            if fallback is not None and not self.meets_diagnosis(responses):
+                return fallback
+        return self.labels[index]
+
+
+def compile_instrument(name, rule):
+    """Turns one instrument's rule table into an Instrument, checking bands and subscales."""
+    bands = sorted(rule['bands'], key=lambda band: band['min'])
+    cutoffs = tuple(band['min'] for band in bands)
+    if not cutoffs or len(set(cutoffs)) != len(cutoffs):
+        raise ValueError(f"{name}: score bands must have distinct 'min' values")
+
+    items = rule['items']
+    subscales = []
+    for subscale, (first, last) in rule.get('subscales', {}).items():
+        # Item ranges are 1-based and inclusive, as printed on the questionnaires
+        if not 1 <= first <= last <= items:
+            raise ValueError(f"{name}: subscale {subscale} items {first}-{last} are outside 1-{items}")
+        subscales.append((subscale, first - 1, last))
+
+    diagnosis = rule.get('diagnosis')
+    labels = tuple(band['label'] for band in bands[:1] + bands)
+    labels_without_diagnosis = tuple(band.get('label_without_diagnosis') for band in bands[:1] + bands)
+    if not any(labels_without_diagnosis):
+        labels_without_diagnosis = ()
+    elif diagnosis is None:
+        raise ValueError(f"{name}: bands refer to diagnosis criteria that aren't defined")
+    criteria = tuple((start, stop, diagnosis['minimums'][subscale])
+                     for subscale, start, stop in subscales if subscale in diagnosis['minimums']) if diagnosis else ()
+
+    return Instrument(
+        name=name,
+        title=rule.get('title', name),
+        items=items,
+        min_item_score=rule.get('min_item_score', 0),
+        max_item_score=rule['max_item_score'],
+        cutoffs=cutoffs,
+        labels=labels,
+        labels_without_diagnosis=labels_without_diagnosis,
+        subscales=tuple(subscales),
+        diagnosis_criteria=criteria,
+        diagnosis_labels=(diagnosis['label'], diagnosis['label_without']) if diagnosis else ('', ''),
+    )
+
+
+def load_scoring_rules(filename=SCORING_RULES_FILE):
+    with open(filename, 'r', encoding='utf-8') as file:
+        rules = json.load(file)
+    return MappingProxyType({name: compile_instrument(name, rule) for name, rule in rules.items()})
+
+
+# Compiled once at import and shared read-only, like the question banks
+INSTRUMENTS = load_scoring_rules()
 
 
 def score_becks_depression(total_score):
-    if total_score <= 10:
-        return "отсутствуют или не выражены симптомы депрессии."
-    elif 11 <= total_score <= 16:
-        return "имеются нарушения настроения."
-    elif 17 <= total_score <= 20:
-        return "есть симптомы на границе депрессии."
-    elif 21 <= total_score <= 30:
-        return "есть симптомы которые свидетельствуют или могут привести к умеренной депрессии."
-    elif 31 <= total_score <= 40:
-        return "имеются серьезные нарушения настроения либо выраженная депрессия."
-    else:
-        return "есть симптомы серьезной депрессии."
+    return INSTRUMENTS['beck_depression'].interpret(total_score)
 
 
 def score_becks_anxiety(total_score):
-    if total_score <= 7:
-        return "минимальный уровень тревожности."
-    elif 8 <= total_score <= 15:
-        return "легкая тревожность и беспокойство."
-    elif 16 <= total_score <= 25:
-        return "умеренная тревожность."
-    else:
-        return "сильная тревога."
+    return INSTRUMENTS['beck_anxiety'].interpret(total_score)
 
 
 def score_social_phobia(total_score):
-    if total_score <= 20:
-        return "нет социальной фобии или очень слабо выражена."
-    elif 21 <= total_score <= 30:
-        return "легкая социальная фобия."
-    elif 31 <= total_score <= 40:
-        return "умеренная социальная фобия."
-    elif 41 <= total_score <= 50:
-        return "сильная социальная фобия."
-    else:
-        return "очень сильная социальная фобия."
+    return INSTRUMENTS['social_phobia'].interpret(total_score)
 
 
 def calculate_pcl5_cluster_scores(responses):
-    cluster_b = sum(responses[0:5])  # Items 1-5 belong to Cluster B
-    cluster_c = sum(responses[5:7])  # Items 6-7 belong to Cluster C
-    cluster_d = sum(responses[7:15])  # Items 8-14 belong to Cluster D
-    cluster_e = sum(responses[15:20])  # Items 15-20 belong to Cluster E
-    return cluster_b, cluster_c, cluster_d, cluster_e
+    # Clusters B, C, D and E
+    return INSTRUMENTS['ptsd'].subscale_scores(responses)
 
 def make_provisional_diagnosis(responses):
-    cluster_b, cluster_c, cluster_d, cluster_e = calculate_pcl5_cluster_scores(responses)
-
-    if cluster_b >= 1 and cluster_c >= 1 and cluster_d >= 2 and cluster_e >= 2:
-        return "Provisional PTSD diagnosis"
-    else:
-        return "No PTSD diagnosis"
+    pcl5 = INSTRUMENTS['ptsd']
+    return pcl5.diagnosis_labels[0 if pcl5.meets_diagnosis(responses) else 1]
 
 def score_pcl5(responses):
-    # Calculate the total score based on the number of responses in the selected test
-    total_score = sum(responses)
-
-    # Scoring based on symptom clusters
-    cluster_b, cluster_c, cluster_d, cluster_e = calculate_pcl5_cluster_scores(responses)
-
     # Interpretation based on cutoff scores and symptom clusters
-    if total_score < 31:
-        return "нет выраженных симптомов ПСТР"
-    elif total_score <= 33 and cluster_b >= 1 and cluster_c >= 1 and cluster_d >= 2 and cluster_e >= 2:
-        return "есть симптомы ПТСР"
-    else:
-        return "вероятно есть постравматические растройства"
\ No newline at end of file
+    return INSTRUMENTS['ptsd'].interpret(sum(responses), responses)
+
+def explain_score(test_name, responses, instruments=None):
+    # Pick the interpretation for a completed test from its per-question responses,
+    # under the given rules (a catalog snapshot's) or the ones loaded at import
+    instrument = (INSTRUMENTS if instruments is None else instruments).get(test_name)
+    if instrument is None:
+        return "Unknown test type."
+    return instrument.interpret(instrument.total(responses), responses)
@@ -0,0 +1,42 @@
+# session.py
+from catalog import current_catalog
+
+
+class Session:
+    """Per-user test progress; the questions themselves live in the shared bank.
+
+    A session stays on the catalog snapshot it started with, even after a reload.
+    """
+    __slots__ = ('test_name', 'current_question', 'answers', 'message_id', 'catalog')
+
+    def __init__(self, test_name, message_id=None, catalog=None):
+        self.test_name = test_name
+        self.current_question = 0
+        # One byte per answered question, indexed by question number
+        self.answers = bytearray()
+        self.message_id = message_id
+        self.catalog = catalog or current_catalog()
+
+    @property
+    def questions(self):
+        return self.catalog.banks[self.test_name]
+
+    def is_finished(self):
+        return self.current_question >= len(self.questions)
+
+    def accepts_answer(self, message_id, question_index, option):
+        """Whether a tap answers the question currently shown in this session's message.
+
+        Double taps and redelivered callbacks name a question that was already answered,
+        and taps on an earlier test's keyboard come from another message.
+        """
+        return (message_id == self.message_id and question_index == self.current_question
+                and question_index < len(self.questions)
+                and option < len(self.questions[question_index].options))
+
+    def record_answer(self, option):
+        self.answers.append(option)
+        self.current_question += 1
+
+    def total_score(self):
+        return sum(self.answers)
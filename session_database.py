@@ -0,0 +1,133 @@
+# session_database.py
+# In-progress tests and conversation states in SQLite, so a restart resumes them. Used by
+# bot.py through persistence.SqliteSessionPersistence and by async_bot.py directly.
+import json
+import logging
+import sqlite3
+import threading
+from collections import defaultdict
+
+from catalog import get_catalog
+from session import Session
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    test_name TEXT NOT NULL,
+    current_question INTEGER NOT NULL,
+    answers BLOB NOT NULL,
+    message_id INTEGER,
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state INTEGER NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+
+def session_to_row(user_id, session):
+    return (user_id, session.test_name, session.current_question, bytes(session.answers), session.message_id,
+            session.catalog.version)
+
+
+def session_from_row(row):
+    _, test_name, current_question, answers, message_id, version = row
+    session = Session(test_name, message_id, get_catalog(version))
+    session.current_question = current_question
+    session.answers = bytearray(answers)
+    return session
+
+
+class SessionDatabase:
+    """Sessions as rows and conversation states by (name, key), with writes batched.
+
+    Only the users and conversations reported changed are written, at most once per
+    flush_interval, from a background thread.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        if 'version' not in [column[1] for column in self._conn.execute('PRAGMA table_info(sessions)')]:
+            # sessions.db from before catalog versions; those sessions resume on the current catalog
+            self._conn.execute('ALTER TABLE sessions ADD COLUMN version TEXT')
+        self._lock = threading.Lock()
+        # user_id -> session row, or None to delete; conversation (name, key) -> state or None
+        self._dirty_sessions = {}
+        self._dirty_conversations = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load_user_data(self):
+        """user_id -> {'session': Session} for every stored session."""
+        user_data = defaultdict(dict)
+        for row in self._conn.execute('SELECT * FROM sessions'):
+            user_data[row[0]]['session'] = session_from_row(row)
+        return user_data
+
+    def load_conversations(self, name):
+        rows = self._conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    def save_conversation(self, name, key, state):
+        with self._lock:
+            self._dirty_conversations[(name, json.dumps(key))] = state
+        self._start()
+
+    def save_user_data(self, user_id, data):
+        session = data.get('session')
+        # Snapshot now: the Session keeps changing after this call returns
+        row = session_to_row(user_id, session) if session else None
+        with self._lock:
+            self._dirty_sessions[user_id] = row
+        self._start()
+
+    def flush(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._write_dirty()
+
+    def _start(self):
+        if self._thread is None and not self._stop.is_set():
+            self._thread = threading.Thread(target=self._run, name='session-persistence', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._write_dirty()
+
+    def _write_dirty(self):
+        with self._lock:
+            sessions, self._dirty_sessions = self._dirty_sessions, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not sessions and not conversations:
+            return
+        try:
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)',
+                                       [row for row in sessions.values() if row])
+                self._conn.executemany('DELETE FROM sessions WHERE user_id = ?',
+                                       [(user_id,) for user_id, row in sessions.items() if not row])
+                self._conn.executemany('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+                                       [(name, key, state) for (name, key), state in conversations.items()
+                                        if state is not None])
+                self._conn.executemany('DELETE FROM conversations WHERE name = ? AND key = ?',
+                                       [(name, key) for (name, key), state in conversations.items()
+                                        if state is None])
+        except sqlite3.Error as e:
+            logger.error(f"Error saving {len(sessions)} sessions: {e}")
+            # Put the changes back unless newer ones arrived meanwhile
+            with self._lock:
+                self._dirty_sessions = {**sessions, **self._dirty_sessions}
+                self._dirty_conversations = {**conversations, **self._dirty_conversations}
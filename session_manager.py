@@ -0,0 +1,106 @@
+# session_manager.py
+# Idle-session expiry: a test nobody has touched for `ttl` seconds is evicted from
+# user_data and recorded as abandoned, so users who never finish don't pin memory.
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple
+
+import metrics
+from results_store import TIMESTAMP_FORMAT, Abandonment
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStats(NamedTuple):
+    live: int
+    evicted: int
+
+
+def record_abandonment(results_writer, user_id, session, reason):
+    """Counts a test left unfinished and queues its Abandonment row."""
+    metrics.test_abandoned(session.test_name)
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    results_writer.write(Abandonment(user_id, session.test_name, timestamp, session.current_question, reason))
+
+
+class SessionManager:
+    """Evicts sessions idle for longer than `ttl` seconds from a user_id -> user_data mapping.
+
+    Deadlines sit on a hashed timer wheel: one set of user ids per `resolution`-second
+    tick. touch() moves a user to a new tick in O(1) and expire() only visits the ticks
+    that have passed, so neither scans all users. Evicted users are handed to
+    on_evict(user_id, session).
+    """
+
+    def __init__(self, user_data, ttl, on_evict=None, resolution=1.0):
+        self.user_data = user_data
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.resolution = resolution
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._buckets = {}  # tick -> user ids due then
+        self._deadlines = {}  # user_id -> tick
+        self._swept = None  # last tick expire() has handled
+
+    def touch(self, user_id, now=None):
+        """Restarts the user's idle clock after an update, or stops tracking them once the test is over."""
+        data = self.user_data.get(user_id)
+        if not data or data.get('session') is None:
+            tick = None
+            if data is not None and not data:
+                # Nothing left to keep for a user between tests
+                self.user_data.pop(user_id, None)
+        else:
+            tick = math.ceil(((time.monotonic() if now is None else now) + self.ttl) / self.resolution)
+        with self._lock:
+            old = self._deadlines.pop(user_id, None)
+            if old is not None:
+                bucket = self._buckets[old]
+                bucket.discard(user_id)
+                if not bucket:
+                    del self._buckets[old]
+            if tick is not None:
+                self._deadlines[user_id] = tick
+                self._buckets.setdefault(tick, set()).add(user_id)
+
+    def expire(self, now=None):
+        """Evicts every session whose deadline has passed; returns how many."""
+        current = math.floor((time.monotonic() if now is None else now) / self.resolution)
+        evicted = []
+        with self._lock:
+            if not self._buckets:
+                self._swept = current
+                return 0
+            first = min(self._buckets) if self._swept is None else self._swept + 1
+            # After a long pause walking the occupied ticks is cheaper than every elapsed one
+            if current - first + 1 <= len(self._buckets):
+                ticks = range(first, current + 1)
+            else:
+                ticks = sorted(tick for tick in self._buckets if tick <= current)
+            for tick in ticks:
+                for user_id in self._buckets.pop(tick, ()):
+                    del self._deadlines[user_id]
+                    data = self.user_data.pop(user_id, None)
+                    session = data.get('session') if data else None
+                    if session is not None:
+                        evicted.append((user_id, session))
+            self._swept = current
+            self.evicted += len(evicted)
+        if evicted:
+            metrics.SESSIONS_EVICTED.inc(len(evicted))
+            logger.info(f"Evicted {len(evicted)} sessions idle for over {self.ttl:.0f} s")
+        if self.on_evict is not None:
+            for user_id, session in evicted:
+                try:
+                    self.on_evict(user_id, session)
+                except Exception:
+                    logger.exception(f"Error recording evicted session of user {user_id}")
+        return len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return SessionStats(len(self._deadlines), self.evicted)
@@ -0,0 +1,331 @@
+# session_store.py
+# Shared session storage, so several bot replicas can serve the same users. Each update
+# does one load() of the user's record (conversation state and test session together)
+# and at most one save(). A save only lands if nobody else saved that user since the
+# load (optimistic versioning), so concurrent updates can't overwrite each other.
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+from typing import NamedTuple, Optional
+
+from catalog import get_catalog
+from session import Session
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRecord(NamedTuple):
+    state: Optional[int]  # conversation state; None outside a conversation
+    session: Optional[Session]
+    version: int  # 0 when the user has no record
+
+
+EMPTY_RECORD = SessionRecord(None, None, 0)
+
+
+def encode_record(state, session):
+    data = {'state': state}
+    if session is not None:
+        data.update(test=session.test_name, question=session.current_question, answers=bytes(session.answers).hex(),
+                    message_id=session.message_id, version=session.catalog.version)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def decode_record(data, version):
+    data = json.loads(data)
+    session = None
+    if 'test' in data:
+        session = Session(data['test'], data['message_id'], get_catalog(data.get('version')))
+        session.current_question = data['question']
+        session.answers = bytearray.fromhex(data['answers'])
+    return SessionRecord(data['state'], session, version)
+
+
+class SessionStore:
+    """Per-user conversation state and test session, shared by every replica.
+
+    Records idle for `ttl` seconds are dropped by purge(), which returns them so their
+    tests can be recorded as abandoned; start() runs it periodically.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self, user_id):
+        """The user's SessionRecord, or EMPTY_RECORD."""
+        raise NotImplementedError
+
+    def save(self, user_id, state, session, version):
+        """Stores a new record if the user's is still at `version`; False if another update saved first.
+
+        Records are never deleted on save, only by purge(), so a version number is never reused.
+        """
+        raise NotImplementedError
+
+    def purge(self, now=None):
+        """Deletes records idle for longer than ttl; returns them as (user_id, SessionRecord) pairs.
+
+        Users between tests leave records without a session, which are purged the same way.
+        """
+        return []
+
+    def close(self):
+        pass
+
+    def start(self, interval, on_expire):
+        """Calls on_expire(user_id, record) for every purged record, every `interval` seconds."""
+        if self._thread is None and self.ttl:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval, on_expire), name='session-purge',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval, on_expire):
+        while not self._stop.wait(interval):
+            try:
+                expired = self.purge()
+            except Exception as e:
+                logger.error(f"Error purging idle sessions: {e}")
+                continue
+            for user_id, record in expired:
+                try:
+                    on_expire(user_id, record)
+                except Exception:
+                    logger.exception(f"Error recording expired session of user {user_id}")
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store, for a single replica and for tests of the replica logic.
+
+    Records are kept encoded, so a loaded Session is never shared with another update.
+    """
+
+    def __init__(self, ttl=None):
+        super().__init__(ttl)
+        self._records = {}  # user_id -> (version, data, updated_at)
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        entry = self._records.get(user_id)
+        return EMPTY_RECORD if entry is None else decode_record(entry[1], entry[0])
+
+    def save(self, user_id, state, session, version):
+        with self._lock:
+            current = self._records.get(user_id)
+            if (current[0] if current else 0) != version:
+                return False
+            self._records[user_id] = (version + 1, encode_record(state, session), time.time())
+            return True
+
+    def purge(self, now=None):
+        if not self.ttl:
+            return []
+        cutoff = (time.time() if now is None else now) - self.ttl
+        with self._lock:
+            expired = [user_id for user_id, (_, _, updated_at) in self._records.items() if updated_at < cutoff]
+            entries = [(user_id, self._records.pop(user_id)) for user_id in expired]
+        return [(user_id, decode_record(data, version)) for user_id, (version, data, _) in entries]
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_records (
+    user_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS session_records_updated ON session_records (updated_at);
+"""
+
+
+class SqliteSessionStore(SessionStore):
+    """Records in a SQLite file shared by the replicas on one host or volume.
+
+    Saves are a single conditional UPDATE (or INSERT for a new user), so the version
+    check and the write happen atomically even across processes.
+    """
+
+    def __init__(self, path, ttl=None, timeout=5.0):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._conn.execute('SELECT version, data FROM session_records WHERE user_id = ?',
+                                     (user_id,)).fetchone()
+        return EMPTY_RECORD if row is None else decode_record(row[1], row[0])
+
+    def save(self, user_id, state, session, version):
+        with self._lock, self._conn:
+            if not version:
+                cursor = self._conn.execute('INSERT OR IGNORE INTO session_records VALUES (?, 1, ?, ?)',
+                                            (user_id, encode_record(state, session), time.time()))
+            else:
+                cursor = self._conn.execute('UPDATE session_records SET version = version + 1, data = ?, '
+                                            'updated_at = ? WHERE user_id = ? AND version = ?',
+                                            (encode_record(state, session), time.time(), user_id, version))
+            return cursor.rowcount == 1
+
+    def purge(self, now=None):
+        if not self.ttl:
+            return []
+        cutoff = (time.time() if now is None else now) - self.ttl
+        expired = []
+        with self._lock, self._conn:
+            rows = self._conn.execute('SELECT user_id, version, data FROM session_records WHERE updated_at < ?',
+                                      (cutoff,)).fetchall()
+            for user_id, version, data in rows:
+                # Another replica may purge or touch the same record meanwhile; only one delete counts
+                if self._conn.execute('DELETE FROM session_records WHERE user_id = ? AND version = ?',
+                                      (user_id, version)).rowcount:
+                    expired.append((user_id, decode_record(data, version)))
+        return expired
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """A blocking connection speaking the Redis protocol (RESP), enough for RedisSessionStore."""
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, timeout=5.0):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        if password:
+            self.command('AUTH', password)
+        if db:
+            self.command('SELECT', db)
+
+    def command(self, *args):
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """Sends several commands in one write and returns their replies in order."""
+        chunks = []
+        for args in commands:
+            chunks.append(b'*%d\r\n' % len(args))
+            for arg in args:
+                arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+                chunks.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._sock.sendall(b''.join(chunks))
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('connection closed by Redis')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            return RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            return None if length < 0 else self._file.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise RedisError(f'unexpected reply {line!r}')
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+class RedisSessionStore(SessionStore):
+    """Records in Redis (or anything speaking its protocol, e.g. fake_redis.py), as
+    `<prefix><user_id>` -> 8-byte version + encoded record.
+
+    Saves WATCH the key and only write in a MULTI/EXEC transaction if the version read
+    under the watch is the one loaded. Idle records expire in Redis itself after ttl,
+    so purge() has nothing to return and expired tests leave no abandonment row.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, ttl=None, prefix='psy_bot:session:'):
+        super().__init__(ttl)
+        self.address = (host, port, db, password)
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._redis = None
+
+    def load(self, user_id):
+        with self._lock:
+            value = self._run(lambda redis: redis.command('GET', f'{self.prefix}{user_id}'))
+        return EMPTY_RECORD if value is None else decode_record(value[8:], int.from_bytes(value[:8], 'big'))
+
+    def save(self, user_id, state, session, version):
+        key = f'{self.prefix}{user_id}'
+
+        def watched_write(redis):
+            _, value = redis.pipeline([('WATCH', key), ('GET', key)])
+            if (0 if value is None else int.from_bytes(value[:8], 'big')) != version:
+                redis.command('UNWATCH')
+                return False
+            write = ('SET', key, (version + 1).to_bytes(8, 'big') + encode_record(state, session))
+            if self.ttl:
+                write += ('EX', int(self.ttl))
+            # EXEC replies nil when the watched key changed after WATCH
+            return redis.pipeline([('MULTI',), write, ('EXEC',)])[-1] is not None
+
+        with self._lock:
+            return self._run(watched_write)
+
+    def close(self):
+        with self._lock:
+            if self._redis is not None:
+                self._redis.close()
+                self._redis = None
+
+    def _run(self, operation):
+        # Connects lazily, and again after a failure left the connection mid-reply
+        if self._redis is None:
+            self._redis = RedisConnection(*self.address)
+        try:
+            return operation(self._redis)
+        except OSError:
+            self._redis.close()
+            self._redis = None
+            raise
+
+
+def open_session_store(url, ttl=None):
+    """memory://, sqlite:///relative.db, sqlite:////absolute.db or redis://[:password@]host:port/db."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == 'memory':
+        return MemorySessionStore(ttl)
+    if parts.scheme == 'sqlite':
+        return SqliteSessionStore(parts.path[1:], ttl)
+    if parts.scheme == 'redis':
+        db = int(parts.path.lstrip('/') or 0)
+        return RedisSessionStore(parts.hostname or '127.0.0.1', parts.port or 6379, db, parts.password, ttl)
+    raise ValueError(f"Unknown session store {url!r}")
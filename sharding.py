@@ -0,0 +1,210 @@
+# sharding.py
+# Multi-process mode: a front process receives updates (long polling or webhook) and
+# routes each one to one of N worker processes by user id. A user's updates always go
+# to the same worker, in order, so their test session lives there; different users
+# spread over the cores. Each worker runs async_bot.AsyncBot with its own Bot API
+# connections, outbound queue, results writer and session expiry.
+#
+#   BOT_WORKERS=4 python sharding.py
+import asyncio
+import functools
+import logging
+import multiprocessing
+import secrets
+import signal
+import threading
+
+import config
+import metrics
+from async_bot import AsyncBot, BotAPI
+from bot_api import TelegramError
+from catalog import CATALOGS
+from outbound import OutboundQueue
+from results_store import open_results_store
+from results_writer import ResultsWriter
+from stats import checkpoint_path, follow_results
+from webhook import WebhookServer, require_webhook_url
+
+logger = logging.getLogger(__name__)
+
+# Update kinds that carry the user in a 'from' field
+USER_UPDATE_KINDS = ('message', 'edited_message', 'callback_query')
+
+
+def update_user_id(update):
+    for kind in USER_UPDATE_KINDS:
+        sender = (update.get(kind) or {}).get('from')
+        if sender:
+            return sender['id']
+    return None
+
+
+def shard_for(update, shards):
+    """The worker that owns the update's user; updates without a user go to worker 0."""
+    user_id = update_user_id(update)
+    return 0 if user_id is None else user_id % shards
+
+
+def worker_api(token, base_url, shards):
+    # Telegram's global flood limit is per bot, so the workers split it
+    return OutboundQueue(BotAPI(token, base_url), config.OUTBOUND_GLOBAL_RATE / shards, config.OUTBOUND_CHAT_RATE,
+                         config.OUTBOUND_CHAT_BURST)
+
+
+def run_worker(index, inbox, ready, make_api, results_db, metrics_port):
+    # Ctrl-C reaches the whole process group; workers stop when the front tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(index, inbox, ready, make_api, results_db, metrics_port))
+
+
+async def refresh_statistics(statistics, interval):
+    """Reads the results other workers saved into this worker's statistics every `interval` seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, statistics.refresh)
+
+
+async def _serve(index, inbox, ready, make_api, results_db, metrics_port):
+    loop = asyncio.get_running_loop()
+    api = make_api()
+    # Every worker appends to the same results store; SQLite serializes the writers
+    results_writer = ResultsWriter(open_results_store(results_db, history_depth=config.HISTORY_LENGTH + 1))
+    # The statistics follow the shared store: this worker's batches as it writes them, and the
+    # other workers' on every refresh_statistics pass
+    statistics = follow_results(results_writer, checkpoint_path(results_db), config.STATS_CHECKPOINT_INTERVAL)
+    results_writer.start()
+    metrics_server = None
+    if metrics_port:
+        metrics_server = metrics.MetricsServer(host=config.METRICS_HOST, port=metrics_port).start()
+    bot = AsyncBot(api, results_writer, statistics=statistics)
+    expiry = asyncio.ensure_future(bot.run_expiry())
+    refresh = asyncio.ensure_future(refresh_statistics(statistics, config.STATS_REFRESH_INTERVAL))
+    # Each worker reloads edited banks on its own; catalog versions are content hashes, so they agree
+    CATALOGS.start(config.CATALOG_RELOAD_INTERVAL)
+    ready.put(index)
+    try:
+        while True:
+            updates = await loop.run_in_executor(None, inbox.get)
+            if updates is None:
+                break
+            for update in updates:
+                await bot.schedule(update)
+        await bot.drain()
+    finally:
+        expiry.cancel()
+        refresh.cancel()
+        CATALOGS.stop()
+        await api.close()
+        if not results_writer.close():
+            logger.error(f"Worker {index}: some results could not be saved; they are logged above")
+        statistics.save_checkpoint()
+        if metrics_server:
+            metrics_server.stop()
+
+
+class ShardedBot:
+    """Starts `shards` worker processes and routes batches of updates to them.
+
+    make_api is a picklable callable building each worker's BotAPIMethods client. With
+    metrics_port set, worker i serves /metrics on metrics_port + i.
+    """
+
+    def __init__(self, shards, make_api, results_db=config.RESULTS_DB, metrics_port=0):
+        context = multiprocessing.get_context('spawn')
+        self.shards = shards
+        self.inboxes = [context.Queue() for _ in range(shards)]
+        self._ready = context.Queue()
+        self.processes = [
+            context.Process(target=run_worker, name=f'bot-worker-{index}',
+                            args=(index, inbox, self._ready, make_api, results_db,
+                                  metrics_port + index if metrics_port else 0))
+            for index, inbox in enumerate(self.inboxes)
+        ]
+
+    def start(self):
+        """Starts the workers and waits until each is ready for updates."""
+        for process in self.processes:
+            process.start()
+        for _ in self.processes:
+            self._ready.get()
+        return self
+
+    def route(self, updates):
+        batches = [[] for _ in self.inboxes]
+        for update in updates:
+            batches[shard_for(update, self.shards)].append(update)
+        for inbox, batch in zip(self.inboxes, batches):
+            if batch:
+                inbox.put(batch)
+
+    def stop(self):
+        """Lets every worker finish the updates routed to it, then waits for them to exit."""
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+
+
+async def poll(api, sharded, poll_timeout=30):
+    offset = None
+    while True:
+        try:
+            updates = await api.get_updates(offset=offset, timeout=poll_timeout)
+        except (TelegramError, OSError, asyncio.TimeoutError) as e:
+            logger.error(f"Error fetching updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        if updates:
+            offset = updates[-1]['update_id'] + 1
+            sharded.route(updates)
+
+
+async def _set_webhook(api, secret_token):
+    try:
+        await api.call('setWebhook', url=config.WEBHOOK_URL, secret_token=secret_token)
+    finally:
+        await api.close()
+
+
+def run_webhook(api, sharded):
+    """Receives updates on a local HTTP endpoint and routes each one as it arrives."""
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    webhook = WebhookServer(lambda update: sharded.route([update]), secret_token, host=config.WEBHOOK_HOST,
+                            port=config.WEBHOOK_PORT, path=config.WEBHOOK_PATH,
+                            queue_size=config.WEBHOOK_QUEUE_SIZE).start()
+    asyncio.run(_set_webhook(api, secret_token))
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+    webhook.stop()
+
+
+def main() -> None:
+    if config.BOT_MODE == 'webhook':
+        require_webhook_url(config.WEBHOOK_URL)
+    with open("token.txt", "r") as file:
+        token = file.read().strip()
+    shards = config.BOT_WORKERS
+    make_api = functools.partial(worker_api, token, config.TELEGRAM_API_URL, shards)
+    sharded = ShardedBot(shards, make_api, config.RESULTS_DB, config.METRICS_PORT).start()
+    logger.info(f"Started {shards} bot workers")
+    api = BotAPI(token, config.TELEGRAM_API_URL)
+    try:
+        if config.BOT_MODE == 'webhook':
+            run_webhook(api, sharded)
+        else:
+            # Stop on SIGTERM (docker stop) the same way as on Ctrl-C
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            asyncio.run(poll(api, sharded))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sharded.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+# stats.py
+# Running statistics over every completed test: completions per test and day, score
+# histograms, band proportions and subscale (PCL-5 cluster) means. The aggregates are a
+# fold over the results store, brought up to date by reading only what was written since
+# the last refresh; a checkpoint of the aggregates and the store position they cover lets
+# the bot and the CLI pick up where the last run stopped instead of rescanning history.
+# Scores are small bounded integers, so the histograms are exact counts per score and
+# also rank a new result against everyone else's (the percentile end_test shows).
+#
+#   python stats.py [results.db] [--checkpoint results_stats.json] [--days 7] [--histogram]
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+from catalog import current_catalog
+from keyboards import TEST_TITLES
+from results_store import open_results_store
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FORMAT = 1
+# Days kept in each test's per-day counts; completions on older days are only counted in total
+PER_DAY_LIMIT = 366
+
+
+def checkpoint_path(results):
+    """Where the statistics over a results store are checkpointed: next to it, so each store has its own."""
+    return os.path.splitext(results)[0] + '_stats.json'
+
+
+class TestStats:
+    """Aggregates for one test. Memory is bounded by PER_DAY_LIMIT, the score range and the
+    number of bands, however many completions are added."""
+    __slots__ = ('completions', 'score_sum', 'per_day', 'earlier_days', 'scores', 'bands', 'subscale_sums',
+                 'subscale_completions')
+
+    def __init__(self):
+        self.completions = 0
+        self.score_sum = 0
+        self.per_day = {}  # 'YYYY-MM-DD' -> completions, for the latest PER_DAY_LIMIT days
+        self.earlier_days = 0  # completions on days older than those
+        self.scores = {}  # total score -> completions
+        self.bands = {}  # band label -> completions
+        # Subscale name -> sum of its scores, over the completions with every item answered
+        self.subscale_sums = {}
+        self.subscale_completions = 0
+
+    def add(self, completion, instrument=None):
+        self.completions += 1
+        self.score_sum += completion.total_score
+        day = completion.timestamp[:10]
+        if day in self.per_day:
+            self.per_day[day] += 1
+        elif len(self.per_day) < PER_DAY_LIMIT:
+            self.per_day[day] = 1
+        else:
+            # A new day pushes out the oldest one; completions arrive about in order, so this is once a day
+            oldest = min(self.per_day)
+            if day < oldest:
+                self.earlier_days += 1
+            else:
+                self.earlier_days += self.per_day.pop(oldest)
+                self.per_day[day] = 1
+        self.scores[completion.total_score] = self.scores.get(completion.total_score, 0) + 1
+        # The band the user was shown; only rows saved without one are scored here
+        band = completion.explanation
+        if not band and instrument is not None:
+            band = instrument.interpret(completion.total_score, completion.answers)
+        if band:
+            self.bands[band] = self.bands.get(band, 0) + 1
+        if instrument is not None and instrument.subscales and len(completion.answers) == instrument.items:
+            self.subscale_completions += 1
+            for (name, _, _), score in zip(instrument.subscales, instrument.subscale_scores(completion.answers)):
+                self.subscale_sums[name] = self.subscale_sums.get(name, 0) + score
+
+    def mean_score(self):
+        return self.score_sum / self.completions if self.completions else 0.0
+
+    def band_proportions(self):
+        """(label, share of completions), most common first."""
+        return [(band, count / self.completions)
+                for band, count in sorted(self.bands.items(), key=lambda item: -item[1])]
+
+    def percentile(self, score):
+        """Percentile rank of a total score among these completions, ties counting as half below.
+
+        Sums over the distinct scores, so the cost depends on the score range, not on how
+        many completions there are.
+        """
+        below = equal = 0
+        for value, count in self.scores.items():
+            if value < score:
+                below += count
+            elif value == score:
+                equal = count
+        return 100.0 * (below + equal / 2) / self.completions
+
+    def subscale_means(self):
+        if not self.subscale_completions:
+            return {}
+        return {name: total / self.subscale_completions for name, total in self.subscale_sums.items()}
+
+    def to_json(self):
+        return {
+            'completions': self.completions,
+            'score_sum': self.score_sum,
+            'per_day': self.per_day,
+            'earlier_days': self.earlier_days,
+            'scores': {str(score): count for score, count in self.scores.items()},
+            'bands': self.bands,
+            'subscale_sums': self.subscale_sums,
+            'subscale_completions': self.subscale_completions,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls()
+        stats.completions = data['completions']
+        stats.score_sum = data['score_sum']
+        # Checkpoints from before the per-day limit have no earlier_days and may hold more days
+        days = sorted(data['per_day'].items())
+        stats.per_day = dict(days[-PER_DAY_LIMIT:])
+        stats.earlier_days = data.get('earlier_days', 0) + sum(count for _, count in days[:-PER_DAY_LIMIT])
+        stats.scores = {int(score): count for score, count in data['scores'].items()}
+        stats.bands = dict(data['bands'])
+        stats.subscale_sums = dict(data['subscale_sums'])
+        stats.subscale_completions = data['subscale_completions']
+        return stats
+
+
+class ResultStatistics:
+    """TestStats for every test in a results store, kept up to date with refresh().
+
+    Without a checkpoint file every instance starts from the first completion. A checkpoint
+    belongs to one results store; delete it (or pass --rebuild to the CLI) to start over.
+    """
+
+    def __init__(self, store, checkpoint=None, checkpoint_interval=60.0):
+        self.store = store
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.position = 0
+        self.tests = {}
+        self._lock = threading.Lock()
+        self._unsaved = False
+        self._saved_at = time.monotonic()
+        if checkpoint:
+            self._load_checkpoint()
+
+    def refresh(self):
+        """Adds the completions written since the last refresh; returns how many there were."""
+        with self._lock:
+            added = 0
+            instruments = current_catalog().instruments
+            while True:
+                position, completions = self.store.completions_since(self.position)
+                if position == self.position and not completions:
+                    break
+                for completion in completions:
+                    stats = self.tests.get(completion.test_name)
+                    if stats is None:
+                        stats = self.tests[completion.test_name] = TestStats()
+                    stats.add(completion, instruments.get(completion.test_name))
+                added += len(completions)
+                self.position = position
+                self._unsaved = True
+            if self._unsaved and self.checkpoint and time.monotonic() - self._saved_at >= self.checkpoint_interval:
+                self._save_checkpoint()
+            return added
+
+    def save_checkpoint(self):
+        with self._lock:
+            if self.checkpoint:
+                self._save_checkpoint()
+
+    def percentile_text(self, test_name, score, min_completions=1):
+        """The line end_test adds under a result, or '' until the test has min_completions."""
+        with self._lock:
+            stats = self.tests.get(test_name)
+            if stats is None or stats.completions < max(min_completions, 1):
+                return ''
+            return f"Процентиль среди {stats.completions} прошедших этот тест: {stats.percentile(score):.0f}"
+
+    def report(self, days=7, today=None):
+        with self._lock:
+            return format_report(self.tests, days, today or date.today())
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint, encoding='utf-8') as file:
+                data = json.load(file)
+            if data.get('format') != CHECKPOINT_FORMAT:
+                raise ValueError(f"unsupported format {data.get('format')!r}")
+            tests = {test_name: TestStats.from_json(stats) for test_name, stats in data['tests'].items()}
+            position = data['position']
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Ignoring statistics checkpoint {self.checkpoint}: {e}")
+            return
+        self.tests = tests
+        self.position = position
+
+    def _save_checkpoint(self):
+        data = {
+            'format': CHECKPOINT_FORMAT,
+            'position': self.position,
+            'tests': {test_name: stats.to_json() for test_name, stats in self.tests.items()},
+        }
+        # Written next to the checkpoint and renamed over it, so a crash leaves the old one intact;
+        # the temporary name is per process because sharding.py workers share the checkpoint
+        temporary = f'{self.checkpoint}.{os.getpid()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(temporary, self.checkpoint)
+        self._unsaved = False
+        self._saved_at = time.monotonic()
+
+
+def follow_results(results_writer, checkpoint, checkpoint_interval=60.0):
+    """ResultStatistics for a ResultsWriter's store, caught up from the checkpoint and then
+    refreshed on the writer thread after every batch it saves."""
+    statistics = ResultStatistics(results_writer.store, checkpoint, checkpoint_interval)
+    statistics.refresh()
+    results_writer.on_written = lambda rows: statistics.refresh()
+    return statistics
+
+
+def format_report(tests, days, today):
+    """The /stats reply: per-test totals, the last `days` days and band shares."""
+    total = sum(stats.completions for stats in tests.values())
+    if not total:
+        return "Завершённых тестов пока нет."
+    lines = [f"Статистика на {today.isoformat()}: {total} завершённых тестов"]
+    recent_days = [(today - timedelta(days=offset)).isoformat() for offset in range(days - 1, -1, -1)]
+    for test_name in sorted(tests):
+        stats = tests[test_name]
+        recent = [stats.per_day.get(day, 0) for day in recent_days]
+        lines.append('')
+        lines.append(f"{TEST_TITLES.get(test_name, test_name)}: {stats.completions}, "
+                     f"за {days} дн.: {sum(recent)}, средний балл {stats.mean_score():.1f}")
+        lines.append("по дням: " + ', '.join(f"{day[5:]}: {count}" for day, count in zip(recent_days, recent)))
+        for band, share in stats.band_proportions():
+            lines.append(f"{share:6.1%}  {band}")
+        means = stats.subscale_means()
+        if means:
+            lines.append("средние по кластерам: " + ', '.join(f"{name} {mean:.1f}" for name, mean in means.items()))
+    return '\n'.join(lines)
+
+
+def format_histogram(stats, width=40):
+    largest = max(stats.scores.values())
+    return '\n'.join(f"{score:4d} {count:7d} {'#' * max(round(count * width / largest), 1)}"
+                     for score, count in sorted(stats.scores.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show statistics over completed tests.")
+    parser.add_argument('results', nargs='?', default='results.db', help="results database or CSV file")
+    parser.add_argument('--checkpoint', help="aggregates saved between runs (default: <results>_stats.json)")
+    parser.add_argument('--days', type=int, default=7, 
+                        help=f"days of per-day counts to show (default: %(default)s; the last {PER_DAY_LIMIT} are kept)")
+    parser.add_argument('--histogram', action='store_true', help="also print each test's score histogram")
+    parser.add_argument('--rebuild', action='store_true', help="ignore the checkpoint and read every completion")
+    args = parser.parse_args()
+
+    args.checkpoint = args.checkpoint or checkpoint_path(args.results)
+    if args.rebuild and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    store = open_results_store(args.results)
+    try:
+        statistics = ResultStatistics(store, args.checkpoint)
+        added = statistics.refresh()
+        statistics.save_checkpoint()
+    finally:
+        store.close()
+    print(statistics.report(args.days))
+    if args.histogram:
+        for test_name in sorted(statistics.tests):
+            print()
+            print(f"{test_name}:")
+            print(format_histogram(statistics.tests[test_name]))
+    print()
+    print(f"{added} completions read since the last checkpoint")
+
+
+if __name__ == '__main__':
+    main()
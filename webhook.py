@@ -0,0 +1,145 @@
+# webhook.py
+# Webhook ingestion: a small HTTP endpoint that Telegram POSTs updates to, as an
+# alternative to long polling.
+import argparse
+import hmac
+import json
+import logging
+import queue
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_SIZE = 1 << 20
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        # Rejected before reading the body, which would otherwise be parsed as the next
+        # request on a keep-alive connection; closing it is cheaper than draining it
+        if self.path != webhook.path:
+            return self._reply(404, close=True)
+        if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), webhook.secret_token):
+            return self._reply(403, close=True)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_SIZE:
+            return self._reply(413, close=True)
+        try:
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._reply(400)
+        if not webhook.enqueue(update):
+            # Telegram redelivers updates that weren't acknowledged with 200
+            return self._reply(503)
+        self._reply(200)
+
+    def do_GET(self):
+        self._reply(405)
+
+    def _reply(self, status, close=False):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer:
+    """Validates incoming update POSTs and hands them to `handle_update` through a bounded queue.
+
+    A single dispatcher thread drains the queue so each user's updates are handled in order.
+    """
+
+    def __init__(self, handle_update, secret_token, host='0.0.0.0', port=8443, path='/webhook', queue_size=1000):
+        self.handle_update = handle_update
+        self.secret_token = secret_token
+        self.path = path
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.httpd = ThreadingHTTPServer((host, port), _WebhookRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self
+        self._threads = []
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def enqueue(self, update):
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            logger.warning("Webhook update queue is full, rejecting update")
+            return False
+        return True
+
+    def start(self):
+        self._threads = [threading.Thread(target=self.httpd.serve_forever, name='webhook-http', daemon=True),
+                         threading.Thread(target=self._dispatch, name='webhook-dispatcher', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.updates.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _dispatch(self):
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.handle_update(update)
+            except Exception:
+                logger.exception(f"Error handling update {update.get('update_id')}")
+
+
+def require_webhook_url(url):
+    """Fails at startup without a webhook URL: Telegram takes setWebhook(url='') as deleting the webhook."""
+    if not url:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL, the public HTTPS URL Telegram should POST updates to")
+
+
+def replay(url, secret_token, payloads):
+    """POSTs recorded update payloads to a webhook and returns the HTTP status of each."""
+    statuses = []
+    for payload in payloads:
+        request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'), method='POST',
+                                         headers={'Content-Type': 'application/json', SECRET_HEADER: secret_token})
+        try:
+            with urllib.request.urlopen(request) as response:
+                statuses.append(response.status)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates (one JSON object per line) to a webhook.")
+    parser.add_argument('url')
+    parser.add_argument('secret_token')
+    parser.add_argument('updates', type=argparse.FileType('r', encoding='utf-8'))
+    args = parser.parse_args()
+
+    payloads = [json.loads(line) for line in args.updates if line.strip()]
+    statuses = replay(args.url, args.secret_token, payloads)
+    print(f"Posted {len(statuses)} updates, {statuses.count(200)} accepted")
+
+
+if __name__ == '__main__':
+    main()